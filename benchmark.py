@@ -0,0 +1,321 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+import create_cubic_structure as ccs
+import crystal
+
+# Number of atoms of the benchmarked structures (the last sizes take minutes and several GB: select them with --sizes)
+BENCHMARK_SIZES = (10, 100, 1000, 10**4, 10**5, 10**6)
+
+# A benchmark is flagged as a regression when it is slower (or uses more memory) than this factor times the baseline
+REGRESSION_THRESHOLD = 1.5
+
+# Times below this value (s) are dominated by noise and are never flagged
+MINIMUM_TIME = 1e-3
+
+
+def _cubic_repetitions(
+                    structure : str,
+                    n_atoms : int
+) -> int:
+    """
+    Notes
+    -----
+    This function returns the repetitions N of an N x N x N cubic structure with about n_atoms atoms
+
+    Parameters
+    ----------
+    structure (str) : type of cubic structure (sc, bcc or fcc)
+    n_atoms (int) : number of atoms
+
+    Returns
+    -------
+    N (int) : number of repetitions along each axis
+    """
+    atoms_per_cell = {"sc": 1, "bcc": 2, "fcc": 4}[structure]
+    return max(1, int(round((n_atoms / atoms_per_cell)**(1/3))) - 1)
+
+
+def _surface_repetitions(n_atoms : int) -> int:
+    """
+    Notes
+    -----
+    This function returns the repetitions N of an N x N surface with about n_atoms atoms
+
+    Parameters
+    ----------
+    n_atoms (int) : number of atoms
+
+    Returns
+    -------
+    N (int) : number of repetitions along each axis
+    """
+    return max(1, int(round(np.sqrt(n_atoms))) - 1)
+
+
+def _generate(structure : str):
+    def setup(n_atoms, directory):
+        N = _cubic_repetitions(structure, n_atoms)
+        return lambda: ccs.generate_cubic_structure(structure, N, N, N)
+    return setup
+
+
+def _shift_surface(n_atoms, directory):
+    surface = ccs.generate_surface_structure("fcc", '111', _surface_repetitions(n_atoms), _surface_repetitions(n_atoms))
+    return lambda: ccs.shift_surface_coordinates(surface)
+
+
+def _symmetry(n_atoms, directory):
+    surface = ccs.shift_surface_coordinates(ccs.generate_surface_structure("fcc", '111', _surface_repetitions(n_atoms), _surface_repetitions(n_atoms)))
+    return lambda: ccs.get_symmetry_properties(surface, lattice_vectors = ccs.surface_lattice_vectors("fcc", '111'))
+
+
+def _intensity(n_atoms, directory):
+    N = _surface_repetitions(n_atoms)
+    return lambda: ccs.calculate_intensity(N, N)
+
+
+def _crystal_intensity(n_atoms, directory):
+    N = _cubic_repetitions("fcc", n_atoms)
+    fcc = crystal.cubic_crystal("fcc", N, N, N)
+    q_points = np.random.default_rng(0).uniform(0, 3, (1000, 3))
+    return lambda: crystal.crystal_intensity(fcc, q_points)
+
+
+def _parameters(n_atoms):
+    N = _cubic_repetitions("fcc", n_atoms)
+    return {"structure": "fcc", "Nx": N, "Ny": N, "Nz": N, "a": 3.85, "element": "Ir", "plane": "111", "Na": 1, "Nb": 1}
+
+
+def _save(n_atoms, directory):
+    parameters = _parameters(n_atoms)
+    coordinates = ccs.generate_cubic_structure("fcc", parameters["Nx"], parameters["Ny"], parameters["Nz"], parameters["a"])
+
+    def save():
+        cwd = os.getcwd()
+        os.chdir(directory)
+        try:
+            return ccs.save_atomic_coordinates(coordinates, parameters)
+        finally:
+            os.chdir(cwd)
+    return save
+
+
+def _load(n_atoms, directory):
+    parameters = _parameters(n_atoms)
+    coordinates = ccs.generate_cubic_structure("fcc", parameters["Nx"], parameters["Ny"], parameters["Nz"], parameters["a"])
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        filename = os.path.join(directory, ccs.save_atomic_coordinates(coordinates, parameters))
+    finally:
+        os.chdir(cwd)
+
+    # the coordinates are memory mapped: read them all, as a consumer would
+    return lambda: ccs.load_atomic_coordinates(filename)[0].sum()
+
+
+# Benchmarked functions: for each name, setup(n_atoms, directory) prepares the inputs and returns the callable to time
+BENCHMARKS = {
+    "generate_cubic_structure[sc]": _generate("sc"),
+    "generate_cubic_structure[bcc]": _generate("bcc"),
+    "generate_cubic_structure[fcc]": _generate("fcc"),
+    "shift_surface_coordinates": _shift_surface,
+    "get_symmetry_properties": _symmetry,
+    "calculate_intensity": _intensity,
+    "crystal_intensity": _crystal_intensity,
+    "save_atomic_coordinates": _save,
+    "load_atomic_coordinates": _load,
+}
+
+
+def measure(
+        function,
+        repeat : int = 3
+) -> [float, int]:
+    """
+    Notes
+    -----
+    This function measures the wall time (best of repeat runs) and the peak memory allocated by a function.
+    The memory is traced (tracemalloc, which also sees the numpy buffers) in a separate run, so that the
+    tracing overhead does not affect the timings.
+
+    Parameters
+    ----------
+    function (callable) : function without arguments
+    repeat (int) : number of timed runs
+
+    Returns
+    -------
+    elapsed (float) : best wall time in seconds
+    peak_memory (int) : peak of the memory allocated during the call, in bytes
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        function()
+        peak_memory = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return min(times), peak_memory
+
+
+def run_benchmarks(
+                names : list = None,
+                sizes : tuple = BENCHMARK_SIZES,
+                repeat : int = 3,
+                verbose : bool = False
+) -> list:
+    """
+    Notes
+    -----
+    This function runs the benchmarks for every size
+
+    Parameters
+    ----------
+    names (list) : names of the benchmarks to run (default: all the BENCHMARKS)
+    sizes (tuple) : numbers of atoms of the benchmarked structures
+    repeat (int) : number of timed runs of every benchmark
+    verbose (bool) : if true, prints every result as soon as it is measured
+
+    Returns
+    -------
+    results (list) : one dictionary per benchmark and size with the keys benchmark, size, time (s) and peak_memory (bytes)
+    """
+    names = list(BENCHMARKS) if names is None else names
+    unknown = set(names) - set(BENCHMARKS)
+    if unknown:
+        raise ValueError(f"Error: unknown benchmarks {sorted(unknown)}.")
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for name in names:
+            for size in sizes:
+                elapsed, peak_memory = measure(BENCHMARKS[name](size, directory), repeat)
+                results.append({"benchmark": name, "size": size, "time": elapsed, "peak_memory": peak_memory})
+                if verbose:
+                    print(f"{name:32s} {size:>10d} {elapsed:12.6f} s {peak_memory / 2**20:12.3f} MiB")
+
+    return results
+
+
+def save_baseline(
+                results : list,
+                filename : str = 'benchmark_baseline.json'
+) -> str:
+    """
+    Notes
+    -----
+    This function stores the results of run_benchmarks as the baseline of the following comparisons
+
+    Parameters
+    ----------
+    results (list) : results of run_benchmarks
+    filename (str) : name of the JSON file of the baseline
+
+    Returns
+    -------
+    filename (str) : name of the JSON file of the baseline
+    """
+    with open(filename, 'w') as file:
+        json.dump(results, file, indent=1)
+    return filename
+
+
+def load_baseline(filename : str = 'benchmark_baseline.json') -> list:
+    """
+    Notes
+    -----
+    This function reads a baseline written by save_baseline
+
+    Parameters
+    ----------
+    filename (str) : name of the JSON file of the baseline
+
+    Returns
+    -------
+    results (list) : results of run_benchmarks stored as baseline
+    """
+    if not os.path.isfile(filename):
+        raise FileNotFoundError(f"Error: '{filename}' file not found. Run benchmark.py --save-baseline first.")
+
+    with open(filename) as file:
+        return json.load(file)
+
+
+def find_regressions(
+                    results : list,
+                    baseline : list,
+                    threshold : float = REGRESSION_THRESHOLD
+) -> list:
+    """
+    Notes
+    -----
+    This function compares the results with the baseline and returns the benchmarks that became slower or
+    use more memory by more than the threshold factor. Benchmarks missing from the baseline are ignored.
+
+    Parameters
+    ----------
+    results (list) : results of run_benchmarks
+    baseline (list) : results of run_benchmarks stored as baseline
+    threshold (float) : tolerated ratio between the result and the baseline
+
+    Returns
+    -------
+    regressions (list) : one dictionary per regression with the keys benchmark, size, metric, baseline, value and ratio
+    """
+    reference = {(record["benchmark"], record["size"]): record for record in baseline}
+
+    regressions = []
+    for record in results:
+        previous = reference.get((record["benchmark"], record["size"]))
+        if previous is None:
+            continue
+        for metric, minimum in (("time", MINIMUM_TIME), ("peak_memory", 2**20)):
+            if record[metric] > minimum and record[metric] > threshold * previous[metric]:
+                regressions.append({"benchmark": record["benchmark"], "size": record["size"], "metric": metric,
+                                    "baseline": previous[metric], "value": record[metric], "ratio": record[metric] / max(previous[metric], 1e-12)})
+
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time the generators, the symmetry checks, the intensity and the save/load paths across sizes.")
+    parser.add_argument("--benchmarks", nargs="+", default=None, help=f"benchmarks to run (default: all): {', '.join(BENCHMARKS)}")
+    parser.add_argument("--sizes", nargs="+", type=int, default=BENCHMARK_SIZES, help="numbers of atoms (default: 10 to 10^6)")
+    parser.add_argument("--repeat", type=int, default=3, help="number of timed runs of every benchmark (default: 3)")
+    parser.add_argument("--baseline", default="benchmark_baseline.json", help="JSON file of the baseline (default: benchmark_baseline.json)")
+    parser.add_argument("--save-baseline", action="store_true", help="store the results as the new baseline instead of comparing them")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD, help=f"regression ratio (default: {REGRESSION_THRESHOLD})")
+    args = parser.parse_args()
+
+    try:
+        print(f"{'benchmark':32s} {'atoms':>10s} {'time':>14s} {'peak memory':>16s}")
+        results = run_benchmarks(args.benchmarks, args.sizes, args.repeat, verbose=True)
+
+        if args.save_baseline:
+            print(f"Baseline saved in {save_baseline(results, args.baseline)}")
+        elif os.path.isfile(args.baseline):
+            regressions = find_regressions(results, load_baseline(args.baseline), args.threshold)
+            for regression in regressions:
+                print(f"REGRESSION {regression['benchmark']} ({regression['size']} atoms): {regression['metric']} "
+                      f"{regression['value']:.6g} vs {regression['baseline']:.6g} ({regression['ratio']:.2f}x)")
+            print(f"{len(regressions)} regressions with respect to {args.baseline}")
+            sys.exit(1 if regressions else 0)
+    except ValueError as e:
+        print(f"Error: {e}")
+    except FileNotFoundError as e:
+        print(f"Error: {e}")
@@ -1,42 +1,62 @@
 import numpy as np
+import argparse
 import configparser
-import matplotlib.pyplot as plt
-# Read configuration from the 'config.ini' file
-config = configparser.ConfigParser()
-config.read('config.ini')
-
-# Extract configuration parameters
-cubic_structure = config.get('cubic_structure', 'type').lower()
+import itertools
+import json
+import os
 
-Nx_string = config.get('repetitions', 'Nx')
-Ny_string = config.get('repetitions', 'Ny')
-Nz_string = config.get('repetitions', 'Nz')
-Nx = int(Nx_string)
-Ny = int(Ny_string)
-Nz = int(Nz_string)
+import kernels
+from instrumentation import instrumented, count_result_atoms, count_input_atoms, count_q_points
 
-a_string = config.get('lattice_parameter', 'a')
-a = float(a_string)
+# Read configuration from the 'config.ini' file
+def read_config(
+            config_file : str = 'config.ini'
+) -> dict:
+    """
+    Notes
+    -----
+    This function reads and validates the parameters of the structure from a configuration file
 
-element_symbol = config.get('element', 'symbol')
+    Parameters
+    ----------
+    config_file (str) : name of the configuration file
 
-plane = config.get('surface', 'plane')
+    Returns
+    -------
+    parameters (dict) : dictionary with the keys structure, Nx, Ny, Nz, a, element, plane, Na and Nb
+    """
+    config = configparser.ConfigParser()
+    if not config.read(config_file):
+        raise FileNotFoundError(f"Error: '{config_file}' file not found.")
+
+    # Extract configuration parameters
+    parameters = {
+        "structure": config.get('cubic_structure', 'type').lower(),
+        "Nx": int(config.get('repetitions', 'Nx')),
+        "Ny": int(config.get('repetitions', 'Ny')),
+        "Nz": int(config.get('repetitions', 'Nz')),
+        "a": float(config.get('lattice_parameter', 'a')),
+        "element": config.get('element', 'symbol'),
+        "plane": config.get('surface', 'plane'),
+        "Na": int(config.get('surface_repetitions', 'Na')),
+        "Nb": int(config.get('surface_repetitions', 'Nb')),
+    }
 
-Na_string = config.get('surface_repetitions', 'Na')
-Nb_string = config.get('surface_repetitions', 'Nb')
-Na = int(Na_string)
-Nb = int(Nb_string)
+    # Check for a specific error condition and raise an exception if met
+    if parameters["Nx"] == 0 or parameters["Ny"] == 0 or parameters["Nz"] == 0:
+        raise ValueError("Error: At least one of Nx, Ny, or Nz is equal to zero.")
 
-# Check for a specific error condition and raise an exception if met
-if Nx == 0 or Ny == 0 or Nz == 0:
-    raise ValueError("Error: At least one of Nx, Ny, or Nz is equal to zero.")
+    return parameters
 
 # Create a 3D grid of atoms for the specified cubic structure
+@instrumented(counts=count_result_atoms)
 def generate_cubic_structure(
                         structure : str,
                         Nx : int,
                         Ny : int,
-                        Nz : int
+                        Nz : int,
+                        a : float = 1.0,
+                        dtype : np.dtype = np.float64
 ):
     """
     Notes
@@ -49,18 +69,21 @@ def generate_cubic_structure(
     Nx (int) : number of repetitions of the structure to display the x axis
     Ny (int) : number of repetitions of the structure to display the y axis
     Nz (int) : number of repetitions of the structure to display the z axis
+    a (float) : lattice parameter (1 gives the positions in units of the lattice parameter)
+    dtype (np.dtype) : floating point type of the returned array
 
     """
 
     if structure == "sc":
-        return generate_simple_cubic(Nx, Ny, Nz)
+        return generate_simple_cubic(Nx, Ny, Nz, a, dtype)
     elif structure == "bcc":
-        return generate_body_centered_cubic(Nx, Ny, Nz)
+        return generate_body_centered_cubic(Nx, Ny, Nz, a, dtype)
     elif structure == "fcc":
-        return generate_face_centered_cubic(Nx, Ny, Nz)
+        return generate_face_centered_cubic(Nx, Ny, Nz, a, dtype)
     else:
         raise ValueError("Invalid cubic_structure specified in config.ini")
     
+@instrumented(counts=count_result_atoms)
 def generate_surface_structure(
                             structure : str,
                             plane : str,
@@ -91,11 +114,184 @@ def generate_surface_structure(
 
 
 
+def _fill_sublattice(
+                    block : np.ndarray,
+                    x : np.ndarray,
+                    y : np.ndarray,
+                    z : np.ndarray
+):
+    """
+    Notes
+    -----
+    This function writes the positions of one cubic sublattice into a preallocated block, keeping the
+    x-major, z-minor ordering of the original nested loops
+
+    Parameters
+    ----------
+    block (np.ndarray) : (len(x)*len(y)*len(z), 3) view of the output array to be filled
+    x (np.ndarray) : coordinates of the sublattice along the x axis
+    y (np.ndarray) : coordinates of the sublattice along the y axis
+    z (np.ndarray) : coordinates of the sublattice along the z axis
+    """
+    grid = block.reshape(len(x), len(y), len(z), 3)
+    grid[..., 0] = x[:, None, None]
+    grid[..., 1] = y[None, :, None]
+    grid[..., 2] = z[None, None, :]
+
+
+def _cubic_sublattices(
+                    structure : str,
+                    Nx : int,
+                    Ny : int,
+                    Nz : int,
+                    a : float = 1.0
+) -> list:
+    """
+    Notes
+    -----
+    This function returns the axis coordinates of every sublattice of the cubic structure, in the order
+    in which the atoms are stored (verteces first, then body or face centered atoms)
+
+    Parameters
+    ----------
+    structure (str) : type of cubic structure (sc, bcc or fcc)
+    Nx (int) : number of repetitions of the structure to display the x axis
+    Ny (int) : number of repetitions of the structure to display the y axis
+    Nz (int) : number of repetitions of the structure to display the z axis
+    a (float) : lattice parameter
+
+    Returns
+    -------
+    sublattices (list) : list of (x, y, z) tuples of 1-dim arrays with the coordinates along each axis
+    """
+    corners = (np.arange(Nx + 1) * a, np.arange(Ny + 1) * a, np.arange(Nz + 1) * a)
+
+    if structure == "sc":
+        return [corners]
+    elif structure == "bcc":
+        # evaluation of the position of the central atoms
+        centers = ((np.arange(Nx) + 0.5) * a, (np.arange(Ny) + 0.5) * a, (np.arange(Nz) + 0.5) * a)
+        return [corners, centers]
+    elif structure == "fcc":
+        # face centered atoms along the x, y and z direction
+        faces = (np.arange(Nx) * a + a/2, np.arange(Ny) * a + a/2, np.arange(Nz) * a + a/2)
+        return [
+            corners,
+            (corners[0], faces[1], faces[2]),
+            (faces[0], corners[1], faces[2]),
+            (faces[0], faces[1], corners[2]),
+        ]
+    else:
+        raise ValueError("Invalid cubic_structure specified in config.ini")
+
+def _build_structure(
+                    sublattices : list,
+                    dtype : np.dtype = np.float64
+) -> np.ndarray:
+    """
+    Notes
+    -----
+    This function fills the positions of all the sublattices into one preallocated array
+
+    Parameters
+    ----------
+    sublattices (list) : list of (x, y, z) axis coordinates, as returned by _cubic_sublattices
+    dtype (np.dtype) : floating point type of the returned array
+
+    Returns
+    -------
+    atomic_positions (np.ndarray) : (N, 3) array cointaining the atomic positions
+    """
+    counts = [len(x) * len(y) * len(z) for x, y, z in sublattices]
+    atomic_positions = np.empty((sum(counts), 3), dtype=dtype)
+
+    start = 0
+    for (x, y, z), count in zip(sublattices, counts):
+        _fill_sublattice(atomic_positions[start:start + count], x, y, z)
+        start += count
+
+    return atomic_positions
+
+def count_cubic_atoms(
+                    structure : str,
+                    Nx : int,
+                    Ny : int,
+                    Nz : int
+) -> int:
+    """
+    Notes
+    -----
+    This function returns the number of atoms of the cubic structure without generating it
+
+    Parameters
+    ----------
+    structure (str) : type of cubic structure (sc, bcc or fcc)
+    Nx (int) : number of repetitions of the structure to display the x axis
+    Ny (int) : number of repetitions of the structure to display the y axis
+    Nz (int) : number of repetitions of the structure to display the z axis
+
+    Returns
+    -------
+    n_atoms (int) : number of atoms of the structure
+    """
+    return sum(len(x) * len(y) * len(z) for x, y, z in _cubic_sublattices(structure, Nx, Ny, Nz))
+
+def iterate_cubic_structure(
+                        structure : str,
+                        Nx : int,
+                        Ny : int,
+                        Nz : int,
+                        a : float = 1.0,
+                        block_size : int = 1_000_000,
+                        dtype : np.dtype = np.float64
+):
+    """
+    Notes
+    -----
+    This function yields the atomic positions of the cubic structure in blocks of at most block_size atoms,
+    so that the peak memory does not depend on Nx, Ny and Nz. Concatenating the blocks gives the same
+    array returned by generate_cubic_structure. A block never spans two sublattices, so it can be shorter
+    than block_size.
+
+    Parameters
+    ----------
+    structure (str) : type of cubic structure (sc, bcc or fcc)
+    Nx (int) : number of repetitions of the structure to display the x axis
+    Ny (int) : number of repetitions of the structure to display the y axis
+    Nz (int) : number of repetitions of the structure to display the z axis
+    a (float) : lattice parameter
+    block_size (int) : maximum number of atoms per block
+    dtype (np.dtype) : floating point type of the blocks
+
+    Yields
+    ------
+    block (np.ndarray) : (n, 3) array with n <= block_size atomic positions
+    """
+    if block_size <= 0:
+        raise ValueError("Error: block_size must be greater than zero.")
+
+    for x, y, z in _cubic_sublattices(structure, Nx, Ny, Nz, a):
+        shape = (len(x), len(y), len(z))
+        count = shape[0] * shape[1] * shape[2]
+
+        for start in range(0, count, block_size):
+            # recover the (i, j, k) indices of the atoms in this block from their flat position
+            i, j, k = np.unravel_index(np.arange(start, min(start + block_size, count)), shape)
+
+            block = np.empty((len(i), 3), dtype=dtype)
+            block[:, 0] = x[i]
+            block[:, 1] = y[j]
+            block[:, 2] = z[k]
+            yield block
+
+
 # Create a 3D grid of atoms for the simple cubic structure
 def generate_simple_cubic(
                         Nx : int,
                         Ny : int,
-                        Nz : int
+                        Nz : int,
+                        a : float = 1.0,
+                        dtype : np.dtype = np.float64
 ) -> np.ndarray:
     """
     Notes
@@ -107,26 +303,24 @@ def generate_simple_cubic(
     Nx (int) : number of repetitions of the structure to display the x axis
     Ny (int) : number of repetitions of the structure to display the y axis
     Nz (int) : number of repetitions of the structure to display the z axis
+    a (float) : lattice parameter (1 gives the positions in units of the lattice parameter)
+    dtype (np.dtype) : floating point type of the returned array (e.g. np.float32 for very large slabs)
 
     Returns
     -------
     atomic_positions (np.ndarray) : 3-dim array cointaining the atomic positions
     """
 
-    atomic_positions = []
-    for i in range(Nx + 1):
-        for j in range(Ny + 1):
-            for k in range(Nz + 1):
-                atomic_positions.append([i * a, j * a, k * a])
-    atomic_positions = np.array(atomic_positions)
-    return atomic_positions
+    return _build_structure(_cubic_sublattices("sc", Nx, Ny, Nz, a), dtype)
 
 
 # Create a 3D grid of atoms for the body-centered cubic structure
 def generate_body_centered_cubic(
                                 Nx : int,
                                 Ny : int,
-                                Nz : int
+                                Nz : int,
+                                a : float = 1.0,
+                                dtype : np.dtype = np.float64
 ) -> np.ndarray:
     """
     Notes
@@ -138,31 +332,22 @@ def generate_body_centered_cubic(
     Nx (int) : number of repetitions of the structure to display the x axis
     Ny (int) : number of repetitions of the structure to display the y axis
     Nz (int) : number of repetitions of the structure to display the z axis
+    a (float) : lattice parameter (1 gives the positions in units of the lattice parameter)
+    dtype (np.dtype) : floating point type of the returned array (e.g. np.float32 for very large slabs)
+
     Returns
     -------
     atomic_positions (np.array) : 3-dim array cointaining the atomic positions
     """
-    
-    atomic_positions = []
-    for i in range(Nx + 1):
-        for j in range(Ny + 1):
-            for k in range(Nz + 1):
-                atomic_positions.append([i * a, j * a, k * a])
-                
-  
-    for i in range(Nx ):
-        for j in range(Ny):
-            for k in range(Nz):
-                # evaluation of the position of the central atom
-                atomic_positions.append( [(i+0.5) * a, (j+0.5) * a, (k+0.5) * a])
-    
-    return atomic_positions
+    return _build_structure(_cubic_sublattices("bcc", Nx, Ny, Nz, a), dtype)
 
 # Create a 3D grid of atoms for the face-centered cubic structure
 def generate_face_centered_cubic(
                                 Nx : int,
                                 Ny : int,
-                                Nz : int
+                                Nz : int,
+                                a : float = 1.0,
+                                dtype : np.dtype = np.float64
 ) -> np.ndarray:
     """
     Notes
@@ -174,38 +359,14 @@ def generate_face_centered_cubic(
     Nx (int) : number of repetitions of the structure to display the x axis
     Ny (int) : number of repetitions of the structure to display the y axis
     Nz (int) : number of repetitions of the structure to display the z axis
+    a (float) : lattice parameter (1 gives the positions in units of the lattice parameter)
+    dtype (np.dtype) : floating point type of the returned array (e.g. np.float32 for very large slabs)
 
     Returns
     -------
     atomic_positions (np.ndarray) : 3-dim array cointaining the atomic positions
     """
-    atomic_positions = []
-
-    # Evaluation of the atoms at the verteces
-    for i in range(Nx + 1):
-        for j in range(Ny + 1):                
-            for k in range(Nz + 1):
-                atomic_positions.append([i * a, j * a, k * a])
-
-    # Evaluation of the face centeres atoms along the x direction
-    for i in range(Nx + 1):
-        for j in range(Ny):
-            for k in range(Nz):
-                atomic_positions.append([i * a, j * a + a/2, k * a + a/2])
-
-    # Evaluation of the face centeres atoms along the y direction
-    for i in range(Nx):
-        for j in range(Ny + 1):
-            for k in range(Nz):
-                atomic_positions.append([i * a + a/2, j * a, k * a + a/2])
-
-    # Evaluation of the face centeres atoms along the z direction
-    for i in range(Nx):
-        for j in range(Ny):
-            for k in range(Nz + 1):
-                atomic_positions.append([i * a + a/2, j * a + a/2, k * a])
-    atomic_positions = np.array(atomic_positions)
-    return atomic_positions
+    return _build_structure(_cubic_sublattices("fcc", Nx, Ny, Nz, a), dtype)
 
 def generate_111_surface_sc(
                           Na : int,
@@ -297,6 +458,7 @@ def calculate_lattice_center(
     Notes
     -----
     Calculate the center of a surface lattice from a list of atomic positions.
+    A batch of structures with the same number of atoms can be given as a stacked (..., N, d) array.
 
     Parameters
     ----------
@@ -304,43 +466,315 @@ def calculate_lattice_center(
 
     Returns
     -------
-    center (np.ndarray): coordinates of the lattice center.
+    center (np.ndarray): coordinates of the lattice center, with shape (..., d).
     """
     # Calculate the average position of all atoms
-    center = np.mean(atomic_positions, axis=0)
+    center = np.mean(atomic_positions, axis=-2)
     return center
 
+def _rotation_matrix(
+                rotation,
+                dimension : int
+) -> np.ndarray:
+    """
+    Notes
+    -----
+    Return the matrix of a rotation given as a matrix or, in 2D, as an angle in degrees (counterclockwise)
+
+    Parameters
+    ----------
+    rotation (float or np.ndarray): angle in degrees (2D only) or (d, d) rotation matrix.
+    dimension (int): dimension of the space.
+
+    Returns
+    -------
+    matrix (np.ndarray): (d, d) rotation matrix.
+    """
+    if np.ndim(rotation) == 0:
+        if dimension != 2:
+            raise ValueError("Error: a rotation angle can only be given in 2D, use a rotation matrix in 3D.")
+        angle = np.radians(rotation)
+        return np.array([[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]])
+
+    matrix = np.asarray(rotation, dtype=np.float64)
+    if matrix.shape != (dimension, dimension):
+        raise ValueError(f"Error: the rotation matrix must have shape ({dimension}, {dimension}), got {matrix.shape}.")
+    return matrix
+
+def transform_coordinates(
+                        atomic_positions : np.ndarray,
+                        shift : np.ndarray = None,
+                        rotation = None,
+                        scale : float = 1.0,
+                        out : np.ndarray = None
+) -> np.ndarray:
+    """
+    Notes
+    -----
+    Apply x -> scale * R (x - shift) to atomic positions with array operations, without Python loops.
+    The result is written in out, which can be the input array itself (in-place transformation of a float64 array);
+    by default a new contiguous float64 array is allocated. A batch of structures can be given as a stacked
+    (..., N, d) array, with one shift per structure (..., d).
+
+    Parameters
+    ----------
+    atomic_positions (np.ndarray): (..., N, d) array of atomic positions.
+    shift (np.ndarray, optional): (..., d) translation subtracted from the positions (e.g. the lattice center).
+    rotation (float or np.ndarray, optional): angle in degrees (2D) or (d, d) rotation matrix.
+    scale (float, optional): scale factor (e.g. the surface lattice parameter to convert to Å).
+    out (np.ndarray, optional): float64 array with the shape of atomic_positions where the result is written.
+
+    Returns
+    -------
+    transformed_positions (np.ndarray): the transformed positions (out, if given).
+    """
+    positions = np.asarray(atomic_positions, dtype=np.float64)
+    if out is None:
+        out = np.empty(positions.shape)
+    elif out.shape != positions.shape or out.dtype != np.float64:
+        raise ValueError(f"Error: out must be a float64 array with shape {positions.shape}.")
+
+    if shift is None:
+        np.copyto(out, positions)
+    else:
+        np.subtract(positions, np.expand_dims(shift, -2), out=out)
+
+    if rotation is not None:
+        # row vectors: x R^T (numpy buffers the operands when out overlaps them)
+        np.matmul(out, _rotation_matrix(rotation, positions.shape[-1]).T, out=out)
+
+    if scale != 1.0:
+        np.multiply(out, scale, out=out)
+
+    return out
+
+@instrumented(counts=count_result_atoms)
 def shift_surface_coordinates(
                             atomic_positions : np.ndarray,
-                            dimension : int = 2
+                            dimension : int = 2,
+                            out : np.ndarray = None
 ) -> np.ndarray:
     """
     Notes
     -----
     Shift the surface atomic coordinates based on the (surface) lattice center.
+    A batch of structures can be given as a stacked (..., N, d) array: each one is shifted on its own center.
 
     Parameters
     ----------
     atomic_positions (np.ndarray): Atomic positions of the surface.
-    dimension (int): dimension of the space (either 2D or 3D)
+    dimension (int): dimension of the space (either 2D or 3D), only the first dimension coordinates are kept
+    out (np.ndarray, optional): float64 array where the shifted positions are written (it can be atomic_positions itself)
 
     Returns
     -------
-    shifted_positions (np.ndarray): Shifted atomic positions.
+    shifted_positions (np.ndarray): Shifted atomic positions, as a contiguous float64 (..., N, dimension) array.
     """
-    center = calculate_lattice_center(atomic_positions)
+    positions = np.asarray(atomic_positions, dtype=np.float64)[..., :dimension]
+    center = calculate_lattice_center(positions)
 
-    if dimension == 2:    
-        shifted_positions = [[pos[0] - center[0], pos[1] - center[1]] for pos in atomic_positions]
+    return transform_coordinates(positions, shift = center, out = out)
 
-    else:
-        shifted_positions = [[pos[0] - center[0], pos[1] - center[1], pos[2] - center[2]] for pos in atomic_positions]
+def surface_lattice_parameter(
+                            structure : str,
+                            plane,
+                            a : float
+) -> float:
+    """
+    Notes
+    -----
+    This function returns the in-plane lattice parameter of a surface (e.g. a/sqrt(2) for fcc(111)), the factor
+    converting the surface coordinates from lattice units to Å (see transform_coordinates)
+
+    Parameters
+    ----------
+    structure (str) : type of cubic structure (sc, bcc or fcc)
+    plane (str or tuple) : Miller indices of the surface
+    a (float) : lattice parameter of the conventional cubic cell in Å
+
+    Returns
+    -------
+    surface_a (float) : length of the first surface lattice vector in Å
+    """
+    return float(np.linalg.norm(surface_unit_cell(structure, plane, a)[0]))
+
+def build_coordinate_index(
+                        atomic_coordinates : np.ndarray,
+                        decimal_places : int = 3
+) -> dict:
+    """
+    Notes
+    -----
+    Build a spatial index of a set of atomic coordinates for the symmetry checks. The coordinates are
+    quantised on a grid with a spacing of a few times the comparison tolerance (half a unit of the last
+    decimal place) and the integer cell of every atom is stored as one sorted key, so that many points can
+    be looked up at once with np.searchsorted.
+
+    Parameters
+    ----------
+    atomic_coordinates (np.ndarray): Array containing atomic coordinates where each row is (x, y) or (x, y, z).
+    decimal_places (int) : Number of decimal places to consider for coordinates comparison.
+
+    Returns
+    -------
+    index (dict): Dictionary with the coordinates, the tolerance, the grid origin and span and the sorted keys.
+    """
+    coordinates = np.asarray(atomic_coordinates, dtype=np.float64)
+    tolerance = 0.5 * 10.0**(-decimal_places)
+    spacing = 16 * tolerance
+
+    cells = np.floor(coordinates / spacing).astype(np.int64)
+    # one extra cell on each side, so that the neighbours of every atom are inside the grid
+    origin = cells.min(axis=0) - 1
+    span = cells.max(axis=0) - origin + 2
+    if np.prod(span.astype(float)) >= 2.0**62:
+        raise ValueError("Error: the coordinates span too many cells for the requested decimal places.")
+
+    keys = _cell_keys(cells - origin, span)
+    order = np.argsort(keys)
+    keys = keys[order]
+
+    # largest number of atoms sharing a cell (1 unless atoms are closer than the grid spacing)
+    boundaries = np.flatnonzero(np.diff(keys)) + 1
+    max_per_cell = int(np.diff(np.concatenate(([0], boundaries, [len(keys)]))).max()) if len(keys) else 0
+
+    return {
+        "coordinates": coordinates[order],
+        "keys": keys,
+        "tolerance": tolerance,
+        "spacing": spacing,
+        "origin": origin,
+        "span": span,
+        "max_per_cell": max_per_cell,
+    }
+
+def _cell_keys(
+            cells : np.ndarray,
+            span : np.ndarray
+) -> np.ndarray:
+    """
+    Notes
+    -----
+    Combine the integer cell indices of each point in a single int64 key (row-major order on the grid)
+
+    Parameters
+    ----------
+    cells (np.ndarray): Array of cell indices relative to the grid origin, one row per point.
+    span (np.ndarray): Number of cells of the grid along each axis.
+
+    Returns
+    -------
+    keys (np.ndarray): Array with one key per point.
+    """
+    keys = cells[:, 0].copy()
+    for axis in range(1, cells.shape[1]):
+        keys *= span[axis]
+        keys += cells[:, axis]
+    return keys
+
+def contains_coordinates(
+                    index : dict,
+                    points : np.ndarray
+) -> np.ndarray:
+    """
+    Notes
+    -----
+    Check, for every point, whether an atom of the index lies within the tolerance from it.
+    All the points are looked up together. Since the grid spacing is larger than twice the tolerance, a
+    matching atom can only be in the cell of the point or, for the points closer than the tolerance to a
+    cell face, in the next cell across that face. Only those few points are searched again in the
+    neighbouring cells, so that the result does not depend on where the rounding boundaries fall.
+
+    Parameters
+    ----------
+    index (dict): Spatial index returned by build_coordinate_index.
+    points (np.ndarray): Array of points to look up, with the same dimension as the indexed coordinates.
+
+    Returns
+    -------
+    found (np.ndarray): Boolean array with one value per point.
+    """
+    points = np.asarray(points, dtype=np.float64)
+    found = np.zeros(len(points), dtype=bool)
+    if len(index["keys"]) == 0 or len(points) == 0:
+        return found
+
+    scaled = points / index["spacing"]
+    cells = np.floor(scaled).astype(np.int64) - index["origin"]
+    fraction = scaled - np.floor(scaled)
+    margin = index["tolerance"] / index["spacing"]
+    # -1 or +1 along the axes where the point is closer than the tolerance to a cell face, 0 elsewhere
+    sides = np.where(fraction < margin, -1, np.where(fraction > 1 - margin, 1, 0))
+
+    for offset in itertools.product((0, 1), repeat=points.shape[1]):
+        needs_offset = np.all(sides[:, np.array(offset, dtype=bool)] != 0, axis=1) if any(offset) else True
+        remaining = np.flatnonzero(~found & needs_offset)
+        neighbour_cells = cells[remaining] + sides[remaining] * offset
+
+        inside = np.ones(len(remaining), dtype=bool)
+        for axis in range(points.shape[1]):
+            inside &= (neighbour_cells[:, axis] >= 0) & (neighbour_cells[:, axis] < index["span"][axis])
+        remaining, neighbour_cells = remaining[inside], neighbour_cells[inside]
+
+        keys = _cell_keys(neighbour_cells, index["span"])
+        # searching the keys in sorted order is much faster than in random order
+        order = np.argsort(keys)
+        first = np.empty_like(keys)
+        first[order] = np.searchsorted(index["keys"], keys[order])
+
+        # compare the point with every atom of the cell
+        for shift in range(index["max_per_cell"]):
+            position = np.minimum(first + shift, len(index["keys"]) - 1)
+            match = (index["keys"][position] == keys) & ~found[remaining]
+            candidate = index["coordinates"][position]
+            for axis in range(points.shape[1]):
+                match &= np.abs(candidate[:, axis] - points[remaining, axis]) <= index["tolerance"]
+
+            found[remaining[match]] = True
+
+    return found
+
+def _all_images_found(
+                    index : dict,
+                    coordinates : np.ndarray,
+                    transformations : list,
+                    block_size : int = 65536
+) -> bool:
+    """
+    Notes
+    -----
+    Check that every atom has an image, under at least one of the transformations, among the indexed atoms.
+    The atoms are processed in blocks and the check stops at the first block with an atom without images.
+
+    Parameters
+    ----------
+    index (dict): Spatial index returned by build_coordinate_index.
+    coordinates (np.ndarray): Array containing the atomic coordinates to be transformed.
+    transformations (list): Functions mapping an array of coordinates to the array of their images.
+    block_size (int): Number of atoms checked at once.
+
+    Returns
+    -------
+    has_symmetry (bool): True if all the atoms have an image, False otherwise.
+    """
+    for start in range(0, len(coordinates), block_size):
+        block = coordinates[start:start + block_size]
+
+        # look for the next image only where the previous ones are missing
+        has_image = contains_coordinates(index, transformations[0](block))
+        for transformation in transformations[1:]:
+            missing = np.flatnonzero(~has_image)
+            has_image[missing] = contains_coordinates(index, transformation(block[missing]))
+
+        if not np.all(has_image):
+            return False
 
-    return shifted_positions
+    return True
 
 def check_mirror_plane_symmetry(
                             atomic_coordinates : np.ndarray,
-                            decimal_places : int = 3
+                            decimal_places : int = 3,
+                            index : dict = None
 ) -> bool:
     """
     Notes
@@ -351,33 +785,23 @@ def check_mirror_plane_symmetry(
     ----------
     atomic_coordinates (np.ndarray): Array containing atomic coordinates where each row is (x, y).
     decimal_places (int) : Number of decimal places to consider for coordinates comparison.
+    index (dict, optional): Spatial index of the coordinates (from build_coordinate_index), to share it between checks.
 
     Returns
     -------
     has_symmetry (bool): True if mirror plane symmetry is detected, False otherwise.
     """
-    # Convert the atomic coordinates to a set for efficient searching
-    coordinates_set = set(tuple(np.round(coord, decimal_places)) for coord in atomic_coordinates)
+    coordinates = np.asarray(atomic_coordinates, dtype=np.float64)
+    if index is None:
+        index = build_coordinate_index(coordinates, decimal_places)
 
     # Check each atom for mirror image existence
-    for atom in atomic_coordinates:
-        x, y = atom
-        mirror_atom_x = (-x, y)
-        mirror_atom_y = (x, -y)
-        mirror_atom_xy = (-x, -y)
-
-        if (
-            tuple(np.round(mirror_atom_x, decimal_places)) not in coordinates_set and
-            tuple(np.round(mirror_atom_y, decimal_places)) not in coordinates_set and
-            tuple(np.round(mirror_atom_xy, decimal_places)) not in coordinates_set
-        ):
-            return False
-
-    return True
+    return _all_images_found(index, coordinates, [lambda r: r * [-1, 1], lambda r: r * [1, -1], lambda r: -r])
 
 def check_2fold_rotation_axis(
                             atomic_coordinates : np.ndarray,
-                            decimal_places : int = 3
+                            decimal_places : int = 3,
+                            index : dict = None
 ) -> bool:
     """
     Notes
@@ -388,28 +812,24 @@ def check_2fold_rotation_axis(
     ----------
     atomic_coordinates (np.ndarray): Array containing atomic coordinates where each row is (x, y).
     decimal_places (int): Number of decimal places to consider for coordinates comparison.
+    index (dict, optional): Spatial index of the coordinates (from build_coordinate_index), to share it between checks.
 
     Returns
     -------
     has_symmetry (bool): True if a 2-fold rotation axis symmetry is detected, False otherwise.
     """
-    # Convert the atomic coordinates to a set for efficient searching
-    coordinates_set = set(tuple(np.round(coord, decimal_places)) for coord in atomic_coordinates)
+    coordinates = np.asarray(atomic_coordinates, dtype=np.float64)
+    if index is None:
+        index = build_coordinate_index(coordinates, decimal_places)
 
     # Check each atom for a 2-fold rotation image existence
-    for atom in atomic_coordinates:
-        x, y = atom
-        rotation_atom = (-x, -y)
-
-        if tuple(np.round(rotation_atom, decimal_places)) not in coordinates_set:
-            return False
-
-    return True
+    return _all_images_found(index, coordinates, [lambda r: -r])
 
 
 def check_centered_unit_cell_symmetry(
                                     atomic_coordinates : np.ndarray, 
-                                    decimal_places : int = 3
+                                    decimal_places : int = 3,
+                                    index : dict = None
 ) -> bool:
     """
     Notes
@@ -420,103 +840,703 @@ def check_centered_unit_cell_symmetry(
     ----------
     atomic_coordinates (np.ndarray): Array containing atomic coordinates where each row is (x, y).
     decimal_places (int): Number of decimal places to consider for coordinates comparison.
+    index (dict, optional): Spatial index of the coordinates (from build_coordinate_index), to share it between checks.
 
     Returns
     -------
     has_symmetry (bool): True if centered unit cell symmetry is detected, False otherwise.
     """
-    # Convert the atomic coordinates to a set for efficient searching
-    coordinates_set = set(tuple(np.round(coord, decimal_places)) for coord in atomic_coordinates)
+    coordinates = np.asarray(atomic_coordinates, dtype=np.float64)
+    if index is None:
+        index = build_coordinate_index(coordinates, decimal_places)
 
     # Check each atom for the existence of a centered unit cell image
-    for atom in atomic_coordinates:
-        x, y = atom
-        centered_atom = (x + 0.5, y + 0.5)      
-
-        if tuple(np.round(centered_atom, decimal_places)) not in coordinates_set:
-            return False
-
-    return True
+    return _all_images_found(index, coordinates, [lambda r: r + 0.5])
 
-def check_glide_plane_symmetry(
-                            atomic_coordinates : np.ndarray, 
-                            decimal_places : int = 3
-) -> bool:
+def surface_lattice_vectors(
+                        structure : str,
+                        plane : str
+) -> np.ndarray:
     """
     Notes
     -----
-    Check for ca glide plane symmetry in a set of atomic coordinates.
+    This function returns the lattice vectors of the surface nets built by generate_surface_structure,
+    in the same units as the generated positions
 
     Parameters
     ----------
-    atomic_coordinates (np.ndarray): Array containing atomic coordinates where each row is (x, y).
-    decimal_places (int): Number of decimal places to consider for coordinates comparison.
+    structure (str) : type of cubic structure (sc, bcc or fcc)
+    plane (str) : surface selected to be visualised
 
     Returns
     -------
-    has_symmetry (bool): True if glide plane symmetry is detected, False otherwise.
+    lattice_vectors (np.ndarray) : (2, 2) array whose rows are the lattice vectors a and b
     """
-    pass
+    if structure == "sc" and plane == '111':
+        return np.array([[1.0, 0.0], [0.0, 1.0]])
+    elif structure == "fcc" and plane == '111':
+        angle = np.pi/3   # 60°
+        return np.array([[1.0, 0.0], [np.cos(angle), np.sin(angle)]])
+    else:
+        raise ValueError("Invalid cubic_structure specified in config.ini")
 
-def get_symmetry_properties(
-                        atomic_coordinates : np.ndarray, 
-                        decimal_places : int = 3
-) -> dict:
+def _periodic_basis(
+                atomic_coordinates : np.ndarray,
+                lattice_vectors : np.ndarray,
+                decimal_places : int
+) -> np.ndarray:
     """
     Notes
     -----
-    Check for various symmetry properties in a set of atomic coordinates and return the detected symmetries.
+    Reduce a set of atomic coordinates to the distinct fractional positions inside one unit cell
 
     Parameters
     ----------
     atomic_coordinates (np.ndarray): Array containing atomic coordinates where each row is (x, y).
+    lattice_vectors (np.ndarray): (2, 2) array whose rows are the lattice vectors.
     decimal_places (int): Number of decimal places to consider for coordinates comparison.
 
     Returns
     -------
-    symmetry_properties (dict): A dictionary containing detected symmetries (mirror_plane, rotation_axis, centered_unit_cell, glide_plane).
+    basis (np.ndarray): (n, 2) array with the fractional coordinates of the atoms of the cell, in [0, 1)
+                        up to the tolerance (the values are not rounded, to avoid accumulating errors).
     """
+    fractional = np.asarray(atomic_coordinates, dtype=np.float64) @ np.linalg.inv(lattice_vectors)
+    fractional = fractional - np.floor(np.round(fractional, decimal_places))
+    _, first = np.unique(np.round(fractional, decimal_places) % 1.0, axis=0, return_index=True)
+    return fractional[np.sort(first)]
 
-    # dictionary containing the information regarding the symmetry properties of the surface structure
-
-    symmetry_properties = {
-        "mirror_plane": False,
-        "rotation_axis": False,
-        "centered_unit_cell": False,
-        "glide_plane": None,
-    }
-    
-    symmetry_properties["mirror_plane"] = check_mirror_plane_symmetry(atomic_coordinates, decimal_places)
-    symmetry_properties["rotation_axis"] = check_2fold_rotation_axis(atomic_coordinates, decimal_places)
-    symmetry_properties["centered_unit_cell"] = check_centered_unit_cell_symmetry(atomic_coordinates, decimal_places)
-
-    # TD add evaluation of the glide_plane
-
-    return symmetry_properties
-
-def generate_surface_reciprocal_lattice_parameter(
-                                        plane : str,
-                                        a : float,
-                                        b : float,
-) -> [float, float]:
+def _integer_lattice_basis(rows : list) -> np.ndarray:
     """
     Notes
     -----
-    This function evaluates the recirpocal lattice parameters
+    Return a basis (upper triangular) of the 2D integer lattice generated by a list of integer vectors
 
     Parameters
     ----------
-    plane (str) : surface selected for the diffraction pattern
-    a (float) : lattice parameter in the real space
-    b (float) : lattice parameter in the real space
-    c (float) : lattice parameter in the real space
+    rows (list): Integer vectors generating a full rank lattice.
 
     Returns
     -------
-    reciprocal_a (float) : lattice parameter in the reciprocal space
-    reciprocal_b (float) : lattice parameter in the reciprocal space
+    basis (np.ndarray): (2, 2) integer array whose rows are a basis of the lattice.
     """
-
+    rows = [[int(x), int(y)] for x, y in rows]
+
+    # Euclid's algorithm on the first column: in the end a single row has a nonzero first entry
+    while True:
+        nonzero = sorted([row for row in rows if row[0] != 0], key=lambda row: abs(row[0]))
+        if len(nonzero) <= 1:
+            break
+        pivot = nonzero[0]
+        for row in nonzero[1:]:
+            quotient = row[0] // pivot[0]
+            row[0] -= quotient * pivot[0]
+            row[1] -= quotient * pivot[1]
+
+    first = next(row for row in rows if row[0] != 0)
+    second = int(np.gcd.reduce([abs(row[1]) for row in rows if row[0] == 0]))
+    return np.array([first, [0, second]])
+
+def _reduce_lattice(
+                cell : np.ndarray,
+                lattice_vectors : np.ndarray
+) -> np.ndarray:
+    """
+    Notes
+    -----
+    Lagrange-Gauss reduction of a 2D lattice: returns the cell whose lattice vectors are the two shortest
+    independent vectors of the lattice
+
+    Parameters
+    ----------
+    cell (np.ndarray): (2, 2) array whose rows are the cell vectors in fractional coordinates of lattice_vectors.
+    lattice_vectors (np.ndarray): (2, 2) array whose rows are the lattice vectors.
+
+    Returns
+    -------
+    reduced_cell (np.ndarray): (2, 2) array with the reduced cell vectors in fractional coordinates of lattice_vectors.
+    """
+    first, second = np.array(cell, dtype=np.float64)
+    metric = lattice_vectors @ lattice_vectors.T
+
+    def norm2(v):
+        return v @ metric @ v
+
+    while True:
+        if norm2(second) < norm2(first):
+            first, second = second, first
+        # reduced when the projection of the second vector on the first is at most half of it
+        ratio = (first @ metric @ second) / norm2(first)
+        if abs(ratio) <= 0.5 + 1e-9:
+            return np.array([first, second])
+        second = second - np.round(ratio) * first
+
+def _primitive_cell(
+                basis : np.ndarray,
+                translations : list,
+                lattice_vectors : np.ndarray
+) -> np.ndarray:
+    """
+    Notes
+    -----
+    Return the reduced primitive cell of the lattice generated by the unit cell and by the extra
+    (centring) translations that leave the structure invariant
+
+    Parameters
+    ----------
+    basis (np.ndarray): Fractional coordinates of the atoms of the cell.
+    translations (list): Fractional translations leaving the structure invariant.
+    lattice_vectors (np.ndarray): (2, 2) array whose rows are the lattice vectors.
+
+    Returns
+    -------
+    cell (np.ndarray): (2, 2) array whose rows are the primitive cell vectors in fractional coordinates.
+    """
+    cell = np.eye(2)
+    if translations:
+        # common denominator of the centring translations, to work on an integer lattice
+        denominator = next(d for d in range(1, 1 + max(len(basis), 1))
+                           if all(np.allclose(d * t, np.round(d * t), atol=1e-3) for t in translations))
+        rows = [[denominator, 0], [0, denominator]] + [np.round(denominator * t) for t in translations]
+        cell = _integer_lattice_basis(rows) / denominator
+
+    return _reduce_lattice(cell, lattice_vectors)
+
+def _lattice_point_operations(lattice_vectors : np.ndarray) -> list:
+    """
+    Notes
+    -----
+    Return the point operations of a reduced 2D lattice, as integer matrices A acting on fractional row
+    vectors (f -> f A) and preserving the metric of the lattice
+
+    Parameters
+    ----------
+    lattice_vectors (np.ndarray): (2, 2) array whose rows are the reduced lattice vectors.
+
+    Returns
+    -------
+    operations (list): List of (2, 2) integer arrays.
+    """
+    metric = lattice_vectors @ lattice_vectors.T
+    operations = []
+    for entries in itertools.product((-1, 0, 1), repeat=4):
+        A = np.array(entries).reshape(2, 2)
+        if abs(round(np.linalg.det(A))) == 1 and np.allclose(A @ metric @ A.T, metric, rtol=1e-6, atol=1e-6 * np.abs(metric).max()):
+            operations.append(A)
+    return operations
+
+def _operation_translations(
+                        basis : np.ndarray,
+                        transformed_basis : np.ndarray,
+                        index : dict,
+                        sample_size : int = 8
+) -> list:
+    """
+    Notes
+    -----
+    Find the translations t for which basis A + t coincides with the basis modulo the lattice.
+    The candidates map the first transformed atom onto every atom of the basis; they are all checked on a
+    small sample of atoms in one batched lookup, and only the surviving ones on the whole basis.
+
+    Parameters
+    ----------
+    basis (np.ndarray): Fractional coordinates of the atoms of the cell.
+    transformed_basis (np.ndarray): The basis transformed by the point operation (computed once per operation).
+    index (dict): Spatial index of the basis and of its periodic images (from build_coordinate_index).
+    sample_size (int): Number of atoms used to filter the candidate translations.
+
+    Returns
+    -------
+    translations (list): Fractional translations (in [0, 1)) completing the point operation.
+    """
+    candidates = (basis - transformed_basis[0]) % 1.0
+
+    for atoms in (transformed_basis[:sample_size], transformed_basis):
+        images = (atoms[None, :, :] + candidates[:, None, :]) % 1.0
+        found = contains_coordinates(index, images.reshape(-1, 2)).reshape(len(candidates), len(atoms))
+        candidates = candidates[np.all(found, axis=1)]
+
+    return list(candidates)
+
+def find_symmetry_operations(
+                        atomic_coordinates : np.ndarray,
+                        lattice_vectors : np.ndarray,
+                        decimal_places : int = 3
+) -> list:
+    """
+    Notes
+    -----
+    Find the symmetry operations (point operation + translation) of a periodic 2D structure.
+    The coordinates are reduced to the atoms of one unit cell, the cell is reduced to the primitive cell
+    (detecting the centring translations) and every point operation of the lattice is tested: the
+    transformed basis is computed once per point operation and shared by all its candidate translations.
+    The operations are returned in fractional coordinates of the given lattice vectors, together with
+    every centring translation, as needed to find the systematic absences.
+
+    Parameters
+    ----------
+    atomic_coordinates (np.ndarray): Array containing atomic coordinates where each row is (x, y),
+                                     e.g. the output of shift_surface_coordinates.
+    lattice_vectors (np.ndarray): (2, 2) array whose rows are the lattice vectors of the structure.
+    decimal_places (int): Number of decimal places to consider for coordinates comparison.
+
+    Returns
+    -------
+    symmetry_operations (list): List of (A, t) pairs mapping the fractional row vector f to f A + t.
+    primitive_operations (list): The same operations expressed in the reduced primitive cell.
+    primitive_cell (np.ndarray): (2, 2) array whose rows are the primitive cell vectors in fractional coordinates.
+    """
+    lattice_vectors = np.asarray(lattice_vectors, dtype=np.float64)
+    basis = _periodic_basis(atomic_coordinates, lattice_vectors, decimal_places)
+
+    def periodic_index(cell_basis):
+        # the basis with its 8 neighbouring images, so that the lookups work across the cell borders
+        shifts = np.array(list(itertools.product((-1, 0, 1), repeat=2)))
+        return build_coordinate_index((cell_basis[None, :, :] + shifts[:, None, :]).reshape(-1, 2), decimal_places)
+
+    # centring translations of the given cell
+    centring = [t for t in _operation_translations(basis, basis, periodic_index(basis)) if np.any(np.abs(t - np.round(t)) > 1e-6)]
+    primitive_cell = _primitive_cell(basis, centring, lattice_vectors)
+
+    # basis and lattice of the reduced primitive cell
+    primitive_lattice = primitive_cell @ lattice_vectors
+    primitive_basis = _periodic_basis(atomic_coordinates, primitive_lattice, decimal_places)
+    index = periodic_index(primitive_basis)
+
+    primitive_operations = []
+    for A in _lattice_point_operations(primitive_lattice):
+        for t in _operation_translations(primitive_basis, primitive_basis @ A, index):
+            primitive_operations.append((A, t))
+
+    # back to the given cell: f = f' P, so A = P^-1 A' P and t = t' P, repeated for every centring translation
+    inverse_cell = np.linalg.inv(primitive_cell)
+    # the centring translations are the cosets of the given lattice in the primitive one: the rows of the integer
+    # matrix P^-1 span the given lattice in the primitive cell, and its triangular basis diag(a, d) lists a * d cosets
+    diagonal = np.diag(_integer_lattice_basis(np.round(inverse_cell)))
+    cosets = np.stack(np.meshgrid(np.arange(abs(diagonal[0])), np.arange(abs(diagonal[1])), indexing='ij'), axis=-1).reshape(-1, 2)
+    centring_translations = np.unique(np.round((cosets @ primitive_cell) % 1.0, 6) % 1.0, axis=0)
+    symmetry_operations = [(np.round(inverse_cell @ A @ primitive_cell, 6), (t @ primitive_cell + c) % 1.0)
+                           for A, t in primitive_operations for c in centring_translations]
+
+    return symmetry_operations, primitive_operations, primitive_cell
+
+def _reflection_kind(
+                A : np.ndarray,
+                translations : list
+) -> [bool, bool, bool]:
+    """
+    Notes
+    -----
+    Classify the reflections with point operation A (det A = -1) of a primitive cell
+
+    Parameters
+    ----------
+    A (np.ndarray): (2, 2) integer reflection matrix acting on fractional row vectors.
+    translations (list): Translations t found for A.
+
+    Returns
+    -------
+    has_mirror (bool): True if a mirror line (no intrinsic translation) exists.
+    has_glide (bool): True if a glide line exists.
+    is_centred (bool): True if the lattice is centred with respect to the reflection (cm-type).
+    """
+    def primitive_solution(M):
+        # primitive integer row vector v with v M = 0 for the rank 1 matrix M
+        column = M[:, 0] if np.any(M[:, 0]) else M[:, 1]
+        v = np.array([column[1], -column[0]])
+        return v // np.gcd.reduce(np.abs(v))
+
+    identity = np.eye(2, dtype=int)
+    fixed = primitive_solution(A.astype(int) - identity)
+    reversed_ = primitive_solution(A.astype(int) + identity)
+    is_centred = abs(round(np.linalg.det(np.array([fixed, reversed_])))) == 2
+
+    has_mirror = has_glide = False
+    for t in translations:
+        # the square of the operation is the translation m; moving t by a lattice vector n adds n (A + I)
+        m = t @ A + t
+        for n in itertools.product(range(-2, 3), repeat=2):
+            intrinsic = (m + np.array(n) @ (A + identity)) / 2
+            if np.allclose(intrinsic, np.round(intrinsic), atol=1e-6):
+                has_mirror = True
+            else:
+                has_glide = True
+
+    return has_mirror, has_glide, is_centred
+
+def detect_plane_group(
+                    atomic_coordinates : np.ndarray,
+                    lattice_vectors : np.ndarray,
+                    decimal_places : int = 3
+) -> dict:
+    """
+    Notes
+    -----
+    Detect the plane (wallpaper) group of a periodic 2D structure among the 17 plane groups.
+
+    Parameters
+    ----------
+    atomic_coordinates (np.ndarray): Array containing atomic coordinates where each row is (x, y),
+                                     e.g. the output of shift_surface_coordinates.
+    lattice_vectors (np.ndarray): (2, 2) array whose rows are the lattice vectors of the structure.
+    decimal_places (int): Number of decimal places to consider for coordinates comparison.
+
+    Returns
+    -------
+    plane_group (dict): A dictionary containing the plane group symbol (plane_group), the highest rotation
+                        order (rotation_order), the presence of mirror and glide lines (mirror_plane,
+                        glide_plane), the presence of centring translations in the given cell
+                        (centered_unit_cell) and the symmetry operations in fractional coordinates of
+                        the given cell (symmetry_operations).
+    """
+    symmetry_operations, primitive_operations, primitive_cell = find_symmetry_operations(atomic_coordinates, lattice_vectors, decimal_places)
+
+    # rotation order from the trace of the proper point operations
+    order_from_trace = {2: 1, -2: 2, 1: 6, 0: 4, -1: 3}
+    rotation_order = max(order_from_trace[int(round(np.trace(A)))] for A, t in primitive_operations if round(np.linalg.det(A)) == 1)
+
+    reflections = {}
+    for A, t in primitive_operations:
+        if round(np.linalg.det(A)) == -1:
+            reflections.setdefault(A.tobytes(), (A, []))[1].append(t)
+    kinds = [_reflection_kind(A, translations) for A, translations in reflections.values()]
+
+    has_mirror = any(kind[0] for kind in kinds)
+    has_glide = any(kind[1] for kind in kinds)
+    is_centred = any(kind[2] for kind in kinds)
+
+    if not reflections:
+        plane_group = {1: 'p1', 2: 'p2', 3: 'p3', 4: 'p4', 6: 'p6'}[rotation_order]
+    elif rotation_order == 1:
+        plane_group = 'cm' if is_centred else ('pm' if has_mirror else 'pg')
+    elif rotation_order == 2:
+        if is_centred:
+            plane_group = 'cmm'
+        else:
+            plane_group = {2: 'pmm', 1: 'pmg', 0: 'pgg'}[sum(kind[0] for kind in kinds)]
+    elif rotation_order == 4:
+        plane_group = 'p4m' if all(kind[0] for kind in kinds) else 'p4g'
+    elif rotation_order == 3:
+        # in p31m the mirror lines contain the shortest lattice vectors, in p3m1 they are perpendicular to them
+        shortest = [np.array([1, 0]), np.array([0, 1]), np.array([1, 1]), np.array([1, -1])]
+        metric = (primitive_cell @ lattice_vectors) @ (primitive_cell @ lattice_vectors).T
+        length = min(v @ metric @ v for v in shortest)
+        shortest = [v for v in shortest if np.isclose(v @ metric @ v, length)]
+        contains_shortest = any(np.array_equal(v @ A, v) for A, _ in reflections.values() for v in shortest)
+        plane_group = 'p31m' if contains_shortest else 'p3m1'
+    else:
+        plane_group = 'p6m'
+
+    return {
+        "plane_group": plane_group,
+        "rotation_order": rotation_order,
+        "mirror_plane": has_mirror,
+        "glide_plane": has_glide,
+        "centered_unit_cell": abs(np.linalg.det(primitive_cell)) < 1 - 1e-6,
+        "symmetry_operations": symmetry_operations,
+    }
+
+def find_systematic_absences(
+                        h : np.ndarray,
+                        k : np.ndarray,
+                        symmetry_operations : list,
+                        tolerance : float = 1e-6
+) -> np.ndarray:
+    """
+    Notes
+    -----
+    Find the reflections (h, k) whose structure factor vanishes by symmetry: a reflection is extinct if an
+    operation (A, t) leaves it invariant (A h = h) while giving it a phase exp(2*pi*i h.t) different from 1
+    (centring translations and glide lines). The extinction rules only hold for integer reflections, the points
+    of a fractional (h, k) grid are never flagged.
+
+    Parameters
+    ----------
+    h (np.ndarray): h indices (any shape, broadcast against k), referred to the cell of the operations.
+    k (np.ndarray): k indices.
+    symmetry_operations (list): List of (A, t) pairs, as returned by find_symmetry_operations or detect_plane_group.
+    tolerance (float): Tolerance on the invariance and on the phase.
+
+    Returns
+    -------
+    absent (np.ndarray): Boolean array with the broadcast shape of h and k, True for the extinct reflections.
+    """
+    h, k = np.broadcast_arrays(np.asarray(h, dtype=np.float64), np.asarray(k, dtype=np.float64))
+    absent = np.zeros(h.shape, dtype=bool)
+    integer = (np.abs(h - np.round(h)) < tolerance) & (np.abs(k - np.round(k)) < tolerance)
+
+    for A, t in symmetry_operations:
+        if np.allclose(t, np.round(t), atol=tolerance):
+            continue
+        # A acting on the column vector (h, k)
+        invariant = (np.abs(A[0, 0] * h + A[0, 1] * k - h) < tolerance) & (np.abs(A[1, 0] * h + A[1, 1] * k - k) < tolerance)
+        phase = t[0] * h + t[1] * k
+        absent |= integer & invariant & (np.abs(phase - np.round(phase)) > tolerance)
+
+    return absent
+
+def check_glide_plane_symmetry(
+                            atomic_coordinates : np.ndarray, 
+                            decimal_places : int = 3,
+                            lattice_vectors : np.ndarray = None
+) -> bool:
+    """
+    Notes
+    -----
+    Check for glide plane symmetry in a set of atomic coordinates. A glide combines a mirror with a
+    translation by a fraction of a lattice vector, so the lattice of the structure is needed.
+
+    Parameters
+    ----------
+    atomic_coordinates (np.ndarray): Array containing atomic coordinates where each row is (x, y).
+    decimal_places (int): Number of decimal places to consider for coordinates comparison.
+    lattice_vectors (np.ndarray): (2, 2) array whose rows are the lattice vectors of the structure.
+
+    Returns
+    -------
+    has_symmetry (bool): True if glide plane symmetry is detected, False otherwise.
+    """
+    if lattice_vectors is None:
+        raise ValueError("Error: the lattice vectors are needed to check the glide plane symmetry.")
+
+    return detect_plane_group(atomic_coordinates, lattice_vectors, decimal_places)["glide_plane"]
+
+@instrumented(counts=count_input_atoms)
+def get_symmetry_properties(
+                        atomic_coordinates : np.ndarray, 
+                        decimal_places : int = 3,
+                        lattice_vectors : np.ndarray = None
+) -> dict:
+    """
+    Notes
+    -----
+    Check for various symmetry properties in a set of atomic coordinates and return the detected symmetries.
+    When the lattice vectors are given, the plane group is detected as well (see detect_plane_group).
+
+    Parameters
+    ----------
+    atomic_coordinates (np.ndarray): Array containing atomic coordinates where each row is (x, y).
+    decimal_places (int): Number of decimal places to consider for coordinates comparison.
+    lattice_vectors (np.ndarray, optional): (2, 2) array whose rows are the lattice vectors of the structure.
+
+    Returns
+    -------
+    symmetry_properties (dict): A dictionary containing detected symmetries (mirror_plane, rotation_axis, centered_unit_cell,
+                                glide_plane) and, with the lattice vectors, plane_group and symmetry_operations.
+    """
+
+    # dictionary containing the information regarding the symmetry properties of the surface structure
+
+    symmetry_properties = {
+        "mirror_plane": False,
+        "rotation_axis": False,
+        "centered_unit_cell": False,
+        "glide_plane": None,
+        "plane_group": None,
+        "symmetry_operations": None,
+    }
+    
+    # the spatial index is built once and shared by all the checks
+    index = build_coordinate_index(atomic_coordinates, decimal_places)
+
+    symmetry_properties["mirror_plane"] = check_mirror_plane_symmetry(atomic_coordinates, decimal_places, index)
+    symmetry_properties["rotation_axis"] = check_2fold_rotation_axis(atomic_coordinates, decimal_places, index)
+    symmetry_properties["centered_unit_cell"] = check_centered_unit_cell_symmetry(atomic_coordinates, decimal_places, index)
+
+    if lattice_vectors is not None:
+        plane_group = detect_plane_group(atomic_coordinates, lattice_vectors, decimal_places)
+        for key in ("glide_plane", "plane_group", "symmetry_operations"):
+            symmetry_properties[key] = plane_group[key]
+
+    return symmetry_properties
+
+def bravais_lattice_vectors(
+                        structure : str,
+                        a : float = 1.0
+) -> np.ndarray:
+    """
+    Notes
+    -----
+    This function returns the primitive lattice vectors of a cubic Bravais lattice
+
+    Parameters
+    ----------
+    structure (str) : type of cubic structure (sc, bcc or fcc)
+    a (float) : lattice parameter of the conventional cubic cell
+
+    Returns
+    -------
+    lattice_vectors (np.ndarray) : (3, 3) array whose rows are the primitive lattice vectors
+    """
+    if structure == "sc":
+        return a * np.eye(3)
+    elif structure == "bcc":
+        return a/2 * np.array([[-1.0, 1.0, 1.0], [1.0, -1.0, 1.0], [1.0, 1.0, -1.0]])
+    elif structure == "fcc":
+        return a/2 * np.array([[0.0, 1.0, 1.0], [1.0, 0.0, 1.0], [1.0, 1.0, 0.0]])
+    else:
+        raise ValueError("Invalid cubic_structure specified in config.ini")
+
+def _miller_indices(plane) -> np.ndarray:
+    """
+    Notes
+    -----
+    Convert a plane given as a string of digits ('111', '001') or as a sequence of integers ((2, -1, 0))
+    into an array of Miller indices
+
+    Parameters
+    ----------
+    plane (str or tuple) : Miller indices of the surface
+
+    Returns
+    -------
+    miller (np.ndarray) : integer array (h, k, l)
+    """
+    miller = np.array([int(index) for index in plane] if isinstance(plane, str) else plane, dtype=np.int64)
+    if miller.shape != (3,) or not miller.any():
+        raise ValueError(f"Error: invalid Miller indices {plane}.")
+    return miller
+
+def _integer_kernel(vector : np.ndarray) -> np.ndarray:
+    """
+    Notes
+    -----
+    Return a basis of the integer vectors orthogonal to a nonzero integer 3D vector c, by reducing c to
+    (g, 0, 0) with unimodular column operations (Euclid's algorithm)
+
+    Parameters
+    ----------
+    vector (np.ndarray) : integer vector c
+
+    Returns
+    -------
+    kernel (np.ndarray) : (2, 3) integer array whose rows u satisfy u . c = 0 and generate all of them
+    """
+    c = [int(x) for x in vector]
+    U = np.eye(3, dtype=np.int64)
+
+    while sum(x != 0 for x in c) > 1:
+        nonzero = sorted((i for i in range(3) if c[i] != 0), key=lambda i: abs(c[i]))
+        pivot = nonzero[0]
+        for i in nonzero[1:]:
+            quotient = c[i] // c[pivot]
+            c[i] -= quotient * c[pivot]
+            U[:, i] -= quotient * U[:, pivot]
+
+    pivot = next(i for i in range(3) if c[i] != 0)
+    return U[:, [i for i in range(3) if i != pivot]].T
+
+def surface_unit_cell(
+                    structure : str,
+                    plane,
+                    a : float = 1.0
+) -> np.ndarray:
+    """
+    Notes
+    -----
+    This function derives the 2D unit cell of any (hkl) surface of a cubic Bravais lattice: the lattice vectors
+    lying in the plane are the integer combinations u of the primitive vectors with u . (P n) = 0, which are
+    found exactly with integer column operations and then reduced to the two shortest vectors.
+    The cell is expressed in the plane, with a along x and the normal pointing out of the page.
+
+    Parameters
+    ----------
+    structure (str) : type of cubic structure (sc, bcc or fcc)
+    plane (str or tuple) : Miller indices of the surface ('111' or e.g. (2, -1, 0))
+    a (float) : lattice parameter of the conventional cubic cell
+
+    Returns
+    -------
+    lattice_vectors (np.ndarray) : (2, 2) array whose rows are the surface lattice vectors a and b
+    """
+    miller = _miller_indices(plane)
+    primitive = bravais_lattice_vectors(structure, 1.0)
+
+    # u @ primitive is orthogonal to n if u . (primitive @ n) = 0; primitive has half-integer entries at most
+    kernel = _integer_kernel(np.round(2 * primitive @ miller))
+    vectors = kernel @ primitive
+
+    # 2D coordinates in the plane, with the first vector along x
+    normal = miller / np.linalg.norm(miller)
+    x_axis = vectors[0] / np.linalg.norm(vectors[0])
+    cell = vectors @ np.array([x_axis, np.cross(normal, x_axis)]).T
+
+    cell = _reduce_lattice(np.eye(2), cell) @ cell
+    if cell[0] @ cell[1] < 0:
+        cell[1] = -cell[1]
+    if np.linalg.det(cell) < 0:
+        cell = cell[::-1]
+
+    # rotate the first vector onto the x axis
+    angle = np.arctan2(cell[0, 1], cell[0, 0])
+    rotation = np.array([[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]])
+    return a * cell @ rotation
+
+def reciprocal_surface_cell(lattice_vectors : np.ndarray) -> np.ndarray:
+    """
+    Notes
+    -----
+    This function computes the reciprocal basis of a 2D cell by matrix inversion, a_i . b_j = 2*pi*delta_ij
+
+    Parameters
+    ----------
+    lattice_vectors (np.ndarray) : (2, 2) array whose rows are the real-space lattice vectors
+
+    Returns
+    -------
+    reciprocal_vectors (np.ndarray) : (2, 2) array whose rows are the reciprocal lattice vectors
+    """
+    return 2*np.pi * np.linalg.inv(lattice_vectors).T
+
+def generate_reciprocal_mesh(
+                        reciprocal_vectors : np.ndarray,
+                        Na : int,
+                        Nb : int,
+                        indexing : str = 'ij'
+) -> np.ndarray:
+    """
+    Notes
+    -----
+    This function generates the points h*a* + k*b* (h = 0..Na, k = 0..Nb) of a reciprocal lattice
+    as a single matrix product between the integer grid and the reciprocal basis
+
+    Parameters
+    ----------
+    reciprocal_vectors (np.ndarray) : (2, 2) array whose rows are the reciprocal lattice vectors (or any basis)
+    Na (int) : number of repetitions along a*
+    Nb (int) : number of repetitions along b*
+    indexing (str) : 'ij' lists the points with h as the outer index, 'xy' with k as the outer index
+
+    Returns
+    -------
+    reciprocal_positions (np.ndarray) : ((Na+1)*(Nb+1), 2) array containing the points
+    """
+    integer_grid = np.stack(np.meshgrid(np.arange(Na + 1), np.arange(Nb + 1), indexing=indexing), axis=-1).reshape(-1, 2)
+    return integer_grid @ np.asarray(reciprocal_vectors)
+
+def generate_surface_reciprocal_lattice_parameter(
+                                        plane : str,
+                                        a : float,
+                                        b : float,
+) -> [float, float]:
+    """
+    Notes
+    -----
+    This function evaluates the recirpocal lattice parameters
+
+    Parameters
+    ----------
+    plane (str) : surface selected for the diffraction pattern
+    a (float) : lattice parameter in the real space
+    b (float) : lattice parameter in the real space
+    c (float) : lattice parameter in the real space
+
+    Returns
+    -------
+    reciprocal_a (float) : lattice parameter in the reciprocal space
+    reciprocal_b (float) : lattice parameter in the reciprocal space
+    """
+
     if plane == '001' or plane == '110':
         reciprocal_a = 2*np.pi/a
         reciprocal_b = 2*np.pi/b
@@ -524,6 +1544,9 @@ def generate_surface_reciprocal_lattice_parameter(
     elif plane == '111':
         reciprocal_a = 2*np.pi/a * 2/np.sqrt(3)
         reciprocal_b = 2*np.pi/b * 2/np.sqrt(3)
+
+    else:
+        raise ValueError(f"Error: no reciprocal lattice parameters for the plane {plane}, use reciprocal_surface_cell(surface_unit_cell(...)).")
     return reciprocal_a, reciprocal_b
 
 def generate_reciprocal_111_surface_sc(
@@ -545,14 +1568,9 @@ def generate_reciprocal_111_surface_sc(
     atomic_positions (np.ndarray) : 2-dim array cointaining the atomic positions
 
     """
-    atomic_positions = []
-
-    for j in range(Nb+1):
-        for i in range(Na+1):
-            atomic_positions.append([i , j ])
+    # square net, listed with j as the outer index
+    atomic_positions = generate_reciprocal_mesh(np.eye(2, dtype=np.int64), Na, Nb, indexing='xy')
 
-    atomic_positions = np.array(atomic_positions)
-    
     return atomic_positions
     
 def generate_reciprocal_111_surface_bcc(
@@ -595,27 +1613,51 @@ def generate_reciprocal_111_surface_fcc(
     atomic_positions (np.ndarray) : 2-dim array cointaining the atomic positions
 
     """
-    atomic_positions = [] 
     angle = np.pi/3     # 60°
-    for i in range(Na+1):
-        for j in range(Nb+1):
-            atomic_positions.append([i * np.sin(angle), j + i*np.cos(angle)])
-
-    atomic_positions = np.array(atomic_positions)
+    atomic_positions = generate_reciprocal_mesh([[np.sin(angle), np.cos(angle)], [0, 1]], Na, Nb)
     # atomic_positions = atomic_positions*a_111    
     
     return atomic_positions
 
+def forbidden_reflections(
+                        h : np.ndarray,
+                        k : np.ndarray,
+                        symmetry_properties : dict = None
+) -> np.ndarray:
+    """
+    Notes
+    -----
+    This function flags the (h, k) reflections forbidden by the detected symmetry (centring translations
+    and glide lines), so that they can be skipped before any intensity is computed
+
+    Parameters
+    ----------
+    h (np.ndarray) : h indices (any shape, broadcast against k)
+    k (np.ndarray) : k indices
+    symmetry_properties (dict) : output of get_symmetry_properties; without symmetry operations
+                                 (e.g. if the lattice vectors were not given) no reflection is forbidden
+
+    Returns
+    -------
+    forbidden (np.ndarray) : boolean array with the broadcast shape of h and k, True for the extinct reflections
+    """
+    if symmetry_properties is None or symmetry_properties.get("symmetry_operations") is None:
+        return np.zeros(np.broadcast_shapes(np.shape(h), np.shape(k)), dtype=bool)
+
+    return find_systematic_absences(h, k, symmetry_properties["symmetry_operations"])
+
 def generate_reciprocal_surface_structure(
                             structure : str,
                             plane : str,
                             Na : int,
-                            Nb : int
+                            Nb : int,
+                            symmetry_properties : dict = None
 ):
     """
     Notes
     -----
-    This function calls the right function to generate and return the reciprocal surface structure
+    This function calls the right function to generate and return the reciprocal surface structure.
+    If the symmetry properties are given, the spots of the forbidden reflections are removed.
 
     Parameters
     ----------
@@ -623,83 +1665,280 @@ def generate_reciprocal_surface_structure(
     plane (str) : surface selected to be visualised
     Na (int) : number of repetitions of the structure to display along 'a'
     Nb (int) : number of repetitions of the structure to display along 'b'
+    symmetry_properties (dict, optional) : output of get_symmetry_properties (with the lattice vectors)
     """
     if structure == "sc" and plane == '111':
-        return generate_reciprocal_111_surface_sc(Na, Nb)
+        spots = generate_reciprocal_111_surface_sc(Na, Nb)
+        # (h, k) of every spot, in the order of generate_reciprocal_111_surface_sc (k outer, h inner)
+        h, k = np.tile(np.arange(Na + 1), Nb + 1), np.repeat(np.arange(Nb + 1), Na + 1)
     elif structure == "bcc":
         pass
     elif structure == "fcc" and plane == '111':
-        return generate_reciprocal_111_surface_fcc(Na, Nb)
+        spots = generate_reciprocal_111_surface_fcc(Na, Nb)
+        # (h, k) of every spot, in the order of generate_reciprocal_111_surface_fcc (h outer, k inner)
+        h, k = np.repeat(np.arange(Na + 1), Nb + 1), np.tile(np.arange(Nb + 1), Na + 1)
     else:
         raise ValueError("Invalid cubic_structure specified in config.ini")
 
-def calculate_intensity(Na, Nb):
+    if structure != "bcc":
+        return spots[~forbidden_reflections(h, k, symmetry_properties)]
+
+def interference_function(
+                        h : np.ndarray,
+                        N : int
+) -> np.ndarray:
+    """
+    Notes
+    -----
+    Evaluate the interference (Laue) function sin^2(pi*N*h)/sin^2(pi*h) for any real h.
+    The function has period 1, so h is first reduced to x = h - round(h) in [-0.5, 0.5]: this keeps
+    the sines accurate for large h and moves every 0/0 limit to x = 0, where the value is N^2.
+
+    Parameters
+    ----------
+    h (np.ndarray): Points (integer or fractional) where the function is evaluated.
+    N (int): Number of scatterers along the direction.
+
+    Returns
+    -------
+    interference (np.ndarray): Array with the shape of h containing the values of the function.
+    """
+    x = np.asarray(h, dtype=float)
+    x = x - np.round(x)
+
+    numerator = np.sin(np.pi * N * x)
+    denominator = np.sin(np.pi * x)
+
+    # The limit for x -> 0 is N^2 (the only zero of the denominator in [-0.5, 0.5])
+    interference = np.full(x.shape, float(N)**2)
+    np.divide(numerator, denominator, out=interference, where=denominator != 0)
+    np.square(interference, out=interference, where=denominator != 0)
+
+    return interference
+
+@instrumented(counts=count_q_points)
+def calculate_intensity(
+                    Na : int,
+                    Nb : int,
+                    h : np.ndarray = None,
+                    k : np.ndarray = None,
+                    symmetry_properties : dict = None,
+                    jit : bool = False,
+                    forbidden : np.ndarray = None
+) -> np.ndarray:
     """
     Notes
     -----
     Calculate the intensity array based on the formula:
-    intensity[h][k] = (sin^2(pi*Nx*h)/sin^2(pi*h)) * (sin^2(pi*Ny*k)/sin^2(pi*k))
+    intensity[h][k] = (sin^2(pi*Na*h)/sin^2(pi*h)) * (sin^2(pi*Nb*k)/sin^2(pi*k))
+    h and k are broadcast against each other, so dense fractional grids can be evaluated by passing
+    e.g. h = np.linspace(0, 3, 1000)[:, None] and k = np.linspace(0, 3, 1000)[None, :].
+    By default the integer grid h = 0..Na, k = 0..Nb is used.
+    If the symmetry properties are given, the reflections they forbid (see forbidden_reflections) are set
+    to zero without being evaluated; a mask already computed by forbidden_reflections can be passed instead.
+    With jit = True and Numba installed, a grid given as a column of h and a row of k is evaluated by the
+    compiled fused loop of kernels.interference_grid (otherwise the NumPy evaluation is used).
 
     Parameters
     ----------
-    Nx (int): Repetitions along the x-axis.
-    Ny (int): Repetitions along the y-axis.
+    Na (int): Repetitions along the a-axis.
+    Nb (int): Repetitions along the b-axis.
+    h (np.ndarray, optional): h coordinates of the points (default: integers 0..Na as a column).
+    k (np.ndarray, optional): k coordinates of the points (default: integers 0..Nb as a row).
+    symmetry_properties (dict, optional): output of get_symmetry_properties (with the lattice vectors).
+    jit (bool): if true, uses the Numba kernel when it is available.
+    forbidden (np.ndarray, optional): forbidden reflections, as returned by forbidden_reflections
+                                      (replaces symmetry_properties).
  
     Returns
     -------
-    intensity (np.ndarray): 2D array containing the calculated intensities.
+    intensity (np.ndarray): Array with the broadcast shape of h and k containing the calculated intensities.
     """
-    intensity = np.empty((Na+1, Nb+1))
-    
-    for h in range(0, Na+1):
-        for k in range(0, Nb+1):
-            
-            if h == 0:
-                
-                h_dependence_term = Nx**2   # divergency problem
+    if h is None:
+        h = np.arange(Na + 1)[:, None]
+    if k is None:
+        k = np.arange(Nb + 1)[None, :]
+
+    if forbidden is None:
+        forbidden = forbidden_reflections(h, k, symmetry_properties)
+    if not forbidden.any():
+        if jit and np.ndim(h) == 2 and np.ndim(k) == 2 and np.shape(h)[1] == 1 and np.shape(k)[0] == 1:
+            intensity = kernels.interference_grid(np.ravel(h), np.ravel(k), Na, Nb)
+            if intensity is not None:
+                return intensity
+
+        # The function is separable: evaluate each factor on its own points and broadcast the product
+        return interference_function(h, Na) * interference_function(k, Nb)
+
+    # Evaluate only the allowed reflections
+    h, k = np.broadcast_arrays(h, k)
+    allowed = ~forbidden
+    intensity = np.zeros(forbidden.shape)
+    intensity[allowed] = interference_function(h[allowed], Na) * interference_function(k[allowed], Nb)
+    return intensity
 
-            else:
-                h_dependence_term = (np.sin(np.pi * Nx * h) / np.sin(np.pi * h)) ** 2
 
-            if k == 0:
-                k_dependence_term = Ny**2   # divergency problem
-            else:
-                k_dependence_term = (np.sin(np.pi * Ny * k) / np.sin(np.pi * k)) ** 2
+def coordinates_basename(
+                        parameters : dict,
+                        is_surface : bool = False
+) -> str:
+    """
+    Notes
+    -----
+    This function returns the name (without extension) of the file storing the atomic coordinates
 
-            intensity[h][k] = h_dependence_term * k_dependence_term
+    Parameters
+    ----------
+    parameters (dict) : configuration parameters, as returned by read_config
+    is_surface (bool) : if true, returns the name of the surface file
 
-    
-    return intensity
+    Returns
+    -------
+    basename (str) : name of the file without extension
+    """
+    p = parameters
+    if is_surface:
+        return f'{p["element"]}({p["plane"]})_{p["structure"]}_a{p["a"]}__Na{p["Na"]}_Nb{p["Nb"]}'
+    else:
+        return f'{p["element"]}_{p["structure"]}_a{p["a"]}__Nx{p["Nx"]}_Ny{p["Ny"]}_Nz{p["Nz"]}'
 
+def _count_saved_atoms(result, arguments : dict) -> dict:
+    """
+    Notes
+    -----
+    Counts recorded by the instrumentation for save_atomic_coordinates (coordinates may be an iterator of blocks)
+    """
+    coordinates, n_atoms = arguments["coordinates"], arguments.get("n_atoms")
+    if n_atoms is None and hasattr(coordinates, '__len__'):
+        n_atoms = len(coordinates)
+    return {"n_atoms": n_atoms, "filename": result}
 
+@instrumented(counts=_count_saved_atoms)
 def save_atomic_coordinates(
                         coordinates : np.ndarray,
-                        is_surface : bool = False
-):    
+                        parameters : dict,
+                        is_surface : bool = False,
+                        file_format : str = 'npy',
+                        n_atoms : int = None
+) -> str:
     """
     Notes
     -----
-    This function saves the atomic coordinates previously evaluated in a txt file
+    This function saves the atomic coordinates previously evaluated.
+    With file_format = 'npy' the coordinates are written as a binary .npy file, which can be opened
+    through a memory map without parsing, and the configuration is stored in a .json file next to it.
+    With file_format = 'txt' they are exported as a txt file.
+    The coordinates can also be an iterable of blocks (e.g. from iterate_cubic_structure):
+    in that case the blocks are written one at a time and never held in memory together.
 
     Parameters
     ----------
-    coordinates (np.ndarray) : array containing the atomic coordinates
+    coordinates (np.ndarray) : array containing the atomic coordinates, or an iterable of arrays
+    parameters (dict) : configuration parameters, as returned by read_config
     if_surface (bool) : if true, changes the the file name adding the (111) plane information
+    file_format (str) : either 'npy' (binary, default) or 'txt'
+    n_atoms (int) : total number of atoms, required to stream an iterable of blocks into a npy file
+
+    Returns
+    -------
+    filename (str) : name of the file the coordinates were written to
     """
+    # Generate the filename based on the configuration parameters
+    basename = coordinates_basename(parameters, is_surface)
     if is_surface: 
-        # Generate the filename for the surface
-        filename = f'{element_symbol}({plane})_{cubic_structure}_a{a}__Na{Na}_Nb{Nb}.txt'
-
+        keys = ["structure", "a", "element", "plane", "Na", "Nb"]
     else: 
-        # Generate the filename based on the configuration parameters
-        filename = f'{element_symbol}_{cubic_structure}_a{a}__Nx{Nx}_Ny{Ny}_Nz{Nz}.txt'
+        keys = ["structure", "a", "element", "Nx", "Ny", "Nz"]
+    metadata = {key: parameters[key] for key in keys}
+
+    if file_format == 'txt':
+        filename = basename + '.txt'
+
+        # Save the atomic positions to the generated filename
+        if isinstance(coordinates, np.ndarray):
+            np.savetxt(filename, coordinates)
+        else:
+            with open(filename, 'w') as file:
+                for block in coordinates:
+                    np.savetxt(file, block)
+
+    elif file_format == 'npy':
+        filename = basename + '.npy'
+
+        if isinstance(coordinates, np.ndarray):
+            np.save(filename, coordinates)
+        else:
+            if n_atoms is None:
+                raise ValueError("Error: n_atoms is required to save a stream of coordinates in the npy format.")
+
+            # Copy the blocks into a memory mapped npy file as they arrive
+            output = None
+            start = 0
+            for block in coordinates:
+                if output is None:
+                    output = np.lib.format.open_memmap(filename, mode='w+', dtype=block.dtype, shape=(n_atoms, block.shape[1]))
+                output[start:start + len(block)] = block
+                start += len(block)
+
+            if start != n_atoms:
+                raise ValueError(f"Error: expected {n_atoms} atoms, but {start} were written.")
+            if output is None:
+                # empty stream: there is nothing to map, write an empty array of positions
+                np.save(filename, np.empty((0, 3)))
+            else:
+                output.flush()
+                del output
 
-    # Save the atomic positions to the generated filename
-    np.savetxt(filename, coordinates)
+        metadata["n_atoms"] = n_atoms if n_atoms is not None else len(coordinates)
+        with open(basename + '.json', 'w') as file:
+            json.dump(metadata, file, indent=4)
 
+    else:
+        raise ValueError(f"Error: invalid file format '{file_format}', use either 'npy' or 'txt'.")
+
+    return filename
+
+def load_atomic_coordinates(
+                        filename : str,
+                        mmap_mode : str = 'r'
+) -> [np.ndarray, dict]:
+    """
+    Notes
+    -----
+    This function loads atomic coordinates saved by save_atomic_coordinates, together with their
+    metadata. Binary files are memory mapped, so large structures are neither parsed nor copied.
+
+    Parameters
+    ----------
+    filename (str) : name of the .npy or .txt file
+    mmap_mode (str) : memory map mode passed to np.load for .npy files (None to read into memory)
+
+    Returns
+    -------
+    coordinates (np.ndarray) : array containing the atomic coordinates
+    metadata (dict) : configuration the coordinates were generated with (empty for txt files)
+    """
+    if not os.path.isfile(filename):
+        raise FileNotFoundError(f"Error: '{filename}' file not found.")
+
+    basename, extension = os.path.splitext(filename)
+    if extension == '.npy':
+        coordinates = np.load(filename, mmap_mode=mmap_mode)
+        metadata = {}
+        if os.path.isfile(basename + '.json'):
+            with open(basename + '.json') as file:
+                metadata = json.load(file)
+    else:
+        coordinates = np.loadtxt(filename)
+        metadata = {}
+
+    return coordinates, metadata
+
+@instrumented()
 def save_intensity(
                 intensity : np.ndarray,
-):
+                parameters : dict
+) -> str:
     """
     Notes
     -----
@@ -708,18 +1947,45 @@ def save_intensity(
     Parameters
     ----------
     intensity (np.ndarray) : array containing the intensity of the diffraction pattern
+    parameters (dict) : configuration parameters, as returned by read_config
+
+    Returns
+    -------
+    filename (str) : name of the file the intensity was written to
     """
-    filename = f'intensity_{element_symbol}_{cubic_structure}_a{a}__Nx{Nx}_Ny{Ny}_Nz{Nz}.txt'
+    p = parameters
+    filename = f'intensity_{p["element"]}_{p["structure"]}_a{p["a"]}__Nx{p["Nx"]}_Ny{p["Ny"]}_Nz{p["Nz"]}.txt'
     np.savetxt(filename, intensity)
+    return filename
+
+
+def main(
+        config_file : str = 'config.ini'
+):
+    """
+    Notes
+    -----
+    Command line entry point: generates the cubic structure and its surface from the configuration file,
+    saves them and prints the intensity of the diffraction pattern
+
+    Parameters
+    ----------
+    config_file (str) : name of the configuration file
+    """
+    p = read_config(config_file)
+    structure, Nx, Ny, Nz, a = p["structure"], p["Nx"], p["Ny"], p["Nz"], p["a"]
+
+    save_atomic_coordinates(iterate_cubic_structure(structure, Nx, Ny, Nz, a), p, n_atoms = count_cubic_atoms(structure, Nx, Ny, Nz))
 
+    surface_positions = generate_surface_structure(structure, p["plane"], p["Na"], p["Nb"])
+    save_atomic_coordinates(surface_positions, p, is_surface = True)
 
-cubic_positions = generate_cubic_structure(cubic_structure, Nx, Ny, Nz)
-save_atomic_coordinates(cubic_positions)
+    #check generation of the lattice parameter
+    intensity = calculate_intensity(p["Na"], p["Nb"])
+    print(intensity)
 
-surface_positions = generate_surface_structure(cubic_structure, plane, Na, Nb)
-surface_positions_shifted = shift_surface_coordinates(surface_positions)
-save_atomic_coordinates(surface_positions, is_surface = True)
 
-#check generation of the lattice parameter
-intensity = calculate_intensity(Na, Nb)
-print(intensity)
\ No newline at end of file
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a cubic structure and its surface from a configuration file.")
+    parser.add_argument("config_file", nargs="?", default="config.ini", help="configuration file (default: config.ini)")
+    main(parser.parse_args().config_file)
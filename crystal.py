@@ -0,0 +1,311 @@
+import numpy as np
+
+import create_cubic_structure as ccs
+from form_factors import atomic_form_factor
+
+# Fractional coordinates of the atoms of the conventional cubic cells, in the order of the sublattices
+# of generate_cubic_structure (verteces first, then body or face centered atoms)
+CUBIC_BASIS = {
+    "sc": ((0.0, 0.0, 0.0),),
+    "bcc": ((0.0, 0.0, 0.0), (0.5, 0.5, 0.5)),
+    "fcc": ((0.0, 0.0, 0.0), (0.0, 0.5, 0.5), (0.5, 0.0, 0.5), (0.5, 0.5, 0.0)),
+}
+
+
+def make_crystal(
+            lattice_vectors : np.ndarray,
+            basis : np.ndarray,
+            repetitions : tuple,
+            species : tuple = None
+) -> dict:
+    """
+    Notes
+    -----
+    This function builds the compact description of a finite crystal: the lattice vectors, the atoms of one
+    unit cell and the number of cells along every lattice vector. Its memory does not depend on the number
+    of cells; the atomic positions are produced only on demand (crystal_positions, iterate_crystal_positions)
+    and the diffraction intensity is evaluated in the factorised form |F_cell|^2 x Laue (crystal_intensity).
+
+    Parameters
+    ----------
+    lattice_vectors (np.ndarray) : (d, d) array whose rows are the lattice vectors (d = 2 or 3)
+    basis (np.ndarray) : (n, d) array with the fractional coordinates of the atoms of the cell, in [0, 1)
+    repetitions (tuple) : number of cells along every lattice vector
+    species (tuple, optional) : chemical symbol of every atom of the basis (default: unit scatterers)
+
+    Returns
+    -------
+    crystal (dict) : dictionary with the keys lattice_vectors, basis, repetitions and species
+    """
+    lattice_vectors = np.array(lattice_vectors, dtype=np.float64)
+    basis = np.array(basis, dtype=np.float64).reshape(-1, len(lattice_vectors))
+    repetitions = tuple(int(N) for N in repetitions)
+
+    if lattice_vectors.shape not in ((2, 2), (3, 3)) or abs(np.linalg.det(lattice_vectors)) < 1e-12:
+        raise ValueError(f"Error: the lattice vectors must be a non-singular (2, 2) or (3, 3) array, got shape {lattice_vectors.shape}.")
+    if len(repetitions) != len(lattice_vectors) or min(repetitions) < 1:
+        raise ValueError(f"Error: one positive number of repetitions per lattice vector is required, got {repetitions}.")
+    if np.any((basis < -1e-9) | (basis >= 1 - 1e-9)):
+        raise ValueError("Error: the fractional coordinates of the basis must lie in [0, 1).")
+    if species is not None:
+        species = tuple(species)
+        if len(species) != len(basis):
+            raise ValueError("Error: species must have one chemical symbol per basis atom.")
+
+    lattice_vectors.setflags(write=False)
+    basis.setflags(write=False)
+    return {
+        "lattice_vectors": lattice_vectors,
+        "basis": basis,
+        "repetitions": repetitions,
+        "species": species,
+    }
+
+
+def cubic_crystal(
+                structure : str,
+                Nx : int,
+                Ny : int,
+                Nz : int,
+                a : float = 1.0,
+                element : str = None
+) -> dict:
+    """
+    Notes
+    -----
+    This function returns the compact description of the cubic structure of generate_cubic_structure:
+    Nx x Ny x Nz conventional cells with the sc, bcc or fcc basis
+
+    Parameters
+    ----------
+    structure (str) : type of cubic structure (sc, bcc or fcc)
+    Nx (int) : number of repetitions of the structure along the x axis
+    Ny (int) : number of repetitions of the structure along the y axis
+    Nz (int) : number of repetitions of the structure along the z axis
+    a (float) : lattice parameter (1 gives the positions in units of the lattice parameter)
+    element (str, optional) : chemical symbol of the atoms (default: unit scatterers)
+
+    Returns
+    -------
+    crystal (dict) : compact description of the crystal (see make_crystal)
+    """
+    if structure not in CUBIC_BASIS:
+        raise ValueError("Invalid cubic_structure specified in config.ini")
+
+    basis = CUBIC_BASIS[structure]
+    return make_crystal(a * np.eye(3), basis, (Nx, Ny, Nz), None if element is None else (element,) * len(basis))
+
+
+def surface_crystal(
+                structure : str,
+                plane : str,
+                Na : int,
+                Nb : int,
+                element : str = None
+) -> dict:
+    """
+    Notes
+    -----
+    This function returns the compact description of the surface net of generate_surface_structure,
+    in the same units (the nearest-neighbour distance)
+
+    Parameters
+    ----------
+    structure (str) : type of cubic structure (sc, bcc or fcc)
+    plane (str) : surface selected to be visualised
+    Na (int) : number of repetitions of the structure along 'a'
+    Nb (int) : number of repetitions of the structure along 'b'
+    element (str, optional) : chemical symbol of the atoms (default: unit scatterers)
+
+    Returns
+    -------
+    crystal (dict) : compact description of the surface (see make_crystal)
+    """
+    return make_crystal(ccs.surface_lattice_vectors(structure, plane), ((0.0, 0.0),), (Na, Nb), None if element is None else (element,))
+
+
+def _sublattice_shapes(
+                    crystal : dict,
+                    include_boundary : bool
+) -> list:
+    """
+    Notes
+    -----
+    This function returns the number of lattice translations of every basis atom along every lattice vector.
+    With the boundary, the atoms on the far faces of the block are added (n + b <= N), as the generators do.
+
+    Parameters
+    ----------
+    crystal (dict) : compact description of the crystal
+    include_boundary (bool) : if true, the atoms on the far faces of the block are included
+
+    Returns
+    -------
+    shapes (list) : one tuple of counts per basis atom
+    """
+    repetitions = np.array(crystal["repetitions"])
+    on_faces = np.abs(crystal["basis"]) < 1e-9
+    return [tuple(int(n) for n in repetitions + (include_boundary & faces)) for faces in on_faces]
+
+
+def count_crystal_atoms(
+                    crystal : dict,
+                    include_boundary : bool = False
+) -> int:
+    """
+    Notes
+    -----
+    This function returns the number of atoms of the crystal without generating them
+
+    Parameters
+    ----------
+    crystal (dict) : compact description of the crystal
+    include_boundary (bool) : if true, the atoms on the far faces of the block are counted
+
+    Returns
+    -------
+    n_atoms (int) : number of atoms
+    """
+    return sum(int(np.prod(shape)) for shape in _sublattice_shapes(crystal, include_boundary))
+
+
+def crystal_positions(
+                crystal : dict,
+                include_boundary : bool = False,
+                dtype : np.dtype = np.float64
+) -> np.ndarray:
+    """
+    Notes
+    -----
+    This function produces the atomic positions of the crystal, one sublattice after the other, with the
+    cell indices in C order. Every sublattice is written into the preallocated output by broadcasting the
+    translations along each lattice vector, without temporary arrays of the size of the output.
+    With include_boundary = True the positions of cubic_crystal are exactly those of generate_cubic_structure
+    (same order), and the ones of surface_crystal are those of generate_surface_structure.
+
+    Parameters
+    ----------
+    crystal (dict) : compact description of the crystal
+    include_boundary (bool) : if true, the atoms on the far faces of the block are included
+    dtype (np.dtype) : floating point type of the returned array
+
+    Returns
+    -------
+    atomic_positions (np.ndarray) : (N, d) array containing the atomic positions
+    """
+    lattice_vectors = crystal["lattice_vectors"]
+    dimension = len(lattice_vectors)
+    shapes = _sublattice_shapes(crystal, include_boundary)
+    atomic_positions = np.empty((sum(int(np.prod(shape)) for shape in shapes), dimension), dtype=dtype)
+
+    start = 0
+    for atom, shape in zip(crystal["basis"], shapes):
+        count = int(np.prod(shape))
+        grid = atomic_positions[start:start + count].reshape(*shape, dimension)
+        grid[...] = atom @ lattice_vectors
+        for axis, n in enumerate(shape):
+            # translations along one lattice vector, broadcast over the other axes
+            grid += (np.arange(n)[:, None] * lattice_vectors[axis]).reshape((1,) * axis + (n,) + (1,) * (dimension - axis - 1) + (dimension,))
+        start += count
+
+    return atomic_positions
+
+
+def iterate_crystal_positions(
+                        crystal : dict,
+                        block_size : int = 1_000_000,
+                        include_boundary : bool = False,
+                        dtype : np.dtype = np.float64
+):
+    """
+    Notes
+    -----
+    This function yields the atomic positions of the crystal in blocks of at most block_size atoms, so that
+    the peak memory does not depend on the number of cells. Concatenating the blocks gives crystal_positions.
+
+    Parameters
+    ----------
+    crystal (dict) : compact description of the crystal
+    block_size (int) : maximum number of atoms per block
+    include_boundary (bool) : if true, the atoms on the far faces of the block are included
+    dtype (np.dtype) : floating point type of the blocks
+
+    Yields
+    ------
+    block (np.ndarray) : (n, d) array with n <= block_size atomic positions
+    """
+    if block_size <= 0:
+        raise ValueError("Error: block_size must be greater than zero.")
+
+    lattice_vectors = crystal["lattice_vectors"]
+    for atom, shape in zip(crystal["basis"], _sublattice_shapes(crystal, include_boundary)):
+        count = int(np.prod(shape))
+        for start in range(0, count, block_size):
+            cells = np.stack(np.unravel_index(np.arange(start, min(start + block_size, count)), shape), axis=1)
+            yield ((cells + atom) @ lattice_vectors).astype(dtype, copy=False)
+
+
+def cell_structure_factor(
+                    crystal : dict,
+                    q_points : np.ndarray
+) -> np.ndarray:
+    """
+    Notes
+    -----
+    Calculate the structure factor of one unit cell F_cell(q) = sum_j f_j exp(2*pi*i q.r_j), summed over
+    the basis atoms only. If the crystal has species, f_j is the atomic form factor of the atom at |q|
+    (lattice vectors in Å, q in 1/Å), otherwise 1.
+
+    Parameters
+    ----------
+    crystal (dict) : compact description of the crystal
+    q_points (np.ndarray) : (M, d) array with the q-points, in the reciprocal units of the lattice vectors
+                            (the factor 2*pi is included in the phase, as in calculate_structure_factor)
+
+    Returns
+    -------
+    structure_factor (np.ndarray) : (M,) complex array with F_cell(q) for every q-point
+    """
+    q_points = np.asarray(q_points, dtype=np.float64).reshape(-1, len(crystal["lattice_vectors"]))
+    phases = np.exp(2j * np.pi * q_points @ (crystal["basis"] @ crystal["lattice_vectors"]).T)
+
+    if crystal["species"] is None:
+        return phases.sum(axis=1)
+
+    q = np.linalg.norm(q_points, axis=1)
+    form_factors = np.empty(phases.shape)
+    for element in set(crystal["species"]):
+        form_factors[:, [s == element for s in crystal["species"]]] = atomic_form_factor(element, q)[:, None]
+    return (form_factors * phases).sum(axis=1)
+
+
+def crystal_intensity(
+                crystal : dict,
+                q_points : np.ndarray
+) -> np.ndarray:
+    """
+    Notes
+    -----
+    Calculate the kinematic diffraction intensity of the finite crystal in the factorised form
+        I(q) = |F_cell(q)|^2 * prod_i sin^2(pi N_i q.a_i) / sin^2(pi q.a_i)
+    The cost is O(M * n_basis) whatever the number of cells, and the result equals
+    calculate_kinematic_intensity on crystal_positions(crystal).
+
+    Parameters
+    ----------
+    crystal (dict) : compact description of the crystal
+    q_points (np.ndarray) : (M, d) array with the q-points, in the reciprocal units of the lattice vectors
+
+    Returns
+    -------
+    intensity (np.ndarray) : (M,) array with the intensity for every q-point
+    """
+    q_points = np.asarray(q_points, dtype=np.float64).reshape(-1, len(crystal["lattice_vectors"]))
+    F = cell_structure_factor(crystal, q_points)
+    intensity = F.real**2 + F.imag**2
+
+    # q.a_i is the phase (in turns) between neighbouring cells along the lattice vector a_i
+    for lattice_vector, N in zip(crystal["lattice_vectors"], crystal["repetitions"]):
+        intensity *= ccs.interference_function(q_points @ lattice_vector, N)
+
+    return intensity
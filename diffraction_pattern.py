@@ -0,0 +1,218 @@
+import numpy as np
+
+import create_cubic_structure as ccs
+
+
+def _fast_length(n : int) -> int:
+    """
+    Notes
+    -----
+    This function returns the smallest 5-smooth number (2^a 3^b 5^c) not smaller than n, a length for which the FFT is fast
+
+    Parameters
+    ----------
+    n (int) : minimum length
+
+    Returns
+    -------
+    length (int) : fast FFT length
+    """
+    length = n
+    while True:
+        m = length
+        for factor in (2, 3, 5):
+            while m % factor == 0:
+                m //= factor
+        if m == 1:
+            return length
+        length += 1
+
+
+def _broadening_kernel(
+                    kernel : str,
+                    width : float
+) -> np.ndarray:
+    """
+    Notes
+    -----
+    This function returns the normalised 2D stencil of a broadening kernel
+
+    Parameters
+    ----------
+    kernel (str) : 'gaussian' (width is the standard deviation) or 'lorentzian' (width is the half width at half maximum)
+    width (float) : width of the kernel in pixels
+
+    Returns
+    -------
+    stencil (np.ndarray) : (2r+1, 2r+1) array with unit sum
+    """
+    if kernel == 'gaussian':
+        radius = int(np.ceil(4 * width))
+        offsets = np.arange(-radius, radius + 1)
+        profile = np.exp(-offsets**2 / (2 * width**2))
+        stencil = np.outer(profile, profile)
+    elif kernel == 'lorentzian':
+        radius = int(np.ceil(10 * width))
+        offsets = np.arange(-radius, radius + 1)
+        stencil = 1 / (1 + (offsets[:, None]**2 + offsets[None, :]**2) / width**2)**1.5
+    else:
+        raise ValueError(f"Error: unknown broadening kernel '{kernel}', use 'gaussian', 'lorentzian' or None.")
+
+    return stencil / stencil.sum()
+
+
+def rasterize_spots(
+                spot_positions : np.ndarray,
+                intensities : np.ndarray,
+                shape : tuple = (2048, 2048),
+                extent : tuple = None,
+                kernel : str = 'gaussian',
+                width : float = 1.5
+) -> np.ndarray:
+    """
+    Notes
+    -----
+    This function renders diffraction spots on a detector-sized pixel image. Every spot is split over its four
+    nearest pixels (bilinear weights) and all the spots are accumulated at once with np.bincount; the image is
+    then convolved with the broadening kernel, so the cost of the broadening does not depend on the number of spots.
+    The integrated intensity of the spots inside the image is conserved.
+
+    Parameters
+    ----------
+    spot_positions (np.ndarray) : (N, 2) array with the (x, y) positions of the spots in reciprocal space
+    intensities (np.ndarray) : (N,) array with the intensities of the spots (or a scalar)
+    shape (tuple) : (height, width) of the image in pixels
+    extent (tuple) : (x_min, x_max, y_min, y_max) region of reciprocal space covered by the image
+                     (default: the bounding box of the spots, with a margin of 5%)
+    kernel (str) : 'gaussian', 'lorentzian' or None for point spots
+    width (float) : width of the kernel in pixels
+
+    Returns
+    -------
+    image (np.ndarray) : (height, width) float64 array, with y increasing upwards (row 0 at y_max)
+    """
+    spot_positions = np.asarray(spot_positions, dtype=np.float64).reshape(-1, 2)
+    intensities = np.broadcast_to(np.asarray(intensities, dtype=np.float64), (len(spot_positions),))
+    height, width_pixels = shape
+
+    if extent is None:
+        low, high = spot_positions.min(axis=0), spot_positions.max(axis=0)
+        margin = 0.05 * np.maximum(high - low, 1e-12)
+        extent = (low[0] - margin[0], high[0] + margin[0], low[1] - margin[1], high[1] + margin[1])
+    x_min, x_max, y_min, y_max = extent
+
+    # continuous pixel coordinates, with the pixel centres at integer values
+    column = (spot_positions[:, 0] - x_min) / (x_max - x_min) * width_pixels - 0.5
+    row = (y_max - spot_positions[:, 1]) / (y_max - y_min) * height - 0.5
+
+    column_0, row_0 = np.floor(column).astype(np.int64), np.floor(row).astype(np.int64)
+    fraction_column, fraction_row = column - column_0, row - row_0
+
+    # bilinear weights of the four neighbouring pixels, accumulated in a single bincount
+    rows = np.concatenate([row_0, row_0, row_0 + 1, row_0 + 1])
+    columns = np.concatenate([column_0, column_0 + 1, column_0, column_0 + 1])
+    weights = np.concatenate([(1 - fraction_row) * (1 - fraction_column), (1 - fraction_row) * fraction_column,
+                              fraction_row * (1 - fraction_column), fraction_row * fraction_column]) * np.tile(intensities, 4)
+
+    inside = (rows >= 0) & (rows < height) & (columns >= 0) & (columns < width_pixels)
+    image = np.bincount(rows[inside] * width_pixels + columns[inside], weights=weights[inside],
+                        minlength=height * width_pixels).reshape(height, width_pixels)
+
+    if kernel is None:
+        return image
+
+    # linear convolution by FFT, on the image padded by the kernel radius up to a fast FFT length
+    stencil = _broadening_kernel(kernel, width)
+    radius = stencil.shape[0] // 2
+    padded_shape = (_fast_length(height + 2 * radius), _fast_length(width_pixels + 2 * radius))
+    spectrum = np.fft.rfft2(image, padded_shape) * np.fft.rfft2(stencil, padded_shape)
+    return np.fft.irfft2(spectrum, padded_shape)[radius:radius + height, radius:radius + width_pixels]
+
+
+def save_pattern(
+            image : np.ndarray,
+            filename : str,
+            log_scale : bool = True,
+            cmap : str = 'gray'
+) -> str:
+    """
+    Notes
+    -----
+    This function writes a rendered pattern to an image file (PNG, or any format supported by matplotlib)
+    without creating a figure
+
+    Parameters
+    ----------
+    image (np.ndarray) : 2D array returned by rasterize_spots
+    filename (str) : name of the image file
+    log_scale (bool) : if true, the intensities are shown on a logarithmic scale
+    cmap (str) : matplotlib colour map
+
+    Returns
+    -------
+    filename (str) : name of the image file
+    """
+    image = np.clip(image, 0, None)
+    if log_scale:
+        image = np.log1p(image / max(image.max(), 1e-300) * 1e4)
+
+    # matplotlib is imported only when an image is written
+    import matplotlib.image as mpimg
+    mpimg.imsave(filename, image, cmap=cmap, vmin=0, vmax=max(image.max(), 1e-300), origin='upper')
+    return filename
+
+
+def surface_reciprocal_mesh(
+                        parameters : dict,
+                        Na : int,
+                        Nb : int
+) -> np.ndarray:
+    """
+    Notes
+    -----
+    This function returns the positions h a* + k b* of the (h, k) spots of a surface, for h <= Na and k <= Nb
+
+    Parameters
+    ----------
+    parameters (dict) : configuration parameters (structure and plane are used)
+    Na (int) : highest h index
+    Nb (int) : highest k index
+
+    Returns
+    -------
+    spot_positions (np.ndarray) : ((Na+1)*(Nb+1), 2) array, in units of 2*pi over the nearest-neighbour distance
+    """
+    reciprocal_vectors = ccs.reciprocal_surface_cell(ccs.surface_lattice_vectors(parameters["structure"], parameters["plane"]))
+    return ccs.generate_reciprocal_mesh(reciprocal_vectors, Na, Nb)
+
+
+def render_surface_pattern(
+                        parameters : dict,
+                        intensity : np.ndarray,
+                        shape : tuple = (512, 512),
+                        kernel : str = 'gaussian',
+                        width : float = 1.5,
+                        spot_positions : np.ndarray = None
+) -> np.ndarray:
+    """
+    Notes
+    -----
+    This function renders the intensity calculated on the (h, k) grid of a surface as a 2D diffraction pattern,
+    placing the spot (h, k) at h a* + k b* in reciprocal space (in units of 2*pi over the nearest-neighbour distance)
+
+    Parameters
+    ----------
+    parameters (dict) : configuration parameters (structure and plane are used)
+    intensity (np.ndarray) : (Na+1, Nb+1) array returned by calculate_intensity
+    shape (tuple) : (height, width) of the image in pixels
+    kernel (str) : 'gaussian', 'lorentzian' or None for point spots
+    width (float) : width of the kernel in pixels
+    spot_positions (np.ndarray, optional) : (Na+1)*(Nb+1) x 2 reciprocal mesh of the spots, if already computed
+
+    Returns
+    -------
+    image (np.ndarray) : (height, width) float64 array
+    """
+    if spot_positions is None:
+        spot_positions = surface_reciprocal_mesh(parameters, intensity.shape[0] - 1, intensity.shape[1] - 1)
+    return rasterize_spots(spot_positions, intensity.ravel(), shape, kernel=kernel, width=width)
@@ -0,0 +1,139 @@
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+
+# Cromer-Mann coefficients of the X-ray atomic form factors (International Tables for Crystallography,
+# Vol. C, Table 6.1.1.4): f(s) = sum_i a_i exp(-b_i s^2) + c, with s = sin(theta)/lambda in 1/Å.
+# Each entry is (a1, b1, a2, b2, a3, b3, a4, b4, c).
+CROMER_MANN_COEFFICIENTS = {
+    "H":  (0.489918, 20.6593, 0.262003, 7.74039, 0.196767, 49.5519, 0.049879, 2.20159, 0.001305),
+    "C":  (2.31000, 20.8439, 1.02000, 10.2075, 1.58860, 0.568700, 0.865000, 51.6512, 0.215600),
+    "N":  (12.2126, 0.005700, 3.13220, 9.89330, 2.01250, 28.9975, 1.16630, 0.582600, -11.5290),
+    "O":  (3.04850, 13.2771, 2.28680, 5.70110, 1.54630, 0.323900, 0.867000, 32.9089, 0.250800),
+    "Na": (4.76260, 3.28500, 3.17360, 8.84220, 1.26740, 0.313600, 1.11280, 129.424, 0.676000),
+    "Al": (6.42020, 3.03870, 1.90020, 0.742600, 1.59360, 31.5472, 1.96460, 85.0886, 1.11510),
+    "Si": (6.29150, 2.43860, 3.03530, 32.3337, 1.98910, 0.678500, 1.54100, 81.6937, 1.14070),
+    "S":  (6.90530, 1.46790, 5.20340, 22.2151, 1.43790, 0.253600, 1.58630, 56.1720, 0.866900),
+    "K":  (8.21860, 12.7949, 7.43980, 0.774800, 1.05190, 213.187, 0.865900, 41.6841, 1.42280),
+    "V":  (10.2971, 6.86570, 7.35110, 0.438500, 2.07030, 26.8938, 2.05710, 102.478, 1.21990),
+    "Cr": (10.6406, 6.10380, 7.35370, 0.392000, 3.32400, 20.2626, 1.49220, 98.7399, 1.18320),
+    "Fe": (11.7695, 4.76110, 7.35730, 0.307200, 3.52220, 15.3535, 2.30450, 76.8805, 1.03690),
+    "Co": (12.2841, 4.27910, 7.34090, 0.278400, 4.00340, 13.5359, 2.34880, 71.1692, 1.01180),
+    "Ni": (12.8376, 3.87850, 7.29200, 0.256500, 4.44380, 12.1763, 2.38000, 66.3421, 1.03410),
+    "Cu": (13.3380, 3.58280, 7.16760, 0.247000, 5.61580, 11.3966, 1.67350, 64.8126, 1.19100),
+    "Nb": (17.6142, 1.18865, 12.0144, 11.7660, 4.04183, 0.204785, 3.53346, 69.7957, 3.75591),
+    "Mo": (3.70250, 0.277200, 17.2356, 1.09580, 12.8876, 11.0040, 3.74290, 61.6584, 4.38750),
+    "Rh": (19.2957, 0.751536, 14.3501, 8.21758, 4.73425, 25.8749, 1.28918, 98.6062, 5.32800),
+    "Pd": (19.3319, 0.698655, 15.5017, 7.98929, 5.29537, 25.2052, 0.605844, 76.8986, 5.26593),
+    "Ag": (19.2808, 0.644600, 16.6885, 7.47260, 4.80450, 24.6605, 1.04630, 99.8156, 5.17900),
+    "Cs": (20.3892, 3.56900, 19.1062, 0.310700, 10.6620, 24.3879, 1.49530, 213.904, 3.33520),
+    "Ta": (29.2024, 1.77333, 15.2293, 9.37046, 14.5135, 0.295977, 4.76492, 63.3644, 9.24354),
+    "W":  (29.0818, 1.72029, 15.4300, 9.22590, 14.4327, 0.321703, 5.11982, 57.0560, 9.88750),
+    "Ir": (27.3049, 1.59279, 16.7296, 8.86553, 15.6115, 0.417916, 5.83377, 45.0011, 11.4722),
+    "Pt": (27.0059, 1.51293, 17.7639, 8.81174, 15.7131, 0.424593, 5.78370, 38.6103, 11.6883),
+    "Au": (16.8819, 0.461100, 18.5913, 8.62160, 25.5582, 1.48260, 5.86000, 36.3956, 12.0658),
+    "Pb": (31.0617, 0.690200, 13.0637, 2.35760, 18.4420, 8.61800, 5.96960, 47.2579, 13.4118),
+}
+
+# Maximum number of (element, q-grid) results kept in memory by atomic_form_factor
+FORM_FACTOR_CACHE_SIZE = 128
+
+_form_factor_cache = OrderedDict()
+_cache_statistics = {"hits": 0, "misses": 0}
+
+
+def evaluate_form_factor(
+                    element : str,
+                    q : np.ndarray
+) -> np.ndarray:
+    """
+    Notes
+    -----
+    Evaluate the X-ray atomic form factor of an element with the Cromer-Mann Gaussian sum, without caching.
+
+    Parameters
+    ----------
+    element (str) : chemical symbol of the element (e.g. 'Ir')
+    q (np.ndarray) : moduli of the scattering vectors in 1/Å, without the factor 2*pi
+                     (q = 1/d = 2 sin(theta)/lambda, the convention of structure_factor.py)
+
+    Returns
+    -------
+    form_factor (np.ndarray) : array with the shape of q containing f(q) in electrons
+    """
+    if element not in CROMER_MANN_COEFFICIENTS:
+        raise ValueError(f"Error: no form factor coefficients available for the element '{element}'.")
+
+    coefficients = CROMER_MANN_COEFFICIENTS[element]
+    s_squared = (np.asarray(q, dtype=np.float64) / 2)**2
+
+    form_factor = np.full(s_squared.shape, coefficients[8])
+    for a_i, b_i in zip(coefficients[0:8:2], coefficients[1:8:2]):
+        form_factor += a_i * np.exp(-b_i * s_squared)
+
+    return form_factor
+
+
+def atomic_form_factor(
+                    element : str,
+                    q : np.ndarray
+) -> np.ndarray:
+    """
+    Notes
+    -----
+    Return the X-ray atomic form factor of an element on a q-grid, memoising the result per (element, q-grid).
+    The grid is identified by its content, so repeated evaluations on the same grid (e.g. across the
+    configurations of a sweep) reuse the stored values. At most FORM_FACTOR_CACHE_SIZE results are kept,
+    dropping the least recently used one.
+
+    Parameters
+    ----------
+    element (str) : chemical symbol of the element (e.g. 'Ir')
+    q (np.ndarray) : moduli of the scattering vectors in 1/Å, without the factor 2*pi
+
+    Returns
+    -------
+    form_factor (np.ndarray) : read-only array with the shape of q containing f(q) in electrons
+    """
+    q = np.ascontiguousarray(q, dtype=np.float64)
+    key = (element, q.shape, hashlib.blake2b(q.tobytes(), digest_size=16).digest())
+
+    if key in _form_factor_cache:
+        _cache_statistics["hits"] += 1
+        _form_factor_cache.move_to_end(key)
+        return _form_factor_cache[key]
+
+    _cache_statistics["misses"] += 1
+    form_factor = evaluate_form_factor(element, q)
+    form_factor.setflags(write=False)
+
+    _form_factor_cache[key] = form_factor
+    if len(_form_factor_cache) > FORM_FACTOR_CACHE_SIZE:
+        _form_factor_cache.popitem(last=False)
+
+    return form_factor
+
+
+def form_factor_cache_info() -> dict:
+    """
+    Notes
+    -----
+    Return the statistics of the form factor cache
+
+    Returns
+    -------
+    info (dict) : dictionary with the number of hits, misses and stored results
+    """
+    return dict(_cache_statistics, size=len(_form_factor_cache))
+
+
+def clear_form_factor_cache():
+    """
+    Notes
+    -----
+    Remove every stored result from the form factor cache and reset its statistics
+    """
+    _form_factor_cache.clear()
+    _cache_statistics["hits"] = 0
+    _cache_statistics["misses"] = 0
@@ -0,0 +1,246 @@
+import cProfile
+import functools
+import inspect
+import json
+import os
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+import numpy as np
+
+from settings import export_to_environment, read_config_section
+
+# Environment variables switching the instrumentation on: the first one is the destination of the JSON lines
+# (a file name, or '-' for the standard error), the second one enables the tracing of the allocated memory
+INSTRUMENTATION_VARIABLE = "DIFFRACTION_INSTRUMENTATION"
+TRACE_MEMORY_VARIABLE = "DIFFRACTION_TRACE_MEMORY"
+
+_settings = {
+    "output": os.environ.get(INSTRUMENTATION_VARIABLE) or None,
+    "trace_memory": os.environ.get(TRACE_MEMORY_VARIABLE, "").lower() in ("1", "true", "yes", "on"),
+}
+
+# Memory frames of the open stages, so that nested stages report their own peak without hiding it to the outer ones
+_memory_stack = []
+
+
+def configure(
+            output : str = None,
+            trace_memory : bool = False
+):
+    """
+    Notes
+    -----
+    This function switches the instrumentation on (or off, with output=None), also for the worker processes
+
+    Parameters
+    ----------
+    output (str) : file where the JSON lines are appended ('-' for the standard error), None disables the instrumentation
+    trace_memory (bool) : if true, the peak memory allocated by every stage is traced with tracemalloc (slower)
+    """
+    _settings["output"] = output
+    _settings["trace_memory"] = bool(trace_memory)
+    export_to_environment({INSTRUMENTATION_VARIABLE: output, TRACE_MEMORY_VARIABLE: "1" if trace_memory else None})
+
+
+def configure_from_config(config_file = 'config.ini'):
+    """
+    Notes
+    -----
+    This function reads the optional [instrumentation] section of a configuration file:
+
+        [instrumentation]
+        output = stages.jsonl
+        trace_memory = no
+
+    The DIFFRACTION_INSTRUMENTATION variable takes precedence over the configuration file.
+
+    Parameters
+    ----------
+    config_file (str or list) : name of the configuration file (or the files of a sweep, which must agree)
+    """
+    section = read_config_section(config_file, 'instrumentation', INSTRUMENTATION_VARIABLE)
+    if section is not None and section.get('output'):
+        configure(section.get('output'), section.getboolean('trace_memory', fallback=False))
+
+
+def is_enabled() -> bool:
+    """
+    Notes
+    -----
+    This function tells whether the instrumentation is switched on
+
+    Returns
+    -------
+    enabled (bool) : True if the stages are recorded
+    """
+    return _settings["output"] is not None
+
+
+def _emit(record : dict):
+    """
+    Notes
+    -----
+    This function writes a record as a JSON line to the instrumentation output
+
+    Parameters
+    ----------
+    record (dict) : the record
+    """
+    line = json.dumps(record) + "\n"
+    if _settings["output"] == "-":
+        sys.stderr.write(line)
+    else:
+        # one append per record: the lines of concurrent processes do not interleave
+        with open(_settings["output"], 'a') as file:
+            file.write(line)
+
+
+@contextmanager
+def stage(
+        name : str,
+        **counts
+):
+    """
+    Notes
+    -----
+    Context manager that records a stage: wall time, CPU time, peak allocated bytes (if the memory is traced)
+    and the given counts (e.g. n_atoms, n_q_points). The yielded dictionary can be completed inside the block.
+    When the instrumentation is switched off nothing is measured.
+
+    Parameters
+    ----------
+    name (str) : name of the stage
+    counts : counts describing the size of the stage
+    """
+    if not is_enabled():
+        yield counts
+        return
+
+    trace_memory = _settings["trace_memory"]
+    if trace_memory:
+        started = not tracemalloc.is_tracing()
+        if started:
+            tracemalloc.start()
+        if _memory_stack:
+            _memory_stack[-1]["peak"] = max(_memory_stack[-1]["peak"], tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+        current = tracemalloc.get_traced_memory()[0]
+        _memory_stack.append({"start": current, "peak": current, "started": started})
+
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    try:
+        yield counts
+    finally:
+        record = {"stage": name, "wall_time": time.perf_counter() - wall_start, "cpu_time": time.process_time() - cpu_start}
+
+        if trace_memory:
+            frame = _memory_stack.pop()
+            peak = max(frame["peak"], tracemalloc.get_traced_memory()[1])
+            if _memory_stack:
+                _memory_stack[-1]["peak"] = max(_memory_stack[-1]["peak"], peak)
+            if frame["started"]:
+                tracemalloc.stop()
+            record["allocated_bytes"] = peak - frame["start"]
+
+        record.update(counts)
+        record.update({"pid": os.getpid(), "timestamp": time.time()})
+        _emit(record)
+
+
+def instrumented(
+            name : str = None,
+            counts = None
+):
+    """
+    Notes
+    -----
+    Decorator recording every call of a function as a stage (see stage). When the instrumentation is switched
+    off, the only overhead is a flag check.
+
+    Parameters
+    ----------
+    name (str) : name of the stage (default: name of the function)
+    counts (callable) : function of (result, arguments) returning the counts of the stage as a dictionary,
+                        arguments being the arguments of the call bound to their names
+    """
+    def decorator(function):
+        stage_name = name or function.__name__
+        signature = inspect.signature(function)
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not is_enabled():
+                return function(*args, **kwargs)
+
+            with stage(stage_name) as record:
+                result = function(*args, **kwargs)
+                if counts is not None:
+                    record.update(counts(result, signature.bind(*args, **kwargs).arguments))
+            return result
+
+        return wrapper
+    return decorator
+
+
+def _atom_count(positions) -> int:
+    """
+    Notes
+    -----
+    This function returns the number of atoms of an (..., n_atoms, 3) array of positions (None if there are none)
+    """
+    if positions is None:
+        return None
+    # a batch of structures has the shape (n_structures, n_atoms, 3)
+    return int(np.shape(positions)[-2]) if np.ndim(positions) > 1 else len(positions)
+
+
+def count_result_atoms(result, arguments : dict) -> dict:
+    """
+    Notes
+    -----
+    Counts of the stages returning atomic positions (for the counts argument of instrumented)
+    """
+    return {"n_atoms": _atom_count(result)}
+
+
+def count_input_atoms(result, arguments : dict) -> dict:
+    """
+    Notes
+    -----
+    Counts of the stages taking the atomic positions as first argument (for the counts argument of instrumented)
+    """
+    return {"n_atoms": _atom_count(next(iter(arguments.values())))}
+
+
+def count_q_points(result, arguments : dict) -> dict:
+    """
+    Notes
+    -----
+    Counts of the stages returning intensities (for the counts argument of instrumented)
+    """
+    return {"n_q_points": int(getattr(result, 'size', len(result)))}
+
+
+@contextmanager
+def profiled(filename : str = None):
+    """
+    Context manager that runs a block under cProfile and writes the statistics (readable with pstats or snakeviz)
+
+    Parameters
+    ----------
+    filename (str) : file of the profile statistics; None disables the profiling
+    """
+    if filename is None:
+        yield
+        return
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(filename)
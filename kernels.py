@@ -0,0 +1,210 @@
+import numpy as np
+
+# Numba is optional: it is imported (about half a second) and the kernels are compiled only when a compiled
+# kernel is first requested. The compiled code is cached on disk (in __pycache__, or in NUMBA_CACHE_DIR),
+# so the compilation is paid once, not on every run.
+_numba = {"module": None, "checked": False}
+_compiled_kernels = {}
+
+# The loops below are plain Python: prange is range until Numba compiles them (see get_kernel)
+prange = range
+
+
+def numba_available() -> bool:
+    """
+    Notes
+    -----
+    This function tells whether Numba is installed, importing it on the first call
+
+    Returns
+    -------
+    available (bool) : True if the compiled kernels can be used
+    """
+    if not _numba["checked"]:
+        _numba["checked"] = True
+        try:
+            import numba
+            _numba["module"] = numba
+        except ImportError:
+            pass
+    return _numba["module"] is not None
+
+
+def _phase_sum_loop(
+                positions : np.ndarray,
+                q_points : np.ndarray,
+                form_factors : np.ndarray,
+                real : np.ndarray,
+                imag : np.ndarray
+):
+    """
+    Notes
+    -----
+    Fused loop of the structure factor F(q) = sum_j f_j exp(2*pi*i q.r_j): the q-points are distributed over
+    the threads and every phase is used as soon as it is computed, without (q, atom) temporary arrays.
+    The sum over the atoms of each q-point runs in a fixed order, so the result does not depend on the
+    number of threads.
+
+    Parameters
+    ----------
+    positions (np.ndarray) : (N, d) array with the atomic positions
+    q_points (np.ndarray) : (M, d) array with the q-points
+    form_factors (np.ndarray) : (N,) array with the scattering factor of each atom
+    real (np.ndarray) : (M,) output array for the real part of F(q)
+    imag (np.ndarray) : (M,) output array for the imaginary part of F(q)
+    """
+    for m in prange(q_points.shape[0]):
+        real_sum = 0.0
+        imag_sum = 0.0
+        for j in range(positions.shape[0]):
+            phase = 0.0
+            for axis in range(positions.shape[1]):
+                phase += q_points[m, axis] * positions[j, axis]
+            phase *= 2 * np.pi
+            real_sum += form_factors[j] * np.cos(phase)
+            imag_sum += form_factors[j] * np.sin(phase)
+        real[m] = real_sum
+        imag[m] = imag_sum
+
+
+def _interference_grid_loop(
+                        h : np.ndarray,
+                        k : np.ndarray,
+                        Na : int,
+                        Nb : int,
+                        intensity : np.ndarray
+):
+    """
+    Notes
+    -----
+    Fused loop of the intensity sin^2(pi*Na*h)/sin^2(pi*h) * sin^2(pi*Nb*k)/sin^2(pi*k) on the grid h x k.
+    Each factor is evaluated once per point of its axis (reduced to [-0.5, 0.5], with the limit N^2 at the
+    zeros of the denominator, as in interference_function) and the products are written directly into the output.
+
+    Parameters
+    ----------
+    h (np.ndarray) : (n,) array with the h coordinates of the grid
+    k (np.ndarray) : (m,) array with the k coordinates of the grid
+    Na (int) : repetitions along the a-axis
+    Nb (int) : repetitions along the b-axis
+    intensity (np.ndarray) : (n, m) output array
+    """
+    factor_k = np.empty(k.shape[0])
+    for j in prange(k.shape[0]):
+        x = k[j] - np.floor(k[j] + 0.5)
+        denominator = np.sin(np.pi * x)
+        factor_k[j] = float(Nb)**2 if denominator == 0 else (np.sin(np.pi * Nb * x) / denominator)**2
+
+    for i in prange(h.shape[0]):
+        x = h[i] - np.floor(h[i] + 0.5)
+        denominator = np.sin(np.pi * x)
+        factor_h = float(Na)**2 if denominator == 0 else (np.sin(np.pi * Na * x) / denominator)**2
+        for j in range(k.shape[0]):
+            intensity[i, j] = factor_h * factor_k[j]
+
+
+# Loops that can be compiled with get_kernel
+KERNELS = {
+    "phase_sum": _phase_sum_loop,
+    "interference_grid": _interference_grid_loop,
+}
+
+
+def get_kernel(
+            name : str,
+            fastmath : bool = False
+):
+    """
+    Notes
+    -----
+    This function returns a kernel compiled by Numba (parallel=True, cache=True), compiling it on the first
+    request. fastmath is off by default: it allows Numba to reorder the sums, so the results would change
+    with the number of threads and differ from the NumPy ones beyond the rounding errors.
+
+    Parameters
+    ----------
+    name (str) : name of the kernel, one of the KERNELS
+    fastmath (bool) : if true, the kernel is compiled with fastmath
+
+    Returns
+    -------
+    kernel (callable) : the compiled kernel, or None if Numba is not installed
+    """
+    if name not in KERNELS:
+        raise ValueError(f"Error: unknown kernel '{name}', use one of {list(KERNELS)}.")
+    if not numba_available():
+        return None
+
+    key = (name, bool(fastmath))
+    if key not in _compiled_kernels:
+        numba = _numba["module"]
+        # the loops read prange when they are compiled: Numba distributes the prange loops over its threads
+        globals()["prange"] = numba.prange
+        _compiled_kernels[key] = numba.njit(parallel=True, fastmath=bool(fastmath), cache=True)(KERNELS[name])
+    return _compiled_kernels[key]
+
+
+def phase_sum(
+            positions : np.ndarray,
+            q_points : np.ndarray,
+            form_factors : np.ndarray,
+            fastmath : bool = False
+) -> np.ndarray:
+    """
+    Notes
+    -----
+    Calculate the structure factor F(q) = sum_j f_j exp(2*pi*i q.r_j) with the compiled fused loop
+
+    Parameters
+    ----------
+    positions (np.ndarray) : (N, d) float64 array with the atomic positions
+    q_points (np.ndarray) : (M, d) float64 array with the q-points (the factor 2*pi is included in the phase)
+    form_factors (np.ndarray) : (N,) float64 array with the scattering factor of each atom
+    fastmath (bool) : if true, the kernel compiled with fastmath is used
+
+    Returns
+    -------
+    structure_factor (np.ndarray) : (M,) complex array with F(q), or None if Numba is not installed
+    """
+    kernel = get_kernel("phase_sum", fastmath)
+    if kernel is None:
+        return None
+
+    real, imag = np.empty(len(q_points)), np.empty(len(q_points))
+    kernel(np.ascontiguousarray(positions, dtype=np.float64), np.ascontiguousarray(q_points, dtype=np.float64),
+           np.ascontiguousarray(form_factors, dtype=np.float64), real, imag)
+    return real + 1j * imag
+
+
+def interference_grid(
+                    h : np.ndarray,
+                    k : np.ndarray,
+                    Na : int,
+                    Nb : int,
+                    fastmath : bool = False
+) -> np.ndarray:
+    """
+    Notes
+    -----
+    Calculate the intensity of calculate_intensity on the grid h x k with the compiled fused loop
+
+    Parameters
+    ----------
+    h (np.ndarray) : (n,) array with the h coordinates of the grid
+    k (np.ndarray) : (m,) array with the k coordinates of the grid
+    Na (int) : repetitions along the a-axis
+    Nb (int) : repetitions along the b-axis
+    fastmath (bool) : if true, the kernel compiled with fastmath is used
+
+    Returns
+    -------
+    intensity (np.ndarray) : (n, m) array, or None if Numba is not installed
+    """
+    kernel = get_kernel("interference_grid", fastmath)
+    if kernel is None:
+        return None
+
+    h, k = np.ascontiguousarray(h, dtype=np.float64), np.ascontiguousarray(k, dtype=np.float64)
+    intensity = np.empty((len(h), len(k)))
+    kernel(h, k, int(Na), int(Nb), intensity)
+    return intensity
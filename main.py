@@ -1,32 +1,143 @@
-import subprocess
-import configparser
-import os
-
-# Read configuration from the 'config.ini' file
-config = configparser.ConfigParser()
-config.read('config.ini')
-
-# Run create_cubic_structure.py to generate the cubic structure
-try:
-    print("Generating the cubic structure...")
-    create_structure_result = subprocess.run(["python", "create_cubic_structure.py"])
-
-    # Check the return code of create_cubic_structure.py
-    if create_structure_result.returncode != 0:
-        raise ValueError("Error occurred in create_cubic_structure.py")
-
-    # Check if the 'cubic_structure_positions.txt' file exists
-    if not os.path.isfile('cubic_structure_positions.txt'):
-        raise FileNotFoundError("Error: 'cubic_structure_positions.txt' file not found after running create_cubic_structure.py.")
-
-    # Run plot_cubic_structure.py to plot the cubic structure
-    print("Plotting the cubic structure...")
-    subprocess.run(["python", "plot_cubic_structure.py"])
-
-    print("Done.")  
-except subprocess.CalledProcessError as e:
-    print(f"Error: Subprocess error occurred - {e}")
-except ValueError as e:
-    print(f"Error: {e}")
-except FileNotFoundError as e:
-    print(f"Error: {e}")
+import argparse
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+import create_cubic_structure as ccs
+import diffraction_pattern as dp
+import instrumentation
+import plot_cubic_structure as pcs
+import result_cache
+
+
+@contextmanager
+def timed_stage(
+            name : str,
+            timings : dict
+):
+    """
+    Notes
+    -----
+    Context manager that measures the wall time of a pipeline stage, stores it in timings and reports it.
+    The stage is also recorded by the instrumentation, when it is switched on: the yielded dictionary
+    collects the counts of its record.
+
+    Parameters
+    ----------
+    name (str) : name of the stage
+    timings (dict) : dictionary where the elapsed time (s) is stored under name
+    """
+    print(f"{name}...")
+    start = time.perf_counter()
+    try:
+        with instrumentation.stage(name) as counts:
+            yield counts
+    finally:
+        timings[name] = time.perf_counter() - start
+        print(f"{name}: {timings[name]:.3f} s")
+
+
+def run_pipeline(
+            parameters : dict,
+            save_files : bool = True,
+            plot : bool = True,
+            save_plots : bool = False
+) -> dict:
+    """
+    Notes
+    -----
+    This function runs the generate, surface, symmetry, intensity and plot stages in a single process,
+    passing the arrays in memory from one stage to the next. Saving the coordinates and the intensity
+    to disk is an optional side output. When the result cache is switched on (see result_cache), the
+    positions, the symmetry properties, the reciprocal mesh and the intensity of an unchanged configuration
+    are read from the cache instead of being computed again.
+
+    Parameters
+    ----------
+    parameters (dict) : configuration parameters, as returned by create_cubic_structure.read_config
+    save_files (bool) : if true, saves the coordinates and the intensity to disk
+    plot (bool) : if true, plots the cubic structure and its surface and writes the diffraction pattern to a PNG file
+    save_plots (bool) : if true, the plots are written to PNG files (headless) instead of being displayed
+
+    Returns
+    -------
+    results (dict) : dictionary with the cubic and surface positions, the symmetry properties,
+                     the intensity, the number of forbidden reflections skipped (evaluations_saved, also
+                     recorded by the instrumentation) and the timings (s) of every stage
+    """
+    p = parameters
+    timings = {}
+
+    with timed_stage("Generating the cubic structure", timings):
+        cubic_positions = result_cache.cached("cubic_positions", p, lambda: ccs.generate_cubic_structure(p["structure"], p["Nx"], p["Ny"], p["Nz"], p["a"]))
+
+    with timed_stage("Generating the surface structure", timings):
+        surface_positions = result_cache.cached("surface_positions", p, lambda: ccs.generate_surface_structure(p["structure"], p["plane"], p["Na"], p["Nb"]))
+        surface_positions_shifted = ccs.shift_surface_coordinates(surface_positions)
+
+    with timed_stage("Checking the symmetry properties", timings):
+        symmetry_properties = result_cache.cached("symmetry_properties", p, lambda: ccs.get_symmetry_properties(
+            surface_positions_shifted, lattice_vectors = ccs.surface_lattice_vectors(p["structure"], p["plane"])))
+
+    with timed_stage("Calculating the intensity", timings) as counts:
+        h, k = np.arange(p["Na"] + 1)[:, None], np.arange(p["Nb"] + 1)[None, :]
+        forbidden = ccs.forbidden_reflections(h, k, symmetry_properties)
+        evaluations_saved = counts["evaluations_saved"] = int(forbidden.sum())
+        intensity = result_cache.cached("intensity", p, lambda: ccs.calculate_intensity(p["Na"], p["Nb"], h, k, forbidden = forbidden), pruned = True)
+
+    if save_files:
+        with timed_stage("Saving the results", timings):
+            ccs.save_atomic_coordinates(cubic_positions, p)
+            ccs.save_atomic_coordinates(surface_positions, p, is_surface = True)
+            ccs.save_intensity(intensity, p)
+
+    if plot:
+        with timed_stage("Plotting the cubic structure", timings):
+            pcs.plot_cubic_structure(cubic_positions, p, filename = f'{ccs.coordinates_basename(p)}.png' if save_plots else None, lattice_parameter = p["a"])
+            pcs.plot_surface_structure(surface_positions, filename = f'{ccs.coordinates_basename(p, is_surface = True)}.png' if save_plots else None)
+
+        with timed_stage("Rendering the diffraction pattern", timings):
+            spot_positions = result_cache.cached("reciprocal_mesh", p, lambda: dp.surface_reciprocal_mesh(p, p["Na"], p["Nb"]))
+            pattern = dp.render_surface_pattern(p, intensity, spot_positions = spot_positions)
+            dp.save_pattern(pattern, f'pattern_{ccs.coordinates_basename(p, is_surface = True)}.png')
+
+    return {
+        "cubic_positions": cubic_positions,
+        "surface_positions": surface_positions,
+        "symmetry_properties": symmetry_properties,
+        "intensity": intensity,
+        "evaluations_saved": evaluations_saved,
+        "timings": timings,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate, analyse and plot a cubic structure and its surface.")
+    parser.add_argument("config_file", nargs="?", default="config.ini", help="configuration file (default: config.ini)")
+    parser.add_argument("--no-save", action="store_true", help="do not write the coordinates and the intensity to disk")
+    parser.add_argument("--no-plot", action="store_true", help="do not plot the structures")
+    parser.add_argument("--save-plots", action="store_true", help="write the plots to PNG files instead of displaying them (no GUI needed)")
+    parser.add_argument("--instrument", default=None, help="append a JSON line per stage to this file ('-' for stderr)")
+    parser.add_argument("--trace-memory", action="store_true", help="record the memory allocated by every stage (with --instrument)")
+    parser.add_argument("--cache", default=None, help="directory of the result cache, reused by the following runs (default: no cache)")
+    parser.add_argument("--cache-size", type=float, default=1024, help="maximum size of the result cache in MB (default: 1024)")
+    parser.add_argument("--profile", default=None, help="run the pipeline under cProfile and write the statistics to this file")
+    args = parser.parse_args()
+
+    instrumentation.configure_from_config(args.config_file)
+    result_cache.configure_from_config(args.config_file)
+    if args.cache:
+        result_cache.configure(args.cache, int(args.cache_size * 2**20))
+    if args.instrument:
+        instrumentation.configure(args.instrument, args.trace_memory)
+
+    try:
+        with instrumentation.profiled(args.profile):
+            results = run_pipeline(ccs.read_config(args.config_file), save_files = not args.no_save, plot = not args.no_plot, save_plots = args.save_plots)
+        print(results["intensity"])
+        print("Done.")
+    except ValueError as e:
+        print(f"Error: {e}")
+    except FileNotFoundError as e:
+        print(f"Error: {e}")
@@ -0,0 +1,199 @@
+import re
+
+import numpy as np
+
+import create_cubic_structure as ccs
+
+
+def _wood_length(length : str) -> float:
+    """
+    Notes
+    -----
+    This function converts a length of the Wood notation ('2', '√3', 'sqrt3', '2√3') into a number
+
+    Parameters
+    ----------
+    length (str) : length of a superstructure vector, in units of the substrate vector
+
+    Returns
+    -------
+    value (float) : the length as a number
+    """
+    match = re.fullmatch(r"(\d*\.?\d*)(?:(?:√|sqrt)(\d+\.?\d*))?", length)
+    if match is None or not any(match.groups()):
+        raise ValueError(f"Error: invalid length '{length}' in the Wood notation.")
+
+    coefficient, root = match.groups()
+    return (float(coefficient) if coefficient else 1.0) * (np.sqrt(float(root)) if root else 1.0)
+
+
+def overlayer_matrix(
+                notation,
+                lattice_vectors : np.ndarray
+) -> np.ndarray:
+    """
+    Notes
+    -----
+    This function returns the matrix M of an overlayer, whose rows are the superstructure vectors in units of the
+    substrate vectors (b_i = M_i1 a_1 + M_i2 a_2). The overlayer can be given in Wood notation, e.g. 'p(2x2)',
+    'c(2x2)', '(√3x√3)R30°' or '(sqrt3xsqrt3)R30', or directly as a 2x2 integer matrix.
+    Centred cells are converted to their primitive cell.
+
+    Parameters
+    ----------
+    notation (str or np.ndarray) : Wood notation or 2x2 matrix of the overlayer
+    lattice_vectors (np.ndarray) : (2, 2) array whose rows are the substrate lattice vectors
+
+    Returns
+    -------
+    matrix (np.ndarray) : (2, 2) integer array M
+    """
+    lattice_vectors = np.asarray(lattice_vectors, dtype=np.float64)
+
+    if isinstance(notation, str):
+        match = re.fullmatch(r"([pc]?)\((\S+?)[x×](\S+?)\)(?:R(\d+\.?\d*)°?)?", notation.replace(" ", ""))
+        if match is None:
+            raise ValueError(f"Error: invalid Wood notation '{notation}'.")
+        centring, length_a, length_b, angle = match.groups()
+
+        # superstructure vectors: the substrate vectors scaled and rotated
+        angle = np.radians(float(angle)) if angle else 0.0
+        rotation = np.array([[np.cos(angle), np.sin(angle)], [-np.sin(angle), np.cos(angle)]])
+        superstructure = np.diag([_wood_length(length_a), _wood_length(length_b)]) @ lattice_vectors @ rotation
+        matrix = superstructure @ np.linalg.inv(lattice_vectors)
+
+        if centring == 'c':
+            matrix = np.array([[0.5, 0.5], [-0.5, 0.5]]) @ matrix
+    else:
+        matrix = np.asarray(notation, dtype=np.float64)
+
+    if matrix.shape != (2, 2) or not np.allclose(matrix, np.round(matrix), atol=1e-6) or round(abs(np.linalg.det(matrix))) == 0:
+        raise ValueError(f"Error: the overlayer {notation} is not commensurate with the substrate.")
+
+    return np.round(matrix).astype(np.int64)
+
+
+def _cell_lattice_points(matrix : np.ndarray) -> np.ndarray:
+    """
+    Notes
+    -----
+    This function returns the substrate lattice points lying inside one superstructure cell
+
+    Parameters
+    ----------
+    matrix (np.ndarray) : (2, 2) integer overlayer matrix
+
+    Returns
+    -------
+    points (np.ndarray) : (|det M|, 2) integer array with the points in units of the substrate vectors
+    """
+    corners = np.array([[0, 0], [1, 0], [0, 1], [1, 1]]) @ matrix
+    low, high = corners.min(axis=0), corners.max(axis=0)
+    grid = np.stack(np.meshgrid(np.arange(low[0], high[0] + 1), np.arange(low[1], high[1] + 1), indexing='ij'), axis=-1).reshape(-1, 2)
+
+    # keep the points with fractional coordinates of the superstructure cell in [0, 1)
+    fractional = grid @ np.linalg.inv(matrix)
+    inside = np.all((fractional > -1e-9) & (fractional < 1 - 1e-9), axis=1)
+    return grid[inside]
+
+
+def build_overlayer(
+                lattice_vectors : np.ndarray,
+                notation,
+                sites : np.ndarray,
+                Na : int,
+                Nb : int,
+                substrate_basis : np.ndarray = ((0.0, 0.0),)
+) -> dict:
+    """
+    Notes
+    -----
+    This function builds a substrate surface covered by a commensurate overlayer (adsorbates or reconstruction).
+    The atoms of one superstructure cell are computed once and tiled over Na x Nb cells by broadcasting.
+
+    Parameters
+    ----------
+    lattice_vectors (np.ndarray) : (2, 2) array whose rows are the substrate lattice vectors
+                                   (e.g. surface_lattice_vectors or surface_unit_cell)
+    notation (str or np.ndarray) : Wood notation or 2x2 matrix of the overlayer (see overlayer_matrix)
+    sites (np.ndarray) : (n, 2) adsorption sites of one superstructure cell, in units of the substrate vectors
+                         (e.g. [[1/3, 1/3]] for a hollow site of a (111) surface)
+    Na (int) : number of superstructure cells along the first superstructure vector
+    Nb (int) : number of superstructure cells along the second superstructure vector
+    substrate_basis (np.ndarray) : atoms of the substrate cell, in units of the substrate vectors
+
+    Returns
+    -------
+    overlayer (dict) : dictionary with the substrate and adsorbate positions (substrate_positions, adsorbate_positions),
+                       all the positions (positions, substrate first), the overlayer matrix (matrix) and the
+                       superstructure lattice vectors (lattice_vectors)
+    """
+    lattice_vectors = np.asarray(lattice_vectors, dtype=np.float64)
+    matrix = overlayer_matrix(notation, lattice_vectors)
+    superstructure = matrix @ lattice_vectors
+
+    # translations of the superstructure cells
+    cells = np.stack(np.meshgrid(np.arange(Na), np.arange(Nb), indexing='ij'), axis=-1).reshape(-1, 2) @ superstructure
+
+    # atoms of one superstructure cell, in cartesian coordinates
+    substrate = (_cell_lattice_points(matrix)[:, None, :] + np.asarray(substrate_basis)[None, :, :]).reshape(-1, 2) @ lattice_vectors
+    adsorbates = np.atleast_2d(np.asarray(sites, dtype=np.float64)) @ lattice_vectors
+
+    substrate_positions = (cells[:, None, :] + substrate[None, :, :]).reshape(-1, 2)
+    adsorbate_positions = (cells[:, None, :] + adsorbates[None, :, :]).reshape(-1, 2)
+
+    return {
+        "substrate_positions": substrate_positions,
+        "adsorbate_positions": adsorbate_positions,
+        "positions": np.concatenate([substrate_positions, adsorbate_positions]),
+        "matrix": matrix,
+        "lattice_vectors": superstructure,
+    }
+
+
+def superstructure_spots(
+                    matrix : np.ndarray,
+                    n_max : int = 2,
+                    lattice_vectors : np.ndarray = None
+) -> dict:
+    """
+    Notes
+    -----
+    This function indexes the diffraction spots of an overlayer analytically: the superstructure reciprocal vectors
+    are the rows of (M^-1)^T in units of the substrate reciprocal vectors, so the spot (p, q) of the overlayer has
+    substrate indices (h, k) = (p, q) (M^-1)^T. Only the integer points (p, q) mapping inside the requested window
+    are generated. If the substrate lattice vectors are given, the spots of all the rotational and mirror domains
+    of the overlayer (M W for every point operation W of the substrate lattice) are included.
+
+    Parameters
+    ----------
+    matrix (np.ndarray) : (2, 2) integer overlayer matrix (see overlayer_matrix)
+    n_max (int) : the spots with |h|, |k| <= n_max are returned
+    lattice_vectors (np.ndarray, optional) : (2, 2) array whose rows are the substrate lattice vectors
+
+    Returns
+    -------
+    spots (dict) : dictionary with the (h, k) indices of the spots in substrate units (hk), sorted and without
+                   repetitions, and a mask of the integer-order spots (integer_order)
+    """
+    matrix = np.asarray(matrix)
+    if lattice_vectors is None:
+        domains = [matrix]
+    else:
+        domains = [matrix @ W for W in ccs._lattice_point_operations(np.asarray(lattice_vectors, dtype=np.float64))]
+
+    window = np.array([[-1, -1], [-1, 1], [1, -1], [1, 1]]) * n_max
+    spots = []
+    for domain in domains:
+        # (p, q) = (h, k) M^T: bounding box of the window in superstructure indices
+        corners = window @ domain.T
+        low, high = corners.min(axis=0), corners.max(axis=0)
+        pq = np.stack(np.meshgrid(np.arange(low[0], high[0] + 1), np.arange(low[1], high[1] + 1), indexing='ij'), axis=-1).reshape(-1, 2)
+        hk = pq @ np.linalg.inv(domain).T
+        spots.append(hk[np.all(np.abs(hk) <= n_max + 1e-9, axis=1)])
+
+    hk = np.unique(np.round(np.concatenate(spots), 9) + 0.0, axis=0)
+    return {
+        "hk": hk,
+        "integer_order": np.all(np.isclose(hk, np.round(hk)), axis=1),
+    }
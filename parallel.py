@@ -0,0 +1,168 @@
+import os
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+
+from settings import export_to_environment, read_config_section
+
+# Environment variables selecting the backend of the parallel computations and the number of workers
+EXECUTOR_VARIABLE = "DIFFRACTION_EXECUTOR"
+WORKERS_VARIABLE = "DIFFRACTION_WORKERS"
+
+# Available backends: 'threads' relies on NumPy releasing the GIL in the ufuncs and in the BLAS products,
+# 'processes' on worker processes reading their inputs from memory mapped files
+BACKENDS = ("serial", "threads", "processes")
+
+_settings = {
+    "executor": os.environ.get(EXECUTOR_VARIABLE) or "serial",
+    "max_workers": int(os.environ.get(WORKERS_VARIABLE) or 0) or None,
+}
+
+
+def configure(
+            executor : str = "serial",
+            max_workers : int = None
+):
+    """
+    Notes
+    -----
+    This function selects the default backend of the parallel computations and the number of workers
+
+    Parameters
+    ----------
+    executor (str) : 'serial', 'threads' or 'processes'
+    max_workers (int) : number of workers (None uses the number of processors)
+    """
+    if executor not in BACKENDS:
+        raise ValueError(f"Error: unknown executor '{executor}', use one of {list(BACKENDS)}.")
+
+    _settings["executor"] = executor
+    _settings["max_workers"] = max_workers
+    export_to_environment({EXECUTOR_VARIABLE: executor, WORKERS_VARIABLE: max_workers})
+
+
+def configure_from_config(config_file = 'config.ini'):
+    """
+    Notes
+    -----
+    This function reads the optional [parallel] section of a configuration file:
+
+        [parallel]
+        executor = threads
+        workers = 64
+
+    Nothing is changed when DIFFRACTION_EXECUTOR is set.
+
+    Parameters
+    ----------
+    config_file (str or list) : name of the configuration file (or several files, which must agree)
+    """
+    section = read_config_section(config_file, 'parallel', EXECUTOR_VARIABLE)
+    if section is not None:
+        configure(section.get('executor', fallback='serial'), section.getint('workers', fallback=0) or None)
+
+
+def worker_count(
+            executor = None,
+            max_workers : int = None
+) -> int:
+    """
+    Notes
+    -----
+    This function returns the number of workers that run the tasks in parallel
+
+    Parameters
+    ----------
+    executor (str or concurrent.futures.Executor) : backend, an executor, or None for the configured backend
+    max_workers (int) : number of workers (None for the configured number, or the number of processors)
+
+    Returns
+    -------
+    n_workers (int) : number of workers (1 for the serial backend)
+    """
+    executor = _settings["executor"] if executor is None else executor
+    if executor == "serial":
+        return 1
+    if isinstance(executor, Executor):
+        return getattr(executor, '_max_workers', None) or os.cpu_count() or 1
+    return max_workers or _settings["max_workers"] or os.cpu_count() or 1
+
+
+def uses_processes(executor = None) -> bool:
+    """
+    Notes
+    -----
+    This function tells whether the tasks run in other processes, which need their inputs in shared files
+
+    Parameters
+    ----------
+    executor (str or concurrent.futures.Executor) : backend, an executor, or None for the configured backend
+
+    Returns
+    -------
+    processes (bool) : True for the 'processes' backend and the process pools
+    """
+    executor = _settings["executor"] if executor is None else executor
+    return executor == "processes" or isinstance(executor, ProcessPoolExecutor)
+
+
+@contextmanager
+def get_executor(
+            executor = None,
+            max_workers : int = None
+):
+    """
+    Notes
+    -----
+    Context manager yielding the executor of a parallel computation: None for the serial backend, a new
+    thread or process pool (shut down at the end of the block), or the given executor, which is left open
+    so that it can be reused across calls
+
+    Parameters
+    ----------
+    executor (str or concurrent.futures.Executor) : 'serial', 'threads', 'processes', an executor,
+                                                    or None for the configured backend
+    max_workers (int) : number of workers (None for the configured number, or the number of processors)
+    """
+    executor = _settings["executor"] if executor is None else executor
+
+    if isinstance(executor, Executor):
+        yield executor
+    elif executor == "serial":
+        yield None
+    elif executor in ("threads", "processes"):
+        pool = (ThreadPoolExecutor if executor == "threads" else ProcessPoolExecutor)(max_workers=worker_count(executor, max_workers))
+        try:
+            yield pool
+        finally:
+            pool.shutdown()
+    else:
+        raise ValueError(f"Error: unknown executor '{executor}', use one of {list(BACKENDS)} or a concurrent.futures.Executor.")
+
+
+def ordered_map(
+            function,
+            tasks : list,
+            executor = None,
+            max_workers : int = None
+) -> list:
+    """
+    Notes
+    -----
+    This function runs function(*task) for every task and returns the results in the order of the tasks,
+    whatever the order in which the workers complete them
+
+    Parameters
+    ----------
+    function (callable) : function to run (a module level function for the 'processes' backend)
+    tasks (list) : list of tuples with the arguments of every call
+    executor (str or concurrent.futures.Executor) : backend, an executor, or None for the configured backend
+    max_workers (int) : number of workers
+
+    Returns
+    -------
+    results (list) : results of the calls, in the order of the tasks
+    """
+    with get_executor(executor, max_workers) as pool:
+        if pool is None or len(tasks) < 2:
+            return [function(*task) for task in tasks]
+        return list(pool.map(function, *zip(*tasks)))
@@ -1,157 +1,243 @@
-import matplotlib.pyplot as plt
-from mpl_toolkits.mplot3d import Axes3D
 import numpy as np
-import configparser
+import argparse
 import os
+from create_cubic_structure import read_config, coordinates_basename
+from instrumentation import instrumented, count_input_atoms
 
-# Read configuration from the 'config.ini' file
-config = configparser.ConfigParser()
-config.read('config.ini')
-
-# Extract element symbol from configuration
-element_symbol = config.get('element', 'symbol')
-
-# Extract lattice parameter a from configuration
-a_string = config.get('lattice_parameter', 'a')
-a = float(a_string)
-
-# Extract cubic structure
-cubic_structure = config.get('cubic_structure', 'type').lower()
-
-# Extract the number of repetitions along each axis
-Nx_string = config.get('repetitions', 'Nx')
-Ny_string = config.get('repetitions', 'Ny')
-Nz_string = config.get('repetitions', 'Nz')
-Nx = int(Nx_string)
-Ny = int(Ny_string)
-Nz = int(Nz_string)
+def read_coordinates(basename : str) -> np.ndarray:
+    """
+    Notes
+    -----
+    This function opens the atomic coordinates saved by create_cubic_structure.py. The binary .npy file
+    is memory mapped, so that large structures are not parsed nor copied; the .txt export is used as fallback.
 
-# Extract information on the surface to visualize
-plane = config.get('surface', 'plane')
+    Parameters
+    ----------
+    basename (str) : name of the file without extension
 
-Na_string = config.get('surface_repetitions', 'Na')
-Nb_string = config.get('surface_repetitions', 'Nb')
-Na = int(Na_string)
-Nb = int(Nb_string)
+    Returns
+    -------
+    positions (np.ndarray) : array containing the atomic positions (read-only when memory mapped)
+    """
+    if os.path.isfile(basename + '.npy'):
+        return np.load(basename + '.npy', mmap_mode='r')
+    elif os.path.isfile(basename + '.txt'):
+        return np.loadtxt(basename + '.txt')
+    else:
+        raise FileNotFoundError(f"Error: '{basename}.npy' file not found. Run create_cubic_structure.py first.")
 
-def get_cubic_coordinates():
+def get_cubic_coordinates(parameters : dict):
     """
     Notes
     -----
-    This function checks if the file containing the cubic atomic coordinates (3D) exists and it gets them
+    This function checks if the file containing the cubic atomic coordinates (3D) exists and it gets them.
+    The positions are not renormalized here, so that a memory mapped file is not copied: pass
+    lattice_parameter = parameters["a"] to plot_cubic_structure, which scales the decimated positions only.
+
+    Parameters
+    ----------
+    parameters (dict) : configuration parameters, as returned by create_cubic_structure.read_config
     
     Returns
     -------
-    cubic_positions (np.ndarray) : 
+    cubic_positions (np.ndarray) : atomic positions (Å), memory mapped for the .npy files
     """
-    # Check if the 'cubic_structure_positions.txt' file exists
-    filename = f'{element_symbol}_{cubic_structure}_a{a}__Nx{Nx}_Ny{Ny}_Nz{Nz}.txt'
-    if not os.path.isfile(filename):
-        raise FileNotFoundError(f"Error: '{filename}' file not found. Run create_cubic_structure.py first.")
-
     # Read atomic positions from the file
-    cubic_positions = np.loadtxt(filename)
-    cubic_positions /= a  # renormalize the cubic structure to the lattice parameter
+    cubic_positions = read_coordinates(coordinates_basename(parameters))
 
     return cubic_positions
 
-def get_surface_coordinates():
+def get_surface_coordinates(parameters : dict):
     """
     Notes
     -----
     This function checks if the file containing the surface atomic coordinates (2D) exists and it gets them
+
+    Parameters
+    ----------
+    parameters (dict) : configuration parameters, as returned by create_cubic_structure.read_config
     
     Returns
     -------
-    surface_positions (np.ndarray) : 
+    surface_positions (np.ndarray) : atomic positions of the surface
     """
-    # Check if the 'cubic_structure_positions.txt' file exists
-    filename = f'{element_symbol}({plane})_{cubic_structure}_a{a}__Na{Na}_Nb{Nb}.txt'
-    if not os.path.isfile(filename):
-        raise FileNotFoundError(f"Error: '{filename}' file not found. Run create_cubic_structure.py first.")
-
     #a_surface = a/2*np.sqrt(2)
     # Read atomic positions from the file
-    surface_positions = np.loadtxt(filename)
+    surface_positions = read_coordinates(coordinates_basename(parameters, is_surface=True))
     #surface_positions /= a_surface  # renormalize the cubic structure to the lattice parameter
 
     return surface_positions
 
 
-def plot_cubic_structure(filename : str =None):
+def _new_figure(filename : str = None):
+    """
+    Notes
+    -----
+    This function creates the figure of a plot: when the plot is written to a file, the figure is attached
+    directly to an Agg canvas, without pyplot and without any GUI, so that it also works on headless nodes
+
+    Parameters
+    ----------
+    filename (str, optional) : name of the image file
+
+    Returns
+    -------
+    fig (matplotlib.figure.Figure) : the new figure
+    """
+    # matplotlib is imported only when a plot is requested, so that importing this module stays fast
+    if filename:
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        from matplotlib.figure import Figure
+
+        fig = Figure()
+        FigureCanvasAgg(fig)
+        return fig
+
+    import matplotlib.pyplot as plt
+    return plt.figure()
+
+def _show_or_save(
+                fig,
+                filename : str = None,
+                dpi : int = 150
+):
+    """
+    Notes
+    -----
+    This function writes the figure to an image file, or displays it if no file name is given
+
+    Parameters
+    ----------
+    fig (matplotlib.figure.Figure) : the figure
+    filename (str, optional) : name of the image file
+    dpi (int) : resolution of the image file
+    """
+    if filename:
+        fig.savefig(filename, dpi=dpi)
+    else:
+        import matplotlib.pyplot as plt
+        plt.show()
+
+def decimate_positions(
+                    positions : np.ndarray,
+                    max_atoms : int = None
+) -> np.ndarray:
+    """
+    Notes
+    -----
+    This function reduces the number of atoms to plot (level of detail) by keeping one atom every
+    ceil(N / max_atoms); slicing with a stride does not copy memory mapped coordinates
+
+    Parameters
+    ----------
+    positions (np.ndarray) : atomic positions
+    max_atoms (int, optional) : maximum number of atoms to keep (None keeps all of them)
+
+    Returns
+    -------
+    positions (np.ndarray) : the decimated positions
+    """
+    if max_atoms is None or len(positions) <= max_atoms:
+        return positions
+    return positions[::int(np.ceil(len(positions) / max_atoms))]
+
+@instrumented(counts=count_input_atoms)
+def plot_cubic_structure(
+                        cubic_positions : np.ndarray,
+                        parameters : dict,
+                        filename : str = None,
+                        max_atoms : int = None,
+                        projection : str = '3d',
+                        lattice_parameter : float = 1.0
+):
     """
     Create a 3D plot of the cubic structure.
+    For large structures, max_atoms limits the number of plotted atoms and projection='top' draws a 2D view
+    from above, with the atoms sorted by depth (the top layer drawn last) and coloured by height, which is
+    much faster than the 3D scatter. With a filename the plot is rendered headless (Agg) and written to disk.
 
     Parameters
     ----------
+    - cubic_positions (np.ndarray): atomic positions in units of lattice_parameter
+    - parameters (dict): configuration parameters, as returned by create_cubic_structure.read_config
     - filename (str, optional): The name of the file to save the plot as image
+    - max_atoms (int, optional): maximum number of atoms to plot (level of detail)
+    - projection (str, optional): '3d' for the 3D scatter plot, 'top' for the depth-sorted projection on the ab plane
+    - lattice_parameter (float, optional): the positions are divided by it after the decimation (e.g. positions in Å
+      with lattice_parameter = parameters["a"]), so that only the plotted atoms are read from a memory mapped file
     """
-    cubic_positions = get_cubic_coordinates()
+    if projection not in ('3d', 'top'):
+        raise ValueError(f"Error: unknown projection '{projection}', use '3d' or 'top'.")
 
-    # Initialize variables to store selected atom indices and their colors
-    atom_colors = ['r'] * len(cubic_positions)  # Initialize all atoms as red
+    positions = np.asarray(decimate_positions(cubic_positions, max_atoms)) / lattice_parameter
+    marker_size = 100 if len(positions) <= 1000 else max(1, 100 * 1000 / len(positions))
 
-    # Create a 3D plot
-    fig = plt.figure()
-    ax = fig.add_subplot(111, projection='3d')
+    fig = _new_figure(filename)
 
-    # Scatter plot of atom positions with colors
-    sc = ax.scatter(cubic_positions[:, 0], cubic_positions[:, 1], cubic_positions[:, 2], c=atom_colors, marker='o', s=100)
+    if projection == '3d':
+        ax = fig.add_subplot(111, projection='3d')
+
+        # Scatter plot of atom positions, with a single colour for all the atoms
+        ax.scatter(positions[:, 0], positions[:, 1], positions[:, 2], c='r', marker='o', s=marker_size)
+
+        ax.set_zlabel('c (au)')
+        ax.set_zlim(0, np.max(positions[:, 2]))
+    else:
+        ax = fig.add_subplot(111)
+
+        # Painter's algorithm: draw the atoms from the bottom to the top layer
+        order = np.argsort(positions[:, 2], kind='stable')
+        ax.scatter(positions[order, 0], positions[order, 1], c=positions[order, 2], cmap='Reds', marker='o', s=marker_size)
+        ax.set_aspect('equal')
 
     # Set axis labels
     ax.set_xlabel('a (au)')
     ax.set_ylabel('b (au)')
-    ax.set_zlabel('c (au)')
 
     # Set plot limits
-    ax.set_xlim(0, np.max(cubic_positions[:, 0]))
-    ax.set_ylim(0, np.max(cubic_positions[:, 1]))
-    ax.set_zlim(0, np.max(cubic_positions[:, 2]))
+    ax.set_xlim(0, np.max(positions[:, 0]))
+    ax.set_ylim(0, np.max(positions[:, 1]))
 
     # Title with element symbol
-    plot_title = f'{element_symbol} {cubic_structure} lattice with a = {a} Å'
-    plt.title(plot_title)
+    ax.set_title(f'{parameters["element"]} {parameters["structure"]} lattice with a = {parameters["a"]} Å')
 
     # Display or save the plot
-    if filename:
-        plt.savefig(filename)
-    else:
-        plt.show()
-
-def plot_surface_structure(filename : str = None):
+    _show_or_save(fig, filename)
+
+@instrumented(counts=count_input_atoms)
+def plot_surface_structure(
+                        surface_positions : np.ndarray,
+                        filename : str = None,
+                        max_atoms : int = None
+):
     """
     Create and optionally save a 2D plot of the (111) surface of the cubic structure.
 
     Parameters
     ----------
-    - filename (str, optional): The name of the file to save the plot as image
+    - surface_positions (np.ndarray): atomic positions of the surface
+    - filename (str, optional): The name of the file to save the plot as image (rendered headless)
+    - max_atoms (int, optional): maximum number of atoms to plot (level of detail)
     """
-
-    surface_positions = get_surface_coordinates()
-
-    # Extract the x and y coordinates of the atomic positions
-    x = surface_positions[:, 0]
-    y = surface_positions[:, 1]
+    positions = np.asarray(decimate_positions(surface_positions, max_atoms))
+    marker_size = 100 if len(positions) <= 1000 else max(1, 100 * 1000 / len(positions))
 
     # Create a 2D plot for the (111) surface view
-    fig = plt.figure()
+    fig = _new_figure(filename)
     ax = fig.add_subplot(111)
 
     # Scatter plot of atom positions with colors
-    sc = ax.scatter(x, y, c='r', marker='o', s=100)
+    ax.scatter(positions[:, 0], positions[:, 1], c='r', marker='o', s=marker_size)
 
     # Set axis labels
     ax.set_xlabel('a (au)')
     ax.set_ylabel('b (au)')
 
     # Title for the (111) surface
-    plt.title('Surface (111) View')
+    ax.set_title('Surface (111) View')
 
     # Display or save the plot
-    if filename:
-        plt.savefig(filename)
-    else:
-        plt.show()
+    _show_or_save(fig, filename)
 
 # def save_cubic_structure_plot(filename: str):
 #     """
@@ -179,7 +265,7 @@ def plot_surface_structure(filename : str = None):
 #     ax.set_zlim(0, np.max(cubic_positions[:, 2]))
 
 #     # Title with element symbol
-#     plot_title = f'{element_symbol} {cubic_structure} lattice with a = {a} Å'
+#     plot_title = f'{parameters["element"]} {parameters["structure"]} lattice with a = {parameters["a"]} Å'
 #     plt.title(plot_title)
 
 #     # Save the plot as an image file
@@ -187,9 +273,20 @@ def plot_surface_structure(filename : str = None):
 
 
 
-# Call the functions
-plot_cubic_structure()
-plot_surface_structure()
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Plot the cubic structure and its surface saved by create_cubic_structure.py.")
+    parser.add_argument("config_file", nargs="?", default="config.ini", help="configuration file (default: config.ini)")
+    parser.add_argument("--save", action="store_true", help="write the plots to PNG files instead of displaying them (no GUI needed)")
+    parser.add_argument("--max-atoms", type=int, default=None, help="maximum number of atoms to plot (default: all)")
+    parser.add_argument("--projection", choices=["3d", "top"], default="3d", help="3D scatter or depth-sorted top view of the cubic structure")
+    args = parser.parse_args()
+    parameters = read_config(args.config_file)
+
+    # Call the functions
+    plot_cubic_structure(get_cubic_coordinates(parameters), parameters, filename = f'{coordinates_basename(parameters)}.png' if args.save else None,
+                         max_atoms = args.max_atoms, projection = args.projection, lattice_parameter = parameters["a"])
+    plot_surface_structure(get_surface_coordinates(parameters), filename = f'{coordinates_basename(parameters, is_surface=True)}.png' if args.save else None,
+                           max_atoms = args.max_atoms)
 
 # plotname = f'{element_symbol}_{cubic_structure}_a{a}__Nx{Nx}_Ny{Ny}_Nz{Nz}.png'
 # save_cubic_structure_plot(plotname)
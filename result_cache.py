@@ -0,0 +1,402 @@
+import functools
+import hashlib
+import importlib.util
+import json
+import os
+import tempfile
+
+import numpy as np
+
+from settings import export_to_environment, read_config_section
+
+# Environment variables switching the cache on: the first one is the cache directory, the second one its maximum
+# size in bytes
+CACHE_VARIABLE = "DIFFRACTION_CACHE"
+CACHE_SIZE_VARIABLE = "DIFFRACTION_CACHE_SIZE"
+
+# Default maximum size of the cache (bytes): beyond it the least recently used results are removed
+DEFAULT_MAX_BYTES = 2**30
+
+# Parameters that determine every kind of cached result: configurations differing only in the other
+# parameters (e.g. the element) share the same entries
+KEY_PARAMETERS = {
+    "cubic_positions": ("structure", "Nx", "Ny", "Nz", "a"),
+    "surface_positions": ("structure", "plane", "Na", "Nb"),
+    "symmetry_properties": ("structure", "plane", "Na", "Nb"),
+    "reciprocal_mesh": ("structure", "plane", "Na", "Nb"),
+    "intensity": ("structure", "plane", "Na", "Nb"),
+}
+
+# Modules whose source is part of the key: the modules computing the cached results (and the compiled kernels) and
+# the pipelines passing their arguments; editing them invalidates the stored results
+CODE_MODULES = ("create_cubic_structure", "kernels", "diffraction_pattern", "main", "sweep")
+
+_settings = {
+    "directory": os.environ.get(CACHE_VARIABLE) or None,
+    "max_bytes": int(os.environ.get(CACHE_SIZE_VARIABLE) or DEFAULT_MAX_BYTES),
+}
+_cache_statistics = {"hits": 0, "misses": 0}
+
+
+def configure(
+            directory : str = None,
+            max_bytes : int = DEFAULT_MAX_BYTES
+):
+    """
+    Notes
+    -----
+    This function switches the result cache on (or off, with directory=None)
+
+    Parameters
+    ----------
+    directory (str) : directory of the cache (created if needed), None disables the cache
+    max_bytes (int) : maximum size of the cache in bytes
+    """
+    _settings["directory"] = directory
+    _settings["max_bytes"] = int(max_bytes)
+    export_to_environment({CACHE_VARIABLE: directory, CACHE_SIZE_VARIABLE: int(max_bytes) if directory else None})
+
+
+def configure_from_config(config_file = 'config.ini'):
+    """
+    Notes
+    -----
+    This function reads the optional [cache] section of a configuration file:
+
+        [cache]
+        directory = .diffraction_cache
+        max_megabytes = 1024
+
+    A cache directory given by DIFFRACTION_CACHE is used instead.
+
+    Parameters
+    ----------
+    config_file (str or list) : name of the configuration file (or the files of a sweep, which must agree)
+    """
+    section = read_config_section(config_file, 'cache', CACHE_VARIABLE)
+    if section is not None and section.get('directory'):
+        max_megabytes = section.getfloat('max_megabytes', fallback=DEFAULT_MAX_BYTES / 2**20)
+        configure(section.get('directory'), int(max_megabytes * 2**20))
+
+
+def is_enabled() -> bool:
+    """
+    Notes
+    -----
+    This function tells whether the result cache is switched on
+
+    Returns
+    -------
+    enabled (bool) : True if the results are stored on disk
+    """
+    return _settings["directory"] is not None
+
+
+@functools.lru_cache(maxsize=None)
+def code_version() -> str:
+    """
+    Notes
+    -----
+    This function returns a hash of the source of the CODE_MODULES, so that the results computed by
+    another version of the code are never reused
+
+    Returns
+    -------
+    version (str) : hexadecimal digest of the sources
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for module in CODE_MODULES:
+        with open(importlib.util.find_spec(module).origin, 'rb') as file:
+            digest.update(file.read())
+    return digest.hexdigest()
+
+
+def cache_key(
+            kind : str,
+            parameters : dict,
+            **options
+) -> str:
+    """
+    Notes
+    -----
+    This function returns the content address of a result: a hash of its kind, of the parameters it
+    depends on (KEY_PARAMETERS), of the options of the computation and of the code version
+
+    Parameters
+    ----------
+    kind (str) : kind of result, one of the KEY_PARAMETERS
+    parameters (dict) : configuration parameters, as returned by read_config
+    options : further arguments the result depends on (e.g. pruned=True)
+
+    Returns
+    -------
+    key (str) : hexadecimal key of the result
+    """
+    if kind not in KEY_PARAMETERS:
+        raise ValueError(f"Error: unknown kind of result '{kind}', use one of {list(KEY_PARAMETERS)}.")
+
+    description = {
+        "kind": kind,
+        "parameters": {key: parameters[key] for key in KEY_PARAMETERS[kind]},
+        "options": options,
+        "code_version": code_version(),
+    }
+    return hashlib.blake2b(json.dumps(description, sort_keys=True, default=str).encode(), digest_size=20).hexdigest()
+
+
+def _entry_path(
+            kind : str,
+            key : str
+) -> str:
+    """
+    Notes
+    -----
+    This function returns the name of the cache file of a result
+    """
+    return os.path.join(_settings["directory"], kind, key + '.npz')
+
+
+def _encode(result) -> dict:
+    """
+    Notes
+    -----
+    This function converts a result (an array, or a dictionary of arrays, scalars, strings, None and lists of
+    (A, t) symmetry operations) into arrays that can be stored in a npz file without pickling
+
+    Parameters
+    ----------
+    result (np.ndarray or dict) : the result
+
+    Returns
+    -------
+    arrays (dict) : arrays of the npz file, with the description of the result under 'layout'
+    """
+    if isinstance(result, np.ndarray):
+        return {"layout": np.array(json.dumps(None)), "array": result}
+
+    arrays, layout = {}, {}
+    for name, value in result.items():
+        if isinstance(value, np.ndarray):
+            layout[name] = "array"
+            arrays["array_" + name] = value
+        elif isinstance(value, list) and value and isinstance(value[0], tuple):
+            layout[name] = "operations"
+            arrays["rotations_" + name] = np.array([A for A, t in value])
+            arrays["translations_" + name] = np.array([t for A, t in value])
+        else:
+            layout[name] = ["value", value.item() if isinstance(value, np.generic) else value]
+
+    arrays["layout"] = np.array(json.dumps(layout))
+    return arrays
+
+
+def _decode(data) -> object:
+    """
+    Notes
+    -----
+    This function rebuilds a result converted by _encode
+
+    Parameters
+    ----------
+    data (np.lib.npyio.NpzFile) : the opened npz file
+
+    Returns
+    -------
+    result (np.ndarray or dict) : the result
+    """
+    layout = json.loads(str(data["layout"]))
+    if layout is None:
+        return data["array"]
+
+    result = {}
+    for name, kind in layout.items():
+        if kind == "array":
+            result[name] = data["array_" + name]
+        elif kind == "operations":
+            result[name] = list(zip(data["rotations_" + name], data["translations_" + name]))
+        else:
+            result[name] = kind[1]
+    return result
+
+
+def load(
+        kind : str,
+        key : str
+):
+    """
+    Notes
+    -----
+    This function reads a result from the cache and marks it as recently used
+
+    Parameters
+    ----------
+    kind (str) : kind of result
+    key (str) : key of the result, as returned by cache_key
+
+    Returns
+    -------
+    result (np.ndarray or dict) : the stored result, or None if it is not in the cache
+    """
+    path = _entry_path(kind, key)
+    try:
+        with np.load(path) as data:
+            result = _decode(data)
+        # the modification time orders the entries for the eviction (the access time is often not updated)
+        os.utime(path)
+    except (FileNotFoundError, ValueError, KeyError, OSError):
+        # missing, evicted meanwhile by another process, or unreadable: computed again
+        return None
+    return result
+
+
+def store(
+        kind : str,
+        key : str,
+        result
+) -> str:
+    """
+    Notes
+    -----
+    This function writes a result to the cache. The file is written under a temporary name and renamed,
+    so that concurrent jobs never read a partial entry; the least recently used entries are then evicted.
+
+    Parameters
+    ----------
+    kind (str) : kind of result
+    key (str) : key of the result, as returned by cache_key
+    result (np.ndarray or dict) : the result
+
+    Returns
+    -------
+    path (str) : name of the cache file
+    """
+    path = _entry_path(kind, key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    file = tempfile.NamedTemporaryFile(dir=os.path.dirname(path), prefix='.' + key, suffix='.tmp', delete=False)
+    try:
+        with file:
+            np.savez(file, **_encode(result))
+        os.replace(file.name, path)
+    except BaseException:
+        os.remove(file.name)
+        raise
+
+    evict(_settings["max_bytes"])
+    return path
+
+
+def _entries() -> list:
+    """
+    Notes
+    -----
+    This function lists the entries of the cache. Only the subdirectories of the KEY_PARAMETERS kinds are
+    listed, so that the other files of the directory (e.g. with --cache .) are never evicted.
+
+    Returns
+    -------
+    entries (list) : (modification time, size, path) of every entry, the least recently used first
+    """
+    entries = []
+    for kind in KEY_PARAMETERS:
+        directory = os.path.join(_settings["directory"], kind)
+        try:
+            names = os.listdir(directory)
+        except FileNotFoundError:
+            continue
+        for name in names:
+            if name.endswith('.npz'):
+                path = os.path.join(directory, name)
+                try:
+                    status = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((status.st_mtime, status.st_size, path))
+    return sorted(entries)
+
+
+def evict(max_bytes : int):
+    """
+    Notes
+    -----
+    This function removes the least recently used entries until the cache is not larger than max_bytes
+
+    Parameters
+    ----------
+    max_bytes (int) : maximum size of the cache in bytes
+    """
+    entries = _entries()
+    total = sum(size for mtime, size, path in entries)
+    for mtime, size, path in entries:
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+def cached(
+        kind : str,
+        parameters : dict,
+        compute,
+        **options
+):
+    """
+    Notes
+    -----
+    This function returns a result from the cache, computing and storing it when it is missing.
+    When the cache is switched off, the result is simply computed.
+
+    Parameters
+    ----------
+    kind (str) : kind of result, one of the KEY_PARAMETERS
+    parameters (dict) : configuration parameters, as returned by read_config
+    compute (callable) : function without arguments computing the result
+    options : further arguments the result depends on (part of the key)
+
+    Returns
+    -------
+    result (np.ndarray or dict) : the result
+    """
+    if not is_enabled():
+        return compute()
+
+    key = cache_key(kind, parameters, **options)
+    result = load(kind, key)
+    if result is not None:
+        _cache_statistics["hits"] += 1
+        return result
+
+    _cache_statistics["misses"] += 1
+    result = compute()
+    store(kind, key, result)
+    return result
+
+
+def result_cache_info() -> dict:
+    """
+    Notes
+    -----
+    Return the statistics of the result cache
+
+    Returns
+    -------
+    info (dict) : dictionary with the number of hits and misses of this process, and the number of entries
+                  and the size in bytes of the cache
+    """
+    entries = _entries() if is_enabled() else []
+    return dict(_cache_statistics, entries=len(entries), size=sum(size for mtime, size, path in entries))
+
+
+def clear_result_cache():
+    """
+    Notes
+    -----
+    Remove every entry from the result cache and reset its statistics
+    """
+    if is_enabled():
+        evict(0)
+    _cache_statistics["hits"] = 0
+    _cache_statistics["misses"] = 0
@@ -0,0 +1,66 @@
+import configparser
+import os
+
+
+def export_to_environment(values : dict):
+    """
+    Notes
+    -----
+    This function exports settings to the environment, so that the worker processes started afterwards
+    (e.g. by a sweep) inherit them
+
+    Parameters
+    ----------
+    values (dict) : value of every environment variable; None (or an empty value) removes the variable
+    """
+    for variable, value in values.items():
+        if value:
+            os.environ[variable] = str(value)
+        else:
+            os.environ.pop(variable, None)
+
+
+def read_config_section(
+                    config_files,
+                    section : str,
+                    variable : str
+):
+    """
+    Notes
+    -----
+    This function reads a section of one or more configuration files (e.g. all the files of a sweep).
+    The options set by several files must have the same value. Nothing is read when the environment
+    variable is set, since it takes precedence over the configuration files.
+
+    Parameters
+    ----------
+    config_files (str or list) : name of the configuration file, or list of names
+    section (str) : name of the section
+    variable (str) : environment variable overriding the section
+
+    Returns
+    -------
+    options (configparser.SectionProxy) : the merged section, or None if no file has it or if the variable is set
+    """
+    if os.environ.get(variable):
+        return None
+    if isinstance(config_files, (str, os.PathLike)):
+        config_files = [config_files]
+
+    options, sources = {}, {}
+    for config_file in config_files:
+        config = configparser.ConfigParser()
+        config.read(config_file)
+        if not config.has_section(section):
+            continue
+        for option, value in config.items(section):
+            if options.setdefault(option, value) != value:
+                raise ValueError(f"Error: '{config_file}' sets {option} = {value} in the [{section}] section, "
+                                 f"but '{sources[option]}' sets {option} = {options[option]}.")
+            sources.setdefault(option, config_file)
+
+    if not sources:
+        return None
+    merged = configparser.ConfigParser()
+    merged.read_dict({section: options})
+    return merged[section]
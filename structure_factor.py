@@ -0,0 +1,414 @@
+import os
+import tempfile
+from contextlib import nullcontext
+from functools import lru_cache
+
+import numpy as np
+
+import kernels
+import parallel
+from crystal import cubic_crystal
+from form_factors import atomic_form_factor
+
+
+def _as_points(
+            array : np.ndarray,
+            name : str
+) -> np.ndarray:
+    """
+    Notes
+    -----
+    This function checks that an array is a list of 2D or 3D points and returns it as a float64 (N, d) array
+
+    Parameters
+    ----------
+    array (np.ndarray) : array of points
+    name (str) : name of the array, used in the error message
+
+    Returns
+    -------
+    points (np.ndarray) : (N, d) float64 array
+    """
+    points = np.asarray(array, dtype=np.float64)
+    if points.ndim != 2 or points.shape[1] not in (2, 3):
+        raise ValueError(f"Error: {name} must be an (N, 2) or (N, 3) array, got shape {points.shape}.")
+    return points
+
+
+def _structure_factor_task(
+                        inputs,
+                        q_range : tuple,
+                        atom_range : tuple,
+                        q_block : int,
+                        atom_block : int
+) -> np.ndarray:
+    """
+    Notes
+    -----
+    This function sums the structure factor of the q-points in q_range over the atoms in atom_range, block by
+    block. The blocks always start at multiples of q_block and atom_block and the atom blocks are always added
+    in the same order, so every q-point goes through exactly the same floating point operations whatever the
+    partition of the work among the tasks.
+
+    Parameters
+    ----------
+    inputs (tuple or str) : (positions, q_points, form_factors) arrays, or the directory of the memory mapped
+                            .npy files holding them (for the worker processes)
+    q_range (tuple) : (start, stop) of the q-points
+    atom_range (tuple) : (start, stop) of the atoms
+    q_block (int) : number of q-points per block
+    atom_block (int) : number of atoms per block
+
+    Returns
+    -------
+    structure_factor (np.ndarray) : complex array with the partial F(q) of the q-points in q_range
+    """
+    if isinstance(inputs, str):
+        inputs = tuple(np.load(os.path.join(inputs, name + '.npy'), mmap_mode='r') for name in ("positions", "q_points", "form_factors"))
+    positions, q_points, form_factors = inputs
+
+    structure_factor = np.zeros(q_range[1] - q_range[0], dtype=np.complex128)
+    real_part = np.empty(min(q_block, len(structure_factor)))
+
+    for q_start in range(q_range[0], q_range[1], q_block):
+        q = 2 * np.pi * q_points[q_start:min(q_start + q_block, q_range[1])]
+        F = structure_factor[q_start - q_range[0]:q_start - q_range[0] + len(q)]
+
+        for atom_start in range(atom_range[0], atom_range[1], atom_block):
+            r = positions[atom_start:min(atom_start + atom_block, atom_range[1])]
+            f = form_factors[atom_start:atom_start + len(r)]
+
+            # phases of all the (q, atom) pairs of the block with a single matrix product
+            phase = q @ r.T
+
+            np.matmul(np.cos(phase), f, out=real_part[:len(q)])
+            F.real += real_part[:len(q)]
+            np.sin(phase, out=phase)
+            F.imag += phase @ f
+
+    return structure_factor
+
+
+def calculate_structure_factor(
+                            atomic_positions : np.ndarray,
+                            q_points : np.ndarray,
+                            form_factors : np.ndarray = None,
+                            q_block : int = 1024,
+                            atom_block : int = 4096,
+                            executor = None,
+                            max_workers : int = None,
+                            jit : bool = False
+) -> np.ndarray:
+    """
+    Notes
+    -----
+    Calculate the structure factor F(q) = sum_j f_j exp(2*pi*i q.r_j) directly from the atomic positions.
+    Atoms and q-points are processed in blocks of q_block x atom_block, so the temporary arrays never
+    exceed a few q_block*atom_block elements whatever the number of atoms and q-points. In each block the
+    phases are obtained with one matrix product (q @ r.T) and the sums over the atoms with two
+    matrix-vector products (cos @ f, sin @ f), which are carried out by the (multithreaded) BLAS.
+    With a parallel executor the q blocks are distributed among the workers or, when there are fewer
+    q blocks than workers, the atom blocks, whose partial sums are then added in a fixed order: the result
+    is bitwise identical for every executor and number of workers. With the 'threads' backend, limit the
+    BLAS threads (e.g. OPENBLAS_NUM_THREADS=1) to avoid oversubscribing the cores.
+    With jit = True and Numba installed, the sum is instead evaluated by the compiled fused loop of
+    kernels.phase_sum, parallel over the q-points on the Numba threads (executor and blocks are not used).
+
+    Parameters
+    ----------
+    atomic_positions (np.ndarray) : (N, d) array with the atomic positions (d = 2 or 3), e.g. from
+                                    generate_cubic_structure or generate_surface_structure
+    q_points (np.ndarray) : (M, d) array with the q-points, in the reciprocal units of the positions
+                            (the factor 2*pi is included in the phase: q = (h, k, l) for positions in units of a)
+    form_factors (np.ndarray, optional) : (N,) array with the scattering factor of each atom (default: 1)
+    q_block (int) : number of q-points per block
+    atom_block (int) : number of atoms per block
+    executor (str or concurrent.futures.Executor, optional) : 'serial', 'threads', 'processes' or an executor
+                                                              (default: the backend selected with parallel.configure)
+    max_workers (int, optional) : number of workers (default: the configured number, or the number of processors)
+    jit (bool) : if true, uses the Numba kernel when it is available (the NumPy evaluation otherwise)
+
+    Returns
+    -------
+    structure_factor (np.ndarray) : (M,) complex array with F(q) for every q-point
+    """
+    positions = _as_points(atomic_positions, "atomic_positions")
+    q_points = _as_points(q_points, "q_points")
+    if positions.shape[1] != q_points.shape[1]:
+        raise ValueError("Error: atomic_positions and q_points must have the same dimension.")
+
+    if form_factors is None:
+        form_factors = np.ones(len(positions))
+    else:
+        form_factors = np.asarray(form_factors, dtype=np.float64)
+        if form_factors.shape != (len(positions),):
+            raise ValueError("Error: form_factors must have one value per atom.")
+
+    if jit:
+        structure_factor = kernels.phase_sum(positions, q_points, form_factors)
+        if structure_factor is not None:
+            return structure_factor
+
+    n_q, n_atoms = len(q_points), len(positions)
+    n_workers = parallel.worker_count(executor, max_workers)
+    q_starts, atom_starts = range(0, n_q, q_block), range(0, n_atoms, atom_block)
+
+    if n_workers == 1:
+        tasks = [((0, n_q), (0, n_atoms))]
+    elif len(q_starts) >= n_workers or len(atom_starts) <= 1:
+        tasks = [((start, min(start + q_block, n_q)), (0, n_atoms)) for start in q_starts]
+    else:
+        tasks = [((0, n_q), (start, min(start + atom_block, n_atoms))) for start in atom_starts]
+
+    with tempfile.TemporaryDirectory() if parallel.uses_processes(executor) else nullcontext() as directory:
+        if directory is None:
+            inputs = (positions, q_points, form_factors)
+        else:
+            # the worker processes map the inputs from the files instead of receiving a copy of them
+            for name, array in (("positions", positions), ("q_points", q_points), ("form_factors", form_factors)):
+                np.save(os.path.join(directory, name + '.npy'), array)
+            inputs = directory
+
+        results = parallel.ordered_map(_structure_factor_task, [(inputs, q_range, atom_range, q_block, atom_block)
+                                                                for q_range, atom_range in tasks], executor, max_workers)
+
+    if tasks[0][1] == (0, n_atoms):
+        return np.concatenate(results) if results else np.zeros(0, dtype=np.complex128)
+
+    # partial sums over the atom blocks, added in the order of the blocks
+    structure_factor = np.zeros(n_q, dtype=np.complex128)
+    for partial in results:
+        structure_factor += partial
+    return structure_factor
+
+
+def calculate_kinematic_intensity(
+                                atomic_positions : np.ndarray,
+                                q_points : np.ndarray,
+                                form_factors : np.ndarray = None,
+                                q_block : int = 1024,
+                                atom_block : int = 4096,
+                                element : str = None,
+                                executor = None,
+                                max_workers : int = None,
+                                jit : bool = False
+) -> np.ndarray:
+    """
+    Notes
+    -----
+    Calculate the kinematic diffraction intensity I(q) = |sum_j f_j exp(2*pi*i q.r_j)|^2 from the atomic positions
+
+    Parameters
+    ----------
+    atomic_positions (np.ndarray) : (N, d) array with the atomic positions (d = 2 or 3)
+    q_points (np.ndarray) : (M, d) array with the q-points, in the reciprocal units of the positions
+    form_factors (np.ndarray, optional) : (N,) array with the scattering factor of each atom (default: 1)
+    q_block (int) : number of q-points per block
+    atom_block (int) : number of atoms per block
+    element (str, optional) : if given, the intensity is multiplied by the squared atomic form factor
+                              f(|q|)^2 of the element (positions in Å, q in 1/Å); mutually exclusive with form_factors
+    executor (str or concurrent.futures.Executor, optional) : backend of the parallel evaluation (see calculate_structure_factor)
+    max_workers (int, optional) : number of workers
+    jit (bool) : if true, uses the Numba kernel when it is available (see calculate_structure_factor)
+
+    Returns
+    -------
+    intensity (np.ndarray) : (M,) array with the intensity for every q-point
+    """
+    if form_factors is not None and element is not None:
+        raise ValueError("Error: form_factors and element are mutually exclusive, the form factor would be applied twice.")
+
+    structure_factor = calculate_structure_factor(atomic_positions, q_points, form_factors, q_block, atom_block, executor, max_workers, jit)
+    intensity = structure_factor.real**2 + structure_factor.imag**2
+
+    if element is not None:
+        intensity *= atomic_form_factor(element, np.linalg.norm(q_points, axis=1))**2
+
+    return intensity
+
+
+def _layer_coefficients(
+                    fractional_positions : np.ndarray,
+                    h : float,
+                    k : float,
+                    form_factors : np.ndarray = None,
+                    decimals : int = 6
+) -> [np.ndarray, np.ndarray]:
+    """
+    Notes
+    -----
+    This function groups the atoms in layers of equal height z and sums, for each layer, the in-plane
+    part of the structure factor A_m = sum_(j in m) f_j exp(2*pi*i (h x_j + k y_j)), so that
+    F(l) = sum_m A_m exp(2*pi*i l z_m) only runs over the layers.
+
+    Parameters
+    ----------
+    fractional_positions (np.ndarray) : (N, 3) array with the atomic positions in units of the lattice parameter
+    h (float) : h index of the rod
+    k (float) : k index of the rod
+    form_factors (np.ndarray, optional) : (N,) array with the scattering factor of each atom (default: 1)
+    decimals (int) : number of decimal places used to assign the atoms to the layers
+
+    Returns
+    -------
+    z_layers (np.ndarray) : heights of the layers
+    coefficients (np.ndarray) : complex in-plane structure factor of each layer
+    """
+    x, y, z = fractional_positions.T
+    z_layers, layer_index = np.unique(np.round(z, decimals), return_inverse=True)
+
+    in_plane = np.exp(2j * np.pi * (h * x + k * y))
+    if form_factors is not None:
+        in_plane *= form_factors
+
+    coefficients = np.bincount(layer_index, weights=in_plane.real, minlength=len(z_layers)) \
+        + 1j * np.bincount(layer_index, weights=in_plane.imag, minlength=len(z_layers))
+
+    return z_layers, coefficients
+
+
+@lru_cache(maxsize=1024)
+def bulk_layer_coefficients(
+                        structure : str,
+                        h : float,
+                        k : float
+) -> [np.ndarray, np.ndarray]:
+    """
+    Notes
+    -----
+    This function returns the layer heights and the in-plane structure factors of the conventional unit cell
+    of the cubic structure for the rod (h, k). The result is cached, so every rod scan after the first one
+    only evaluates the few layer terms. The unit cell is expressed in units of the lattice parameter, so the
+    result does not depend on a.
+
+    Parameters
+    ----------
+    structure (str) : type of cubic structure (sc, bcc or fcc)
+    h (float) : h index of the rod
+    k (float) : k index of the rod
+
+    Returns
+    -------
+    z_layers (np.ndarray) : heights of the layers of the unit cell (read-only)
+    coefficients (np.ndarray) : complex in-plane structure factor of each layer (read-only)
+    """
+    # Basis of the conventional cell, without generating the copies of the atoms on the far faces
+    basis = cubic_crystal(structure, 1, 1, 1)["basis"]
+
+    z_layers, coefficients = _layer_coefficients(basis, h, k)
+    z_layers.setflags(write=False)
+    coefficients.setflags(write=False)
+    return z_layers, coefficients
+
+
+def split_slab(
+            atomic_positions : np.ndarray,
+            a : float,
+            n_surface_cells : int = 1
+) -> [int, np.ndarray]:
+    """
+    Notes
+    -----
+    This function splits a slab built by generate_cubic_structure into bulk unit cells and surface layers,
+    keeping a single lateral unit cell (0 <= x, y < a). The slab is shifted so that the surface layers start
+    at z = 0 and the bulk cells fill -n_bulk_cells*a <= z < 0, as expected by calculate_ctr.
+
+    Parameters
+    ----------
+    atomic_positions (np.ndarray) : (N, 3) array with the atomic positions of the slab
+    a (float) : lattice parameter
+    n_surface_cells (int) : number of unit cells at the top of the slab treated as surface layers
+
+    Returns
+    -------
+    n_bulk_cells (int) : number of bulk unit cells below the surface layers
+    surface_positions (np.ndarray) : (M, 3) array with the positions of the surface atoms
+    """
+    fractional_positions = np.asarray(atomic_positions, dtype=np.float64) / a
+    tolerance = 1e-6
+
+    in_cell = np.all((fractional_positions[:, :2] > -tolerance) & (fractional_positions[:, :2] < 1 - tolerance), axis=1)
+    fractional_positions = fractional_positions[in_cell]
+
+    n_bulk_cells = int(round(fractional_positions[:, 2].max())) - n_surface_cells
+    if n_bulk_cells < 0:
+        raise ValueError("Error: the slab is thinner than the requested surface layers.")
+
+    surface = fractional_positions[fractional_positions[:, 2] > n_bulk_cells - tolerance]
+    surface[:, 2] -= n_bulk_cells
+
+    return n_bulk_cells, surface * a
+
+
+def calculate_ctr(
+                structure : str,
+                h : float,
+                k : float,
+                l : np.ndarray,
+                surface_positions : np.ndarray = None,
+                a : float = 1.0,
+                n_bulk_cells : int = None,
+                attenuation : float = 0.01,
+                surface_form_factors : np.ndarray = None,
+                element : str = None
+) -> np.ndarray:
+    """
+    Notes
+    -----
+    Calculate the crystal truncation rod intensity |F(h, k, l)|^2 along l for a cubic crystal terminated
+    by surface layers. The structure factor is split in
+        F = F_cell(l) * sum_(n=1..n_bulk_cells) x^n + F_surface(l),   x = exp(-2*pi*i l - attenuation)
+    where the bulk cells are stacked below z = 0 and the geometric series is evaluated in closed form
+    (n_bulk_cells = None gives the semi-infinite crystal, x / (1 - x)). F_cell comes from the cached
+    bulk_layer_coefficients, so only the surface layers are summed again when they change.
+    h, k and l are in units of the reciprocal lattice of the conventional cubic cell.
+
+    Parameters
+    ----------
+    structure (str) : type of cubic structure (sc, bcc or fcc)
+    h (float) : h index of the rod
+    k (float) : k index of the rod
+    l (np.ndarray) : values of l along the rod
+    surface_positions (np.ndarray, optional) : (M, 3) positions of the surface atoms (adsorbates, relaxed
+                                               layers...), z >= 0 above the bulk (e.g. from split_slab)
+    a (float) : lattice parameter, the unit of surface_positions
+    n_bulk_cells (int, optional) : number of bulk unit cells (default: semi-infinite crystal)
+    attenuation (float) : absorption per unit cell, needed to keep the semi-infinite sum finite
+    surface_form_factors (np.ndarray, optional) : (M,) scattering factors of the surface atoms (default: 1,
+                                                  or the form factor of element when it is given)
+    element (str, optional) : if given, the bulk atoms scatter with the atomic form factor f(|q|) of the
+                              element, |q| = sqrt(h^2 + k^2 + l^2)/a
+
+    Returns
+    -------
+    intensity (np.ndarray) : array with the shape of l containing the intensity along the rod
+    """
+    l = np.asarray(l, dtype=np.float64)
+    z_layers, coefficients = bulk_layer_coefficients(structure, float(h), float(k))
+
+    # structure factor of one bulk cell, then of the whole stack of cells below the surface
+    F = np.exp(2j * np.pi * l[..., None] * z_layers) @ coefficients
+
+    x = np.exp(-2j * np.pi * l - attenuation)
+    if n_bulk_cells is None:
+        if attenuation <= 0:
+            raise ValueError("Error: the semi-infinite crystal needs a positive attenuation.")
+        F *= x / (1 - x)
+    else:
+        one_minus_x = 1 - x
+        series = np.full(l.shape, float(n_bulk_cells), dtype=np.complex128)   # limit for x -> 1
+        np.divide(x * (1 - x**n_bulk_cells), one_minus_x, out=series, where=np.abs(one_minus_x) > 1e-12)
+        F *= series
+
+    if element is not None:
+        form_factor = atomic_form_factor(element, np.sqrt(h**2 + k**2 + l**2) / a)
+        F *= form_factor
+
+    if surface_positions is not None and len(surface_positions):
+        z_surface, surface_coefficients = _layer_coefficients(np.asarray(surface_positions, dtype=np.float64) / a, h, k, surface_form_factors)
+        F_surface = np.exp(2j * np.pi * l[..., None] * z_surface) @ surface_coefficients
+        if element is not None and surface_form_factors is None:
+            F_surface *= form_factor
+        F += F_surface
+
+    return F.real**2 + F.imag**2
@@ -0,0 +1,178 @@
+import argparse
+import itertools
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import create_cubic_structure as ccs
+import instrumentation
+import result_cache
+
+# Parameters that determine the arrays computed by the sweep: configurations differing only in
+# the other parameters (e.g. the element) share the same geometry and are computed once
+GEOMETRY_KEYS = ("structure", "Nx", "Ny", "Nz", "a", "plane", "Na", "Nb")
+
+
+def make_parameter_grid(
+                    base : dict,
+                    **values : list
+) -> list:
+    """
+    Notes
+    -----
+    This function builds the list of configurations obtained by combining every value of the swept parameters
+
+    Parameters
+    ----------
+    base (dict) : configuration parameters shared by every point of the grid (as returned by read_config)
+    values (list) : for each swept parameter, the list of its values (e.g. a=[3.8, 3.85], element=['Ir', 'Pt'])
+
+    Returns
+    -------
+    configurations (list) : list of configuration dictionaries, one per point of the grid
+    """
+    unknown = set(values) - set(base)
+    if unknown:
+        raise ValueError(f"Error: unknown parameters {sorted(unknown)} in the sweep grid.")
+
+    names = list(values)
+    return [dict(base, **dict(zip(names, combination))) for combination in itertools.product(*values.values())]
+
+
+def geometry_key(parameters : dict) -> tuple:
+    """
+    Notes
+    -----
+    This function returns the part of a configuration that determines the computed arrays
+
+    Parameters
+    ----------
+    parameters (dict) : configuration parameters
+
+    Returns
+    -------
+    key (tuple) : values of the GEOMETRY_KEYS parameters
+    """
+    return tuple(parameters[key] for key in GEOMETRY_KEYS)
+
+
+def run_geometry(key : tuple) -> dict:
+    """
+    Notes
+    -----
+    This function runs the generate, surface and intensity stages for one geometry.
+    It is executed in the worker processes of the sweep; with the result cache switched on, the arrays
+    computed by previous or concurrent sweeps are reused.
+
+    Parameters
+    ----------
+    key (tuple) : geometry, as returned by geometry_key
+
+    Returns
+    -------
+    arrays (dict) : cubic_positions, surface_positions and intensity of the geometry
+    """
+    p = dict(zip(GEOMETRY_KEYS, key))
+    return {
+        "cubic_positions": result_cache.cached("cubic_positions", p, lambda: ccs.generate_cubic_structure(p["structure"], p["Nx"], p["Ny"], p["Nz"], p["a"])),
+        "surface_positions": result_cache.cached("surface_positions", p, lambda: ccs.generate_surface_structure(p["structure"], p["plane"], p["Na"], p["Nb"])),
+        "intensity": result_cache.cached("intensity", p, lambda: ccs.calculate_intensity(p["Na"], p["Nb"]), pruned = False),
+    }
+
+
+def run_sweep(
+            configurations : list,
+            output : str = 'sweep_results.npz',
+            max_workers : int = None
+) -> str:
+    """
+    Notes
+    -----
+    This function runs the pipeline for every configuration on a process pool and writes all the results
+    in a single npz file. Configurations with the same geometry are computed only once: the file stores
+    each geometry once, under 'geometry_<i>_<array>', and an 'index' entry (JSON) that maps every
+    configuration to its geometry.
+
+    Parameters
+    ----------
+    configurations (list) : list of configuration dictionaries (as returned by read_config or make_parameter_grid)
+    output (str) : name of the npz file collecting the results
+    max_workers (int) : number of worker processes (None uses the number of processors)
+
+    Returns
+    -------
+    output (str) : name of the npz file collecting the results
+    """
+    # Assign an id to every distinct geometry, keeping the order of first appearance
+    geometries = {}
+    for parameters in configurations:
+        geometries.setdefault(geometry_key(parameters), len(geometries))
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(run_geometry, geometries))
+
+    arrays = {}
+    for geometry_id, geometry_arrays in enumerate(results):
+        for name, array in geometry_arrays.items():
+            arrays[f"geometry_{geometry_id}_{name}"] = array
+
+    index = [dict(parameters, geometry=geometries[geometry_key(parameters)]) for parameters in configurations]
+    np.savez(output, index=np.array(json.dumps(index)), **arrays)
+
+    return output
+
+
+def load_sweep(filename : str = 'sweep_results.npz') -> list:
+    """
+    Notes
+    -----
+    This function reads the results written by run_sweep
+
+    Parameters
+    ----------
+    filename (str) : name of the npz file collecting the results
+
+    Returns
+    -------
+    results (list) : for every configuration, a dictionary with its parameters and its
+                     cubic_positions, surface_positions and intensity arrays
+    """
+    if not os.path.isfile(filename):
+        raise FileNotFoundError(f"Error: '{filename}' file not found. Run sweep.py first.")
+
+    with np.load(filename) as data:
+        index = json.loads(str(data["index"]))
+        results = []
+        for parameters in index:
+            geometry_id = parameters.pop("geometry")
+            for name in ("cubic_positions", "surface_positions", "intensity"):
+                parameters[name] = data[f"geometry_{geometry_id}_{name}"]
+            results.append(parameters)
+
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the pipeline over many configurations and collect the results in one file.")
+    parser.add_argument("config_files", nargs="+", help="configuration files to be swept")
+    parser.add_argument("--output", default="sweep_results.npz", help="npz file collecting the results (default: sweep_results.npz)")
+    parser.add_argument("--cache", default=None, help="directory of the result cache shared by the sweeps (default: no cache)")
+    parser.add_argument("--cache-size", type=float, default=1024, help="maximum size of the result cache in MB (default: 1024)")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes (default: number of processors)")
+    args = parser.parse_args()
+
+    try:
+        # the [instrumentation] and [cache] sections of the swept files must agree
+        instrumentation.configure_from_config(args.config_files)
+        result_cache.configure_from_config(args.config_files)
+        if args.cache:
+            result_cache.configure(args.cache, int(args.cache_size * 2**20))
+
+        configurations = [ccs.read_config(config_file) for config_file in args.config_files]
+        print(f"Results saved in {run_sweep(configurations, args.output, args.workers)}")
+    except ValueError as e:
+        print(f"Error: {e}")
+    except FileNotFoundError as e:
+        print(f"Error: {e}")
@@ -1,12 +1,31 @@
+import importlib.machinery
+import importlib.util
+import json
+import os
+import subprocess
+import sys
 import numpy as np
-from hypothesis import given, settings
+import pytest
+from hypothesis import given
 from hypothesis import strategies as st
-from create_cubic_structure import generate_cubic_structure, generate_simple_cubic, generate_body_centered_cubic, generate_face_centered_cubic, generate_111_surface_fcc
+from create_cubic_structure import read_config, build_coordinate_index, contains_coordinates, check_2fold_rotation_axis, check_centered_unit_cell_symmetry, interference_function, calculate_intensity, generate_cubic_structure, iterate_cubic_structure, count_cubic_atoms, save_atomic_coordinates, load_atomic_coordinates, generate_simple_cubic, generate_body_centered_cubic, generate_face_centered_cubic, generate_111_surface_fcc, surface_lattice_vectors, shift_surface_coordinates, generate_surface_structure, detect_plane_group, find_systematic_absences, check_glide_plane_symmetry, get_symmetry_properties, forbidden_reflections, generate_reciprocal_surface_structure, bravais_lattice_vectors, surface_unit_cell, reciprocal_surface_cell, generate_reciprocal_mesh, generate_reciprocal_111_surface_sc, generate_reciprocal_111_surface_fcc, transform_coordinates, surface_lattice_parameter, save_intensity
+from main import run_pipeline
+from sweep import make_parameter_grid, run_sweep, load_sweep
+from structure_factor import calculate_structure_factor, calculate_kinematic_intensity, bulk_layer_coefficients, split_slab, calculate_ctr
+from form_factors import CROMER_MANN_COEFFICIENTS, evaluate_form_factor, atomic_form_factor, form_factor_cache_info, clear_form_factor_cache
+from overlayer import overlayer_matrix, build_overlayer, superstructure_spots
+from diffraction_pattern import rasterize_spots, save_pattern, render_surface_pattern
+from plot_cubic_structure import plot_cubic_structure, plot_surface_structure, decimate_positions, get_cubic_coordinates
+from benchmark import BENCHMARKS, run_benchmarks, save_baseline, load_baseline, find_regressions
+import instrumentation
+import result_cache
+import parallel
+import kernels
+from crystal import cubic_crystal, surface_crystal, make_crystal, crystal_positions, iterate_crystal_positions, count_crystal_atoms, crystal_intensity
 
 
 # generating the variables Nx, Ny and Nz such that they are greater than 0
 @given(Nx = st.integers(min_value = 1, max_value = 20), Ny = st.integers(min_value = 1, max_value = 20), Nz = st.integers(min_value = 1, max_value = 20))
-@settings(deadline=400)  # Increase the deadline to 400ms
 def test_generate_simple_cubic(Nx, Ny, Nz):
     """
     positive test that checks if the function generating
@@ -20,7 +39,6 @@ def test_generate_simple_cubic(Nx, Ny, Nz):
 
 # Test the generate_simple_cubic function
 @given(Nx=st.integers(min_value=1, max_value=20), Ny=st.integers(min_value=1, max_value=20), Nz=st.integers(min_value=1, max_value=20))
-@settings(deadline=400)  # Increase the deadline to 400ms
 def test_count_atoms_sc(Nx, Ny, Nz):
     # Generate atomic positions for SC
     atomic_positions = generate_simple_cubic(Nx, Ny, Nz)
@@ -34,8 +52,7 @@ def test_count_atoms_sc(Nx, Ny, Nz):
 
 # Test the generate_body_centered_cubic function
 @given(Nx=st.integers(min_value=1, max_value=20), Ny=st.integers(min_value=1, max_value=20), Nz=st.integers(min_value=1, max_value=20))
-@settings(deadline=400)  # Increase the deadline to 400ms
-def test_count_atoms_sc(Nx, Ny, Nz):
+def test_count_atoms_bcc(Nx, Ny, Nz):
     # Generate atomic positions for BCC
     atomic_positions = generate_body_centered_cubic(Nx, Ny, Nz)
     
@@ -70,5 +87,675 @@ def test_count_111_surface_fcc(Na, Nb):
     # Check if the number of the coordinates matches the expected count
     assert len(atomic_positions) == expected_count
 
+# Test that the vectorized fcc generator keeps the atom ordering of the nested loops
+@given(Nx=st.integers(min_value=1, max_value=6), Ny=st.integers(min_value=1, max_value=6), Nz=st.integers(min_value=1, max_value=6))
+def test_order_atoms_fcc(Nx, Ny, Nz):
+    a = 3.85
+
+    # Build the reference positions with the loop order used originally: verteces, then faces along x, y and z
+    expected_positions = [[i * a, j * a, k * a] for i in range(Nx + 1) for j in range(Ny + 1) for k in range(Nz + 1)]
+    expected_positions += [[i * a, j * a + a/2, k * a + a/2] for i in range(Nx + 1) for j in range(Ny) for k in range(Nz)]
+    expected_positions += [[i * a + a/2, j * a, k * a + a/2] for i in range(Nx) for j in range(Ny + 1) for k in range(Nz)]
+    expected_positions += [[i * a + a/2, j * a + a/2, k * a] for i in range(Nx) for j in range(Ny) for k in range(Nz + 1)]
+
+    atomic_positions = generate_face_centered_cubic(Nx, Ny, Nz, a)
+
+    # Check that the positions are identical, row by row
+    assert np.array_equal(atomic_positions, np.array(expected_positions))
+
+# Test the dtype option of the cubic structure generators
+def test_dtype_cubic_structure():
+    # Generate the same bcc structure in single and double precision
+    positions_64 = generate_cubic_structure("bcc", 3, 2, 4)
+    positions_32 = generate_cubic_structure("bcc", 3, 2, 4, dtype=np.float32)
+
+    # Check the requested type and that the coordinates agree within single precision
+    assert positions_32.dtype == np.float32
+    assert positions_32.shape == positions_64.shape
+    assert np.allclose(positions_32, positions_64)
+
+# Test that the streamed blocks reproduce the full cubic structure
+@given(structure=st.sampled_from(["sc", "bcc", "fcc"]), Nx=st.integers(min_value=1, max_value=6), Ny=st.integers(min_value=1, max_value=6), Nz=st.integers(min_value=1, max_value=6), block_size=st.integers(min_value=1, max_value=50))
+def test_iterate_cubic_structure(structure, Nx, Ny, Nz, block_size):
+    # Generate the blocks of the structure
+    blocks = list(iterate_cubic_structure(structure, Nx, Ny, Nz, block_size=block_size))
+
+    # Check that no block exceeds the requested size and that together they give the whole structure
+    assert all(len(block) <= block_size for block in blocks)
+    assert np.array_equal(np.concatenate(blocks), generate_cubic_structure(structure, Nx, Ny, Nz))
+    assert sum(len(block) for block in blocks) == count_cubic_atoms(structure, Nx, Ny, Nz)
+
+# Test the round trip of the coordinates through the binary and text formats
+def test_save_load_atomic_coordinates(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    parameters = {"structure": "fcc", "Nx": 3, "Ny": 3, "Nz": 3, "a": 3.85, "element": "Ir", "plane": "111", "Na": 3, "Nb": 3}
+    atomic_positions = generate_cubic_structure("fcc", 3, 3, 3, 3.85)
+    n_atoms = count_cubic_atoms("fcc", 3, 3, 3)
+
+    # Save the whole array, a stream of blocks and the txt export
+    filename = save_atomic_coordinates(atomic_positions, parameters)
+    loaded_positions, metadata = load_atomic_coordinates(filename)
+
+    # the stream is written in another directory, so that it does not overwrite the first file
+    (tmp_path / "streamed").mkdir()
+    monkeypatch.chdir(tmp_path / "streamed")
+    streamed_filename = save_atomic_coordinates(iterate_cubic_structure("fcc", 3, 3, 3, 3.85, block_size=7), parameters, n_atoms=n_atoms)
+    streamed_positions, _ = load_atomic_coordinates(streamed_filename)
+    monkeypatch.chdir(tmp_path)
+    text_positions, _ = load_atomic_coordinates(save_atomic_coordinates(atomic_positions, parameters, file_format='txt'))
+
+    # Check that the binary file is memory mapped and that every format gives back the same coordinates
+    assert isinstance(loaded_positions, np.memmap)
+    assert metadata["n_atoms"] == n_atoms
+    assert np.array_equal(loaded_positions, atomic_positions)
+    assert np.array_equal(streamed_positions, atomic_positions)
+    assert np.array_equal(text_positions, atomic_positions)
+    assert (tmp_path / filename).exists() and (tmp_path / "streamed" / streamed_filename).exists()
+
+    # an empty stream gives an empty file
+    empty_positions, empty_metadata = load_atomic_coordinates(save_atomic_coordinates(iter([]), parameters, n_atoms=0))
+    assert empty_positions.shape == (0, 3) and empty_metadata["n_atoms"] == 0
+
+    # the instrumentation counts the atoms of a stream whatever the way the arguments are passed
+    try:
+        instrumentation.configure(str(tmp_path / "stages.jsonl"))
+        save_atomic_coordinates(iterate_cubic_structure("fcc", 3, 3, 3, 3.85, block_size=7), parameters, False, 'npy', n_atoms)
+        save_atomic_coordinates(parameters=parameters, coordinates=iterate_cubic_structure("fcc", 3, 3, 3, 3.85, block_size=7), n_atoms=n_atoms)
+    finally:
+        instrumentation.configure(None)
+    records = list(map(json.loads, (tmp_path / "stages.jsonl").read_text().splitlines()))
+    assert [record["n_atoms"] for record in records if record["stage"] == "save_atomic_coordinates"] == [n_atoms, n_atoms]
+
+# Test that the configuration is read into explicit parameters and that zero repetitions are rejected
+def test_read_config(tmp_path):
+    config_file = tmp_path / "config.ini"
+    config_text = "[cubic_structure]\ntype = BCC\n[repetitions]\nNx = 2\nNy = 3\nNz = {Nz}\n[lattice_parameter]\na = 3.3\n[element]\nsymbol = W\n[surface]\nplane = 111\n[surface_repetitions]\nNa = 4\nNb = 5\n"
+
+    # Read a valid configuration
+    config_file.write_text(config_text.format(Nz=4))
+    parameters = read_config(str(config_file))
+    assert parameters == {"structure": "bcc", "Nx": 2, "Ny": 3, "Nz": 4, "a": 3.3, "element": "W", "plane": "111", "Na": 4, "Nb": 5}
+
+    # A zero repetition has to raise an error
+    config_file.write_text(config_text.format(Nz=0))
+    with pytest.raises(ValueError):
+        read_config(str(config_file))
+
+# Test that the in-process pipeline passes the arrays between the stages without writing files
+def test_run_pipeline(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    parameters = {"structure": "fcc", "Nx": 2, "Ny": 2, "Nz": 2, "a": 3.85, "element": "Ir", "plane": "111", "Na": 3, "Nb": 3}
+
+    results = run_pipeline(parameters, save_files=False, plot=False)
+
+    # Check the results of every stage, their timings and that nothing was written to disk
+    assert np.array_equal(results["cubic_positions"], generate_cubic_structure("fcc", 2, 2, 2, 3.85))
+    assert len(results["surface_positions"]) == 16
+    assert results["intensity"].shape == (4, 4)
+    assert set(results["timings"]) == {"Generating the cubic structure", "Generating the surface structure", "Checking the symmetry properties", "Calculating the intensity"}
+    assert list(tmp_path.iterdir()) == []
+
+# Test that the sweep computes identical geometries once and collects every configuration in one file
+def test_run_sweep(tmp_path):
+    base = {"structure": "fcc", "Nx": 1, "Ny": 1, "Nz": 1, "a": 3.85, "element": "Ir", "plane": "111", "Na": 2, "Nb": 2}
+    configurations = make_parameter_grid(base, element=["Ir", "Pt"], a=[3.85, 3.92])
+    output = run_sweep(configurations, str(tmp_path / "sweep.npz"), max_workers=2)
+
+    # The 4 configurations only have 2 different geometries
+    with np.load(output) as data:
+        assert len([name for name in data.files if name.endswith("_cubic_positions")]) == 2
+
+    # Check that every configuration gets the arrays of its own lattice parameter
+    results = load_sweep(output)
+    assert [(result["element"], result["a"]) for result in results] == [("Ir", 3.85), ("Ir", 3.92), ("Pt", 3.85), ("Pt", 3.92)]
+    for result in results:
+        assert np.array_equal(result["cubic_positions"], generate_cubic_structure("fcc", 1, 1, 1, result["a"]))
+
+# Test the interference function at integer, fractional and nearly integer points
+@given(N=st.integers(min_value=1, max_value=30), h=st.floats(min_value=-50, max_value=50).filter(lambda h: abs(h - round(h)) > 1e-3))
+def test_interference_function(N, h):
+    # Away from the integers the function is given directly by the formula
+    expected = np.sin(np.pi * N * h)**2 / np.sin(np.pi * h)**2
+    assert np.isclose(interference_function(np.array([h]), N)[0], expected, rtol=1e-6, atol=1e-9)
+
+    # At (and next to) the integers it tends to N^2
+    assert np.allclose(interference_function(np.array([round(h), round(h) + 1e-12]), N), N**2)
+
+# Test the broadcasting of calculate_intensity over dense (h,k) grids
+def test_calculate_intensity_grid():
+    # Integer grid: every point is a Bragg peak of height (Na*Nb)^2
+    assert np.array_equal(calculate_intensity(3, 4), np.full((4, 5), (3 * 4)**2))
+
+    # Fractional grid: the intensity is the product of the two interference functions
+    h = np.linspace(0, 2, 201)[:, None]
+    k = np.linspace(0, 2, 101)[None, :]
+    intensity = calculate_intensity(3, 4, h, k)
+    assert intensity.shape == (201, 101)
+    assert np.allclose(intensity, interference_function(h, 3) * interference_function(k, 4))
+
+# Test the blocked structure factor against the direct sum and the interference function
+def test_calculate_structure_factor():
+    rng = np.random.default_rng(0)
+    atomic_positions = rng.uniform(0, 5, size=(300, 3))
+    q_points = rng.uniform(-2, 2, size=(70, 3))
+    form_factors = rng.uniform(1, 3, size=300)
+
+    # Direct sum over all the (q, atom) pairs, with block sizes that do not divide the array lengths
+    expected = np.exp(2j * np.pi * q_points @ atomic_positions.T) @ form_factors
+    assert np.allclose(calculate_structure_factor(atomic_positions, q_points, form_factors, q_block=16, atom_block=37), expected)
+
+    # For a simple cubic block the intensity is the product of the interference functions of Nx+1, Ny+1 and Nz+1 atoms
+    h = rng.uniform(-1, 1, size=(50, 3))
+    intensity = calculate_kinematic_intensity(generate_simple_cubic(3, 4, 2), h)
+    assert np.allclose(intensity, interference_function(h[:, 0], 4) * interference_function(h[:, 1], 5) * interference_function(h[:, 2], 3))
+
+    # the form factor of an element cannot be applied on top of explicit form factors
+    with pytest.raises(ValueError):
+        calculate_kinematic_intensity(atomic_positions, q_points, form_factors, element="Ir")
+
+# Test the crystal truncation rod of a finite slab against the direct sum over its atoms
+@given(structure=st.sampled_from(["sc", "bcc", "fcc"]), Nz=st.integers(min_value=1, max_value=6), h=st.integers(min_value=-2, max_value=2), k=st.integers(min_value=-2, max_value=2))
+def test_calculate_ctr(structure, Nz, h, k):
+    a = 3.85
+    slab = generate_cubic_structure(structure, 2, 2, Nz, a)
+    n_bulk_cells, surface_positions = split_slab(slab, a, n_surface_cells=1)
+    assert n_bulk_cells == Nz - 1
+
+    # Atoms of one lateral unit cell of the slab, in units of the lattice parameter
+    fractional_positions = slab / a
+    fractional_positions = fractional_positions[np.all(fractional_positions[:, :2] < 1 - 1e-6, axis=1)]
+
+    l = np.linspace(-1.3, 2.7, 41)
+    q_points = np.column_stack([np.full_like(l, h), np.full_like(l, k), l])
+    expected = calculate_kinematic_intensity(fractional_positions, q_points)
+
+    intensity = calculate_ctr(structure, h, k, l, surface_positions, a, n_bulk_cells=n_bulk_cells, attenuation=0.0)
+    assert np.allclose(intensity, expected)
+
+    # The bulk unit cell of the rod is cached
+    assert bulk_layer_coefficients.cache_info().currsize > 0
+
+# Test the form factor table and its cache
+def test_atomic_form_factor():
+    clear_form_factor_cache()
+    q = np.linspace(0, 2, 500)
+
+    # In the forward direction the form factor counts the electrons of the atom
+    for element, Z in [("H", 1), ("O", 8), ("Cu", 29), ("Ir", 77), ("Pt", 78), ("Au", 79)]:
+        assert abs(atomic_form_factor(element, np.zeros(1))[0] - Z) < 0.1
+
+    # The form factor decreases with q, and a second evaluation on the same grid is served by the cache
+    form_factor = atomic_form_factor("Ir", q)
+    assert np.all(np.diff(form_factor) < 0)
+    assert atomic_form_factor("Ir", q.copy()) is form_factor
+    assert form_factor_cache_info()["hits"] == 1
+
+    with pytest.raises(ValueError):
+        atomic_form_factor("Xx", q)
+
+# Test that every tabulated element has f(0) equal to its number of electrons
+def test_cromer_mann_coefficients():
+    atomic_numbers = {"H": 1, "C": 6, "N": 7, "O": 8, "Na": 11, "Al": 13, "Si": 14, "S": 16, "K": 19, "V": 23, "Cr": 24, "Fe": 26, "Co": 27, "Ni": 28, "Cu": 29,
+                      "Nb": 41, "Mo": 42, "Rh": 45, "Pd": 46, "Ag": 47, "Cs": 55, "Ta": 73, "W": 74, "Ir": 77, "Pt": 78, "Au": 79, "Pb": 82}
+    assert set(atomic_numbers) == set(CROMER_MANN_COEFFICIENTS)
+    for element, Z in atomic_numbers.items():
+        assert abs(evaluate_form_factor(element, 0.0) - Z) < 0.1
+
+# Test the vectorized symmetry checks against a direct search over the rounded coordinates
+@given(points=st.lists(st.tuples(st.integers(min_value=-6, max_value=6), st.integers(min_value=-6, max_value=6)), min_size=1, max_size=40))
+def test_symmetry_checks(points):
+    atomic_coordinates = np.array(points) / 4
+    coordinates_set = set(tuple(np.round(coord, 3)) for coord in atomic_coordinates)
+
+    def has_image(transformation):
+        return all(tuple(np.round(transformation(x, y), 3)) in coordinates_set for x, y in atomic_coordinates)
+
+    assert check_2fold_rotation_axis(atomic_coordinates) == has_image(lambda x, y: (-x, -y))
+    assert check_centered_unit_cell_symmetry(atomic_coordinates) == has_image(lambda x, y: (x + 0.5, y + 0.5))
+
+# Test that atoms straddling a rounding boundary are still recognised as images of each other
+def test_contains_coordinates_rounding_boundary():
+    atomic_coordinates = np.array([[0.12349999, 0.3], [-0.12350001, -0.3]])
+    assert check_2fold_rotation_axis(atomic_coordinates)
+
+    # Images farther than the tolerance are not found
+    index = build_coordinate_index(atomic_coordinates)
+    assert list(contains_coordinates(index, [[0.1241, 0.3], [0.1235, 0.3], [5.0, 5.0]])) == [False, True, False]
+
+# Test that the lattice reduction terminates on half-length ties, where the rounding noise used to flip the sign
+# of the projection at every step
+@pytest.mark.parametrize("lattice_vectors", [[[1.0, 0.0], [0.5, 1.0]], [[1.414213562373095, 0.0], [-4.949747468305832, 3.0822070014844876]]])
+def test_reduce_lattice_ties(lattice_vectors):
+    from create_cubic_structure import _reduce_lattice
+    lattice_vectors = np.array(lattice_vectors)
+    first, second = _reduce_lattice(np.eye(2), lattice_vectors) @ lattice_vectors
+    assert abs(first @ second) <= (0.5 + 1e-9) * (first @ first) <= (0.5 + 1e-9) * (second @ second)
+    assert np.isclose(abs(np.linalg.det(np.array([first, second]))), abs(np.linalg.det(lattice_vectors)))
+
+# Build a periodic 2D structure (3x3 cells) from the orbit of two generic points under the given
+# cartesian operations (R, t) and centring translations (fractional)
+def plane_group_structure(lattice_vectors, operations, centring=()):
+    inverse = np.linalg.inv(lattice_vectors)
+    operations = [(lattice_vectors @ R.T @ inverse, np.array(t)) for R, t in operations] + [(np.eye(2), np.array(t)) for t in centring]
+    basis = [np.array([0.137, 0.291]), np.array([0.61, 0.77])]
+    for point in basis:
+        for A, t in operations:
+            image = (point @ A + t) % 1
+            if not any(np.allclose((image - b + 0.5) % 1 - 0.5, 0, atol=1e-6) for b in basis):
+                basis.append(image)
+    return np.array([(b + [i, j]) @ lattice_vectors for i in range(3) for j in range(3) for b in basis])
+
+rectangular = np.array([[1.0, 0.0], [0.0, 1.7]])
+hexagonal = surface_lattice_vectors("fcc", "111")
+rotation_120 = np.array([[-0.5, -np.sqrt(3)/2], [np.sqrt(3)/2, -0.5]])
+mirror_x, mirror_y = np.diag([-1.0, 1.0]), np.diag([1.0, -1.0])
+
+# Test the plane group detection on structures built from their symmetry operations
+@pytest.mark.parametrize("plane_group, lattice_vectors, operations, centring", [
+    ("pg", rectangular, [(mirror_x, (0, 0.5))], ()),
+    ("cm", rectangular, [(mirror_x, (0, 0))], [(0.5, 0.5)]),
+    ("pgg", rectangular, [(mirror_x, (0.5, 0.5)), (-np.eye(2), (0, 0))], ()),
+    ("p4g", np.eye(2), [(np.array([[0.0, -1.0], [1.0, 0.0]]), (0, 0)), (mirror_x, (0.5, 0.5))], ()),
+    ("p3m1", hexagonal, [(rotation_120, (0, 0)), (mirror_x, (0, 0))], ()),
+    ("p31m", hexagonal, [(rotation_120, (0, 0)), (mirror_y, (0, 0))], ()),
+])
+def test_detect_plane_group(plane_group, lattice_vectors, operations, centring):
+    atomic_coordinates = plane_group_structure(lattice_vectors, operations, centring)
+    assert detect_plane_group(atomic_coordinates, lattice_vectors)["plane_group"] == plane_group
+    # Every group with reflections has glide lines, except pm and pmm
+    assert check_glide_plane_symmetry(atomic_coordinates, lattice_vectors = lattice_vectors)
+
+    # The predicted systematic absences are zeros of the structure factor
+    h, k = np.arange(-4, 5)[:, None], np.arange(-4, 5)[None, :]
+    absent = find_systematic_absences(h, k, detect_plane_group(atomic_coordinates, lattice_vectors)["symmetry_operations"])
+    fractional = atomic_coordinates @ np.linalg.inv(lattice_vectors)
+    F = np.abs(np.exp(2j*np.pi*(fractional[:, 0, None, None]*h + fractional[:, 1, None, None]*k)).sum(axis=0))
+    assert np.all(F[absent] < 1e-6)
+    assert absent.any() == (plane_group in ("pg", "cm", "pgg", "p4g"))
+
+# Test the plane groups of the generated (111) surfaces
+@pytest.mark.parametrize("structure, plane_group", [("sc", "p4m"), ("fcc", "p6m")])
+def test_surface_plane_group(structure, plane_group):
+    surface = shift_surface_coordinates(generate_surface_structure(structure, '111', 5, 4))
+    assert detect_plane_group(surface, surface_lattice_vectors(structure, '111'))["plane_group"] == plane_group
+
+# Test that the forbidden reflections are skipped and the allowed ones are unchanged
+def test_forbidden_reflections():
+    # Centred rectangular cell: the reflections with h + k odd are extinct
+    atomic_coordinates = plane_group_structure(rectangular, [(mirror_x, (0, 0))], [(0.5, 0.5)])
+    symmetry_properties = get_symmetry_properties(atomic_coordinates, lattice_vectors = rectangular)
+    h, k = np.arange(7)[:, None], np.arange(5)[None, :]
+    forbidden = forbidden_reflections(h, k, symmetry_properties)
+    assert np.array_equal(forbidden, (h + k) % 2 == 1)
+
+    intensity = calculate_intensity(6, 4, h, k, symmetry_properties)
+    assert np.all(intensity[forbidden] == 0)
+    assert np.allclose(intensity[~forbidden], calculate_intensity(6, 4, h, k)[~forbidden])
+    assert np.array_equal(calculate_intensity(6, 4, h, k, forbidden = forbidden), intensity)
+
+    # On a fractional grid only the integer reflections can be forbidden
+    h, k = np.linspace(0, 3, 31)[:, None], np.linspace(0, 2, 21)[None, :]
+    forbidden = forbidden_reflections(h, k, symmetry_properties)
+    integer = np.isclose(h, np.round(h)) & np.isclose(k, np.round(k))
+    assert np.array_equal(forbidden, integer & ((np.round(h) + np.round(k)) % 2 == 1))
+
+    # pg: the (0, k) reflections with k odd are extinct, not the fractional (0, k) points
+    atomic_coordinates = plane_group_structure(rectangular, [(mirror_x, (0, 0.5))])
+    symmetry_operations = get_symmetry_properties(atomic_coordinates, lattice_vectors = rectangular)["symmetry_operations"]
+    assert np.array_equal(find_systematic_absences(0, [0.3, 0.5, 1, 2, 3], symmetry_operations), [False, False, True, False, True])
+
+    # The (111) surfaces have no forbidden reflections
+    surface = shift_surface_coordinates(generate_surface_structure("fcc", '111', 3, 3))
+    symmetry_properties = get_symmetry_properties(surface, lattice_vectors = surface_lattice_vectors("fcc", '111'))
+    assert len(generate_reciprocal_surface_structure("fcc", '111', 3, 3, symmetry_properties)) == 16
+
+# Test the surface cell of arbitrary (hkl) planes: its area times the interplanar spacing is the primitive volume
+@given(structure=st.sampled_from(["sc", "bcc", "fcc"]), miller=st.tuples(*[st.integers(min_value=-6, max_value=6)]*3).filter(any), a=st.floats(min_value=1.0, max_value=6.0))
+def test_surface_unit_cell(structure, miller, a):
+    cell = surface_unit_cell(structure, miller, a)
+    primitive = bravais_lattice_vectors(structure, a)
+
+    # shortest reciprocal lattice vector (without 2*pi) normal to the plane
+    c = np.round(2 * bravais_lattice_vectors(structure) @ np.array(miller)).astype(int)
+    G = (c // np.gcd.reduce(c)) @ np.linalg.inv(primitive).T
+    assert np.isclose(abs(np.linalg.det(cell)), abs(np.linalg.det(primitive)) * np.linalg.norm(G))
+
+    # reduced cell, with the reciprocal basis dual to it
+    assert abs(cell[0] @ cell[1]) <= cell[0] @ cell[0] / 2 + 1e-9
+    assert np.allclose(cell @ reciprocal_surface_cell(cell).T, 2*np.pi * np.eye(2))
+
+# Test the reciprocal meshes against the original double loops
+def test_generate_reciprocal_mesh():
+    Na, Nb = 4, 3
+    assert np.array_equal(generate_reciprocal_111_surface_sc(Na, Nb), [[i, j] for j in range(Nb+1) for i in range(Na+1)])
+    angle = np.pi/3
+    assert np.allclose(generate_reciprocal_111_surface_fcc(Na, Nb), [[i*np.sin(angle), j + i*np.cos(angle)] for i in range(Na+1) for j in range(Nb+1)])
+    assert np.allclose(surface_unit_cell("fcc", '111', 2.0), np.sqrt(2) * surface_lattice_vectors("fcc", '111'))
+    assert generate_reciprocal_mesh(reciprocal_surface_cell(np.eye(2)), 999, 999).shape == (10**6, 2)
+
+# Test the overlayer builder and the analytic spot indexing against a brute-force search
+@pytest.mark.parametrize("structure, notation, n_substrate", [("fcc", "(√3x√3)R30°", 3), ("fcc", "p(2x2)", 4), ("sc", "c(2x2)", 2), ("sc", "p(2x1)", 2)])
+def test_build_overlayer(structure, notation, n_substrate):
+    lattice_vectors = surface_lattice_vectors(structure, '111')
+    overlayer = build_overlayer(lattice_vectors, notation, [[0.5, 0.0]], 3, 3)
+    assert len(overlayer["substrate_positions"]) == 9 * n_substrate
+    assert len(overlayer["adsorbate_positions"]) == 9
+    # the substrate is the same net as without the overlayer
+    substrate = overlayer["substrate_positions"] @ np.linalg.inv(lattice_vectors)
+    assert np.allclose(substrate, np.round(substrate)) and len(np.unique(np.round(substrate), axis=0)) == len(substrate)
+
+    # the overlayer spots are the maxima of the structure factor of the adsorbate net, on a 1/12 grid
+    spots = superstructure_spots(overlayer["matrix"], 1)
+    adsorbates = overlayer["adsorbate_positions"] @ np.linalg.inv(lattice_vectors)
+    grid = np.stack(np.meshgrid(np.arange(-12, 13), np.arange(-12, 13), indexing='ij'), axis=-1).reshape(-1, 2) / 12
+    F = np.abs(np.exp(2j*np.pi * grid @ adsorbates.T).sum(axis=1))
+    assert np.allclose(spots["hk"], grid[F > len(adsorbates) - 1e-6])
+    assert spots["integer_order"].sum() == 9
+
+# Test the Wood notation
+def test_overlayer_matrix():
+    hexagonal = surface_lattice_vectors("fcc", '111')
+    assert np.array_equal(overlayer_matrix("(√3x√3)R30°", hexagonal), [[1, 1], [-1, 2]])
+    assert np.array_equal(overlayer_matrix("(sqrt3 x sqrt3)R30", hexagonal), [[1, 1], [-1, 2]])
+    assert np.array_equal(overlayer_matrix("c(2x2)", np.eye(2)), [[1, 1], [-1, 1]])
+    with pytest.raises(ValueError):
+        overlayer_matrix("(√2x√2)R45°", hexagonal)
+
+# Test the rasterizer: the spots land on the right pixels and their intensity is conserved
+@pytest.mark.parametrize("kernel", [None, "gaussian", "lorentzian"])
+def test_rasterize_spots(kernel, tmp_path):
+    spots = np.array([[-0.5, 0.5], [0.25, -0.25]])
+    image = rasterize_spots(spots, [1.0, 2.0], (40, 80), (-1, 1, -1, 1), kernel=kernel, width=1.0)
+    assert image.shape == (40, 80)
+    assert np.isclose(image.sum(), 3.0, rtol=1e-2)
+    # brightest pixel at x = 0.25 (column 50), y = -0.25 (row 25), with y increasing upwards
+    assert np.unravel_index(image.argmax(), image.shape) in [(r, c) for r in (24, 25) for c in (49, 50)]
+
+    # spots outside the image are dropped
+    assert rasterize_spots([[5.0, 5.0]], 1.0, (8, 8), (-1, 1, -1, 1), kernel=None).sum() == 0
+
+    save_pattern(render_surface_pattern({"structure": "fcc", "plane": '111'}, calculate_intensity(3, 3), (32, 32)), str(tmp_path / "pattern.png"))
+    assert (tmp_path / "pattern.png").stat().st_size > 0
+
+# Test the headless plots: the images are written to disk without a GUI, also with decimation and the top projection
+def test_headless_plots(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    parameters = {"structure": "fcc", "Nx": 3, "Ny": 3, "Nz": 3, "a": 3.85, "element": "Ir", "plane": "111", "Na": 3, "Nb": 3}
+
+    results = run_pipeline(parameters, save_files=False, plot=True, save_plots=True)
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["Ir(111)_fcc_a3.85__Na3_Nb3.png", "Ir_fcc_a3.85__Nx3_Ny3_Nz3.png", "pattern_Ir(111)_fcc_a3.85__Na3_Nb3.png"]
+
+    plot_cubic_structure(results["cubic_positions"], parameters, "top.png", max_atoms=50, projection="top")
+    assert (tmp_path / "top.png").stat().st_size > 0
+    assert len(decimate_positions(results["cubic_positions"], 50)) <= 50
+
+# Test that plotting saved coordinates reads only the decimated atoms of the memory mapped file
+def test_plot_memory_mapped(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    parameters = {"structure": "fcc", "Nx": 6, "Ny": 6, "Nz": 6, "a": 3.85, "element": "Ir", "plane": "111", "Na": 3, "Nb": 3}
+    save_atomic_coordinates(generate_cubic_structure("fcc", 6, 6, 6, 3.85), parameters)
+    cubic_positions = get_cubic_coordinates(parameters)
+    assert isinstance(cubic_positions, np.memmap)
+
+    # record the arithmetic done on the whole memory mapped array
+    whole_array_operations = []
+    def spy(self, ufunc, method, *inputs, **kwargs):
+        if any(isinstance(x, np.memmap) and x.size == cubic_positions.size for x in inputs):
+            whole_array_operations.append(ufunc.__name__)
+        return np.ndarray.__array_ufunc__(self, ufunc, method, *(np.asarray(x) if isinstance(x, np.memmap) else x for x in inputs), **kwargs)
+    monkeypatch.setattr(np.memmap, "__array_ufunc__", spy, raising=False)
+
+    plot_cubic_structure(cubic_positions, parameters, "decimated.png", max_atoms=50, lattice_parameter=parameters["a"])
+    assert (tmp_path / "decimated.png").stat().st_size > 0
+    assert whole_array_operations == []
+
+# Test that the modules can be imported quickly and without loading matplotlib (import-time budget)
+@pytest.mark.parametrize("module", ["create_cubic_structure", "main", "sweep", "structure_factor", "overlayer", "diffraction_pattern", "plot_cubic_structure"])
+def test_import_time(module):
+    # numpy is imported first: the budget covers the modules of the package only
+    code = f"import sys, time, numpy; start = time.perf_counter(); import {module}; print(time.perf_counter() - start, 'matplotlib' in sys.modules)"
+    output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.split()
+    assert output[1] == "False"
+    assert float(output[0]) < 0.2
+
+# Test the benchmark harness on small sizes and the detection of the regressions with respect to a baseline
+def test_benchmarks(tmp_path):
+    results = run_benchmarks(sizes=(10, 100), repeat=1)
+    assert [(record["benchmark"], record["size"]) for record in results] == [(name, size) for name in BENCHMARKS for size in (10, 100)]
+    assert all(record["time"] > 0 and record["peak_memory"] >= 0 for record in results)
+
+    baseline = load_baseline(save_baseline(results, str(tmp_path / "baseline.json")))
+    assert find_regressions(results, baseline) == []
+
+    # a run three times slower than the baseline is flagged
+    slower = [dict(record, time=3 * record["time"] + 0.01) for record in results]
+    assert len(find_regressions(slower, baseline)) == len(results)
+    assert {regression["metric"] for regression in find_regressions(slower, baseline)} == {"time"}
+
+# Test the instrumentation: one JSON line per stage with times, memory and counts, nothing when switched off
+def test_instrumentation(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    parameters = {"structure": "fcc", "Nx": 2, "Ny": 2, "Nz": 2, "a": 3.85, "element": "Ir", "plane": "111", "Na": 3, "Nb": 3}
+
+    run_pipeline(parameters, save_files=False, plot=False)
+    assert list(tmp_path.iterdir()) == []
+
+    try:
+        instrumentation.configure(str(tmp_path / "stages.jsonl"), trace_memory=True)
+        run_pipeline(parameters, save_files=False, plot=False)
+    finally:
+        instrumentation.configure(None)
+
+    records = {record["stage"]: record for record in map(json.loads, (tmp_path / "stages.jsonl").read_text().splitlines())}
+    assert records["generate_cubic_structure"]["n_atoms"] == len(generate_cubic_structure("fcc", 2, 2, 2))
+    assert records["calculate_intensity"]["n_q_points"] == 16
+    assert records["get_symmetry_properties"]["n_atoms"] == 16
+    assert "Checking the symmetry properties" in records
+    assert records["Calculating the intensity"]["evaluations_saved"] == 0
+    for record in records.values():
+        assert record["wall_time"] >= 0 and record["cpu_time"] >= 0 and record["allocated_bytes"] >= 0
+    # the memory of a stage includes the memory of the nested ones
+    assert records["Generating the cubic structure"]["allocated_bytes"] >= records["generate_cubic_structure"]["allocated_bytes"]
+
+# Test that every instrumented stage can be called by keyword with the instrumentation on, and the atom counts
+def test_instrumented_keywords(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    parameters = {"structure": "fcc", "Nx": 2, "Ny": 2, "Nz": 2, "a": 3.85, "element": "Ir", "plane": "111", "Na": 3, "Nb": 3}
+    try:
+        instrumentation.configure(str(tmp_path / "stages.jsonl"))
+        cubic_positions = generate_cubic_structure(structure="fcc", Nx=2, Ny=2, Nz=2, a=3.85)
+        surface_positions = generate_surface_structure(structure="fcc", plane="111", Na=3, Nb=3)
+        assert generate_surface_structure(structure="bcc", plane="111", Na=2, Nb=2) is None
+        shift_surface_coordinates(atomic_positions=np.stack([surface_positions] * 5))
+        symmetry_properties = get_symmetry_properties(atomic_coordinates=shift_surface_coordinates(surface_positions), lattice_vectors=surface_lattice_vectors("fcc", "111"))
+        intensity = calculate_intensity(Na=3, Nb=3, symmetry_properties=symmetry_properties)
+        save_atomic_coordinates(coordinates=cubic_positions, parameters=parameters)
+        save_intensity(intensity=intensity, parameters=parameters)
+        plot_cubic_structure(cubic_positions=cubic_positions, parameters=parameters, filename=str(tmp_path / "cubic.png"))
+        plot_surface_structure(surface_positions=surface_positions, filename=str(tmp_path / "surface.png"))
+    finally:
+        instrumentation.configure(None)
+
+    records = [json.loads(line) for line in (tmp_path / "stages.jsonl").read_text().splitlines()]
+    n_atoms = {}
+    for record in records:
+        n_atoms.setdefault(record["stage"], []).append(record.get("n_atoms"))
+    assert n_atoms["generate_cubic_structure"] == n_atoms["save_atomic_coordinates"] == n_atoms["plot_cubic_structure"] == [len(cubic_positions)]
+    assert n_atoms["generate_surface_structure"] == [16, None]
+    # the batch of 5 structures counts the atoms of one structure
+    assert n_atoms["shift_surface_coordinates"] == [16, 16]
+    assert n_atoms["get_symmetry_properties"] == n_atoms["plot_surface_structure"] == [16]
+    assert [record["n_q_points"] for record in records if record["stage"] == "calculate_intensity"] == [16]
+    assert "save_intensity" in n_atoms
+
+# Test the vectorized shift against the original list comprehension, in place and on a batch of structures
+@given(points=st.lists(st.tuples(*[st.floats(min_value=-100, max_value=100)]*3), min_size=1, max_size=50), dimension=st.sampled_from([2, 3]))
+def test_shift_surface_coordinates(points, dimension):
+    positions = np.array(points)
+    center = np.mean(positions, axis=0)
+    expected = [[pos[i] - center[i] for i in range(dimension)] for pos in positions]
+
+    shifted = shift_surface_coordinates(positions, dimension)
+    assert isinstance(shifted, np.ndarray) and shifted.flags['C_CONTIGUOUS']
+    assert np.allclose(shifted, expected)
+
+    # in place, and on a stacked batch where every structure is shifted on its own center
+    in_place = positions[:, :dimension].copy()
+    assert shift_surface_coordinates(in_place, dimension, out=in_place) is in_place
+    assert np.allclose(in_place, expected)
+    assert np.allclose(shift_surface_coordinates(np.stack([positions, 2 * positions + 1]), dimension), [expected, 2 * np.array(expected)])
+
+# Test the rotation and the scaling to Å of the surface coordinates
+def test_transform_coordinates():
+    surface = shift_surface_coordinates(generate_surface_structure("fcc", '111', 3, 3))
+    rotated = transform_coordinates(surface, rotation=90)
+    assert np.allclose(rotated, np.column_stack([-surface[:, 1], surface[:, 0]]))
+    assert np.allclose(transform_coordinates(surface, shift=surface[0]), surface - surface[0])
+
+    scaled = transform_coordinates(surface, scale=surface_lattice_parameter("fcc", '111', 3.84))
+    assert np.isclose(np.min(np.linalg.norm(scaled[1:] - scaled[0], axis=1)), 3.84 / np.sqrt(2))
+
+# Test the result cache: a second run reads every result back instead of computing it, and the LRU eviction bounds its size
+def test_result_cache(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    parameters = {"structure": "fcc", "Nx": 2, "Ny": 2, "Nz": 2, "a": 3.85, "element": "Ir", "plane": "111", "Na": 3, "Nb": 3}
+    try:
+        result_cache.configure(str(tmp_path / "cache"))
+        result_cache.clear_result_cache()
+        first = run_pipeline(parameters, save_files=False, plot=False)
+        assert result_cache.result_cache_info()["misses"] == 4
+
+        # another element has the same geometry: nothing is computed
+        second = run_pipeline(dict(parameters, element="Pt"), save_files=False, plot=False)
+        info = result_cache.result_cache_info()
+        assert info["hits"] == 4 and info["misses"] == 4 and info["entries"] == 4
+        assert np.array_equal(first["cubic_positions"], second["cubic_positions"])
+        assert np.array_equal(first["intensity"], second["intensity"])
+        assert second["symmetry_properties"]["plane_group"] == first["symmetry_properties"]["plane_group"]
+        assert np.allclose(find_systematic_absences(2, 1, second["symmetry_properties"]["symmetry_operations"]),
+                           find_systematic_absences(2, 1, first["symmetry_properties"]["symmetry_operations"]))
+        assert not list((tmp_path / "cache").rglob("*.tmp"))
+
+        # the least recently used entry is removed first, and reading an entry marks it as recently used
+        entries = sorted((tmp_path / "cache").rglob("*.npz"))
+        for age, path in enumerate(entries):
+            os.utime(path, (1000 + age, 1000 + age))
+        oldest = entries[0].parent.name
+        key = result_cache.cache_key(oldest, parameters, **({"pruned": True} if oldest == "intensity" else {}))
+        assert result_cache.load(oldest, key) is not None
+        result_cache.evict(result_cache.result_cache_info()["size"] - 1)
+        assert {path.parent.name for path in (tmp_path / "cache").rglob("*.npz")} == {path.parent.name for path in entries[2:]} | {oldest}
+
+        # the other files of the cache directory are never evicted
+        (tmp_path / "cache" / "results").mkdir()
+        np.savez(tmp_path / "cache" / "user.npz", x=np.zeros(3))
+        np.savez(tmp_path / "cache" / "results" / "data.npz", x=np.zeros(3))
+        result_cache.evict(0)
+        assert result_cache.result_cache_info()["entries"] == 0
+        assert sorted((tmp_path / "cache").rglob("*.npz")) == [tmp_path / "cache" / "results" / "data.npz", tmp_path / "cache" / "user.npz"]
+    finally:
+        result_cache.configure(None)
+    assert not result_cache.is_enabled()
+
+    # editing any module computing cached results (here the reciprocal meshes) changes the keys
+    edited = tmp_path / "diffraction_pattern.py"
+    edited.write_text(open(importlib.util.find_spec("diffraction_pattern").origin).read() + "\n# edited\n")
+    find_spec = importlib.util.find_spec
+    key = result_cache.cache_key("reciprocal_mesh", parameters)
+    monkeypatch.setattr(importlib.util, "find_spec", lambda name: importlib.machinery.ModuleSpec(name, None, origin=str(edited)) if name == "diffraction_pattern" else find_spec(name))
+    result_cache.code_version.cache_clear()
+    try:
+        assert result_cache.cache_key("reciprocal_mesh", parameters) != key
+    finally:
+        monkeypatch.undo()
+        result_cache.code_version.cache_clear()
+
+# Test the settings read from several configuration files: merged when they agree, rejected when they conflict,
+# overridden by the environment
+def test_config_sections(tmp_path, monkeypatch):
+    monkeypatch.delenv(result_cache.CACHE_VARIABLE, raising=False)
+    monkeypatch.delenv(parallel.EXECUTOR_VARIABLE, raising=False)
+    for name, text in [("first.ini", "[cache]\ndirectory = shared\n[parallel]\nexecutor = threads\n"),
+                       ("second.ini", "[cache]\ndirectory = shared\nmax_megabytes = 2\n"),
+                       ("conflict.ini", "[parallel]\nexecutor = processes\n")]:
+        (tmp_path / name).write_text(text)
+    files = [str(tmp_path / "first.ini"), str(tmp_path / "second.ini")]
+
+    try:
+        result_cache.configure_from_config(files)
+        assert os.environ[result_cache.CACHE_VARIABLE] == "shared" and os.environ[result_cache.CACHE_SIZE_VARIABLE] == str(2 * 2**20)
+        parallel.configure_from_config(files)
+        assert parallel.worker_count() > 0 and os.environ[parallel.EXECUTOR_VARIABLE] == "threads"
+
+        # the environment takes precedence, even over conflicting files
+        parallel.configure_from_config(files + [str(tmp_path / "conflict.ini")])
+        assert os.environ[parallel.EXECUTOR_VARIABLE] == "threads"
+        parallel.configure()
+        monkeypatch.delenv(parallel.EXECUTOR_VARIABLE)
+        with pytest.raises(ValueError):
+            parallel.configure_from_config(files + [str(tmp_path / "conflict.ini")])
+    finally:
+        result_cache.configure(None)
+        parallel.configure()
+        monkeypatch.delenv(parallel.EXECUTOR_VARIABLE, raising=False)
+
+# Test the compact crystal: the positions on demand match the generators and the factorised intensity matches the direct sum
+@pytest.mark.parametrize("structure", ["sc", "bcc", "fcc"])
+def test_crystal(structure):
+    crystal = cubic_crystal(structure, 3, 2, 4, 3.85, element="Ir")
+    assert np.allclose(crystal_positions(crystal, include_boundary=True), generate_cubic_structure(structure, 3, 2, 4, 3.85))
+    assert count_crystal_atoms(crystal, include_boundary=True) == count_cubic_atoms(structure, 3, 2, 4)
+    assert np.allclose(np.concatenate(list(iterate_crystal_positions(crystal, block_size=7))), crystal_positions(crystal))
+
+    q_points = np.random.default_rng(0).uniform(-2, 2, (50, 3)) / 3.85
+    q_points[:3] = np.array([[1, 1, 1], [2, 0, 0], [1, 0, 0]]) / 3.85
+    expected = calculate_kinematic_intensity(crystal_positions(crystal), q_points, element="Ir")
+    assert np.allclose(crystal_intensity(crystal, q_points), expected, atol=1e-9 * expected.max())
+
+    # the surface net of a single atom per cell gives back calculate_intensity
+    surface = surface_crystal("fcc", '111', 3, 4)
+    h, k = np.meshgrid(np.linspace(0, 2, 9), np.linspace(0, 2, 9), indexing='ij')
+    q_points = np.stack([h.ravel(), k.ravel()], axis=1) @ reciprocal_surface_cell(surface["lattice_vectors"]) / (2 * np.pi)
+    assert np.allclose(crystal_intensity(surface, q_points), calculate_intensity(3, 4, h, k).ravel())
+
+    with pytest.raises(ValueError):
+        make_crystal(np.eye(3), [[0.0, 0.0, 1.0]], (1, 1, 1))
+
+# Test that the parallel structure factor is bitwise identical to the serial one for every backend and partition
+@pytest.mark.parametrize("executor, max_workers", [("threads", 2), ("threads", 16), ("processes", 3)])
+def test_parallel_structure_factor(executor, max_workers):
+    rng = np.random.default_rng(0)
+    atomic_positions, q_points, form_factors = rng.uniform(0, 5, (300, 3)), rng.uniform(-2, 2, (70, 3)), rng.uniform(1, 2, 300)
+
+    # 16 workers and 5 q blocks: the atom blocks are distributed instead of the q blocks
+    expected = calculate_structure_factor(atomic_positions, q_points, form_factors, q_block=16, atom_block=37, executor="serial")
+    result = calculate_structure_factor(atomic_positions, q_points, form_factors, q_block=16, atom_block=37, executor=executor, max_workers=max_workers)
+    assert np.array_equal(result, expected)
+
+    try:
+        parallel.configure(executor, max_workers)
+        assert np.array_equal(calculate_structure_factor(atomic_positions, q_points, form_factors, q_block=16, atom_block=37), expected)
+    finally:
+        parallel.configure("serial")
+
+    with pytest.raises(ValueError):
+        parallel.configure("gpu")
+
+# Test the parity of the Numba kernels with the NumPy evaluation (without Numba, the loops run as plain Python)
+def test_kernels():
+    rng = np.random.default_rng(1)
+    atomic_positions, q_points, form_factors = rng.uniform(0, 5, (40, 3)), rng.uniform(-2, 2, (30, 3)), rng.uniform(1, 2, 40)
+    expected = calculate_structure_factor(atomic_positions, q_points, form_factors)
+    h, k = np.linspace(-2, 2, 41), np.linspace(0, 3, 31)
 
+    real, imag = np.empty(30), np.empty(30)
+    kernels._phase_sum_loop(atomic_positions, q_points, form_factors, real, imag)
+    intensity = np.empty((41, 31))
+    kernels._interference_grid_loop(h, k, 4, 5, intensity)
+    assert np.allclose(real + 1j * imag, expected, rtol=1e-12, atol=1e-12)
+    assert np.allclose(intensity, calculate_intensity(4, 5, h[:, None], k[None, :]), rtol=1e-12)
 
+    # with jit=True the compiled kernels are used if Numba is installed, the NumPy evaluation otherwise
+    assert np.allclose(calculate_structure_factor(atomic_positions, q_points, form_factors, jit=True), expected, rtol=1e-12, atol=1e-12)
+    assert np.allclose(calculate_intensity(4, 5, h[:, None], k[None, :], jit=True), intensity, rtol=1e-12)
+    assert (kernels.get_kernel("phase_sum") is None) == (not kernels.numba_available())